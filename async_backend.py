@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+API no bloqueante del backend para la interfaz.
+
+Cada función encola la operación en un único hilo de E/S y devuelve un
+`Future` sin esperar al disco. El resultado vuelve al hilo principal de Kivy
+con `Clock.schedule_once`: `on_done(resultado)` si terminó bien u
+`on_error(excepción)` si falló. Al haber un solo hilo, las operaciones se
+ejecutan en el orden en que se pidieron (una edición nunca adelanta a la
+lectura que la precede).
+
+Uso:
+    async_backend.load_meds(on_done=self._show_meds)
+    async_backend.add_med(entry, on_done=self._saved, on_error=self._save_failed)
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import backend
+
+_executor = None
+_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dosely-io")
+        return _executor
+
+
+def _to_main_thread(callback, value):
+    from kivy.clock import Clock
+    Clock.schedule_once(lambda _dt: callback(value), 0)
+
+
+def submit(fn, *args, on_done=None, on_error=None, **kwargs):
+    """Ejecuta `fn(*args, **kwargs)` en el hilo de E/S y entrega el resultado en el hilo de la UI."""
+    def run():
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as error:
+            if on_error is not None:
+                _to_main_thread(on_error, error)
+                return None
+            from kivy.logger import Logger
+            Logger.exception(f"Dosely: error en {getattr(fn, '__name__', fn)}")
+            raise
+        if on_done is not None:
+            _to_main_thread(on_done, result)
+        return result
+    return _get_executor().submit(run)
+
+
+def shutdown(wait: bool = True):
+    """Espera a que terminen las operaciones pendientes y detiene el hilo de E/S."""
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+def load_meds(on_done=None, on_error=None):
+    return submit(backend.load_meds, on_done=on_done, on_error=on_error)
+
+
+def load_medications(on_done=None, on_error=None):
+    return submit(backend.load_medications, on_done=on_done, on_error=on_error)
+
+
+def get_med(med_id: str, on_done=None, on_error=None):
+    return submit(backend.get_med, med_id, on_done=on_done, on_error=on_error)
+
+
+def check_interactions(entry: dict, med_id: str = None, on_done=None, on_error=None):
+    return submit(backend.check_interactions, entry, med_id, on_done=on_done, on_error=on_error)
+
+
+def add_med(entry: dict, on_done=None, on_error=None):
+    return submit(backend.add_med, entry, on_done=on_done, on_error=on_error)
+
+
+def update_med(med_id: str, entry: dict, on_done=None, on_error=None):
+    return submit(backend.update_med, med_id, entry, on_done=on_done, on_error=on_error)
+
+
+def search_catalog(query: str, on_done=None, on_error=None):
+    return submit(backend.search_catalog, query, on_done=on_done, on_error=on_error)
+
+
+def record_dose(med_id: str, kind: str = "taken", on_done=None, on_error=None):
+    return submit(backend.record_dose, med_id, kind, on_done=on_done, on_error=on_error)
+
+
+def last_dose(med_id: str, on_done=None, on_error=None):
+    return submit(backend.last_dose, med_id, on_done=on_done, on_error=on_error)
@@ -1,19 +1,54 @@
 # -*- coding: utf-8 -*-
 """
-Backend de Dosely: lectura y escritura de JSON,
+Backend de Dosely: almacenamiento de la lista del usuario,
 y funciones para cargar catálogo y buscar.
 
 Archivos:
-- storage/medicamentos.json  (lista del usuario)
-- storage/catalogo.json      (catálogo base con ejemplos)
+- storage/dosely.db          (lista del usuario, motor SQLite por defecto)
+- storage/medicamentos.json  (lista del usuario, motor JSON legado)
+- storage/catalogo.json      (catálogo base con ejemplos, formato de intercambio)
+- storage/catalogo.bin       (catálogo binario con índice, se abre con mmap)
+- storage/interacciones.json (interacciones y grupos terapéuticos, ver interactions.py)
+- storage/historial/         (historial de tomas, ver history.py)
+
+El motor se elige con la variable de entorno DOSELY_STORAGE_ENGINE
+("sqlite" o "json"). Con SQLite, un medicamentos.json existente se importa
+automáticamente la primera vez.
 """
+import copy
 import json
 import os
+import threading
+import time
+
+import catalog_bin
+import catalog_index
+import fuzzy
+import history
+import instrumentation
+import interactions
+import models
+import storage_engine
 
 # Directorio de almacenamiento relativo al directorio actual
 STORAGE_DIR = os.path.join(os.getcwd(), "storage")
 MEDS_FILE = os.path.join(STORAGE_DIR, "medicamentos.json")
 CATALOG_FILE = os.path.join(STORAGE_DIR, "catalogo.json")
+CATALOG_BIN_FILE = catalog_bin.bin_path_for(CATALOG_FILE)
+INTERACTIONS_FILE = os.path.join(STORAGE_DIR, "interacciones.json")
+DB_FILE = os.path.join(STORAGE_DIR, "dosely.db")
+HISTORY_DIR = os.path.join(STORAGE_DIR, "historial")
+
+STORAGE_ENGINE = os.environ.get("DOSELY_STORAGE_ENGINE", "sqlite")
+
+_engine = None
+_repository = None
+_history = None
+# Caches derivados de la lista: (repositorio, generación, objeto).
+_timeline = None
+_regimen = None
+# Funciones llamadas con STORAGE_DIR después de cada alta o edición.
+_listeners = []
 
 
 def ensure_storage():
@@ -24,14 +59,302 @@ def ensure_storage():
         os.makedirs(STORAGE_DIR, exist_ok=True)
 
 
+def set_storage_dir(path: str, catalog_dir: str = None):
+    """
+    Cambia el directorio de almacenamiento y olvida el motor, el repositorio
+    y el historial abiertos (benchmarks, herramientas de línea de comandos,
+    perfiles). `catalog_dir` permite conservar un catálogo compartido.
+    """
+    global STORAGE_DIR, MEDS_FILE, CATALOG_FILE, CATALOG_BIN_FILE, INTERACTIONS_FILE, DB_FILE, HISTORY_DIR
+    global _engine, _repository, _history, _timeline, _regimen
+    if _engine is not None and hasattr(_engine, "close"):
+        _engine.close()
+    STORAGE_DIR = os.path.abspath(path)
+    MEDS_FILE = os.path.join(STORAGE_DIR, "medicamentos.json")
+    CATALOG_FILE = os.path.join(os.path.abspath(catalog_dir or STORAGE_DIR), "catalogo.json")
+    CATALOG_BIN_FILE = catalog_bin.bin_path_for(CATALOG_FILE)
+    INTERACTIONS_FILE = os.path.join(os.path.dirname(CATALOG_FILE), "interacciones.json")
+    DB_FILE = os.path.join(STORAGE_DIR, "dosely.db")
+    HISTORY_DIR = os.path.join(STORAGE_DIR, "historial")
+    _engine = None
+    _repository = None
+    _history = None
+    _timeline = None
+    _regimen = None
+
+
+def open_engine(storage_dir: str, kind: str = None):
+    """
+    Crea un motor de almacenamiento para otro directorio (otro perfil o
+    almacén), sin tocar el motor del proceso.
+    """
+    kind = kind or STORAGE_ENGINE
+    meds_file = os.path.join(storage_dir, "medicamentos.json")
+    if kind == "json":
+        return storage_engine.JsonEngine(meds_file)
+    if kind == "sqlite":
+        return storage_engine.SqliteEngine(os.path.join(storage_dir, "dosely.db"), legacy_json=meds_file)
+    raise ValueError(f"Motor de almacenamiento desconocido: {kind}")
+
+
+def add_listener(callback):
+    """Registra `callback(storage_dir)`, que se llama después de cada alta o edición."""
+    if callback not in _listeners:
+        _listeners.append(callback)
+
+
+def _changed():
+    for callback in list(_listeners):
+        callback(STORAGE_DIR)
+
+
+def get_engine():
+    """
+    Devuelve el motor de almacenamiento configurado en STORAGE_ENGINE.
+    """
+    global _engine
+    if _engine is None:
+        ensure_storage()
+        _engine = open_engine(STORAGE_DIR)
+    return _engine
+
+
+class MedsRepository:
+    """
+    Lista de medicamentos del usuario en memoria, compartida por todo el proceso.
+
+    Las lecturas no tocan el disco; las escrituras pasan al motor y se reflejan
+    en memoria. Si otro proceso modifica el almacenamiento (cambia la firma del
+    motor), la lista se vuelve a cargar en la siguiente lectura.
+
+    Índices: por id (O(1)) y secundarios por nombre y sustancia normalizados.
+    `generation` aumenta con cada recarga completa.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._lock = threading.RLock()
+        self.generation = 0
+        self._meds = None
+        self._signature = None
+        self._pos_by_id = {}
+        self._by_name = {}
+        self._by_substance = {}
+        # id -> (diccionario, Medication) para no volver a convertir lo que no cambió.
+        self._records = {}
+
+    def _ensure_fresh(self):
+        # La firma se toma antes de leer: si otro proceso escribe durante la
+        # lectura, la próxima vez no coincide y se vuelve a cargar.
+        signature = self._engine.signature()
+        if self._meds is None or signature != self._signature:
+            self._meds = self._engine.load_meds()
+            self._signature = signature
+            self.generation += 1
+            self._reindex()
+
+    def _written(self, seen):
+        """
+        Después de una escritura propia: si el motor encontró cambios de otro
+        proceso posteriores a la lectura (`seen`), la lista se vuelve a cargar.
+        """
+        before, after = self._engine.last_write
+        if before == seen:
+            self._signature = after
+        else:
+            self._meds = None
+
+    def _reindex(self):
+        self._pos_by_id = {}
+        self._by_name = {}
+        self._by_substance = {}
+        for pos, med in enumerate(self._meds):
+            self._pos_by_id[med["id"]] = pos
+            self._index_secondary(med)
+
+    def _index_secondary(self, med):
+        med_id = med["id"]
+        self._by_name.setdefault(catalog_index.fold(med.get("nombre", "")), set()).add(med_id)
+        self._by_substance.setdefault(catalog_index.fold(med.get("sustancia", "")), set()).add(med_id)
+
+    def _unindex_secondary(self, med):
+        med_id = med["id"]
+        for table, value in ((self._by_name, med.get("nombre", "")), (self._by_substance, med.get("sustancia", ""))):
+            ids = table.get(catalog_index.fold(value))
+            if ids:
+                ids.discard(med_id)
+
+    def all(self):
+        """Copia de la lista; los diccionarios son compartidos y no deben modificarse."""
+        with self._lock:
+            self._ensure_fresh()
+            return list(self._meds)
+
+    def records(self):
+        """
+        La lista como registros `models.Medication`. Solo se convierten los
+        medicamentos nuevos o editados desde la llamada anterior; el resto son
+        los mismos objetos (se puede comparar por identidad).
+        """
+        with self._lock:
+            self._ensure_fresh()
+            previous = self._records
+            records = {}
+            for med in self._meds:
+                cached = previous.get(med["id"])
+                records[med["id"]] = cached if cached and cached[0] is med else (med, models.Medication.from_dict(med))
+            self._records = records
+            return [record for _med, record in records.values()]
+
+    def get(self, med_id: str):
+        with self._lock:
+            self._ensure_fresh()
+            pos = self._pos_by_id.get(med_id)
+            return None if pos is None else self._meds[pos]
+
+    def find(self, nombre: str = None, sustancia: str = None):
+        """Medicamentos cuyo nombre y/o sustancia coinciden (sin acentos ni mayúsculas)."""
+        with self._lock:
+            self._ensure_fresh()
+            ids = None
+            for table, value in ((self._by_name, nombre), (self._by_substance, sustancia)):
+                if value is None:
+                    continue
+                matches = table.get(catalog_index.fold(value), set())
+                ids = set(matches) if ids is None else ids & matches
+            if ids is None:
+                return list(self._meds)
+            return sorted((self._meds[self._pos_by_id[i]] for i in ids), key=lambda m: self._pos_by_id[m["id"]])
+
+    def add(self, entry: dict) -> str:
+        with self._lock:
+            self._ensure_fresh()
+            entry = copy.deepcopy(entry)
+            if not entry.get("id") or entry["id"] in self._pos_by_id:
+                entry["id"] = storage_engine.new_med_id()
+            seen = self._signature
+            med_id = self._engine.add_med(entry)
+            self._pos_by_id[med_id] = len(self._meds)
+            self._meds.append(entry)
+            self._index_secondary(entry)
+            self._written(seen)
+            return med_id
+
+    def add_many(self, entries) -> list:
+        """Añade varios medicamentos con una sola escritura del motor."""
+        with self._lock:
+            self._ensure_fresh()
+            new = []
+            taken = set(self._pos_by_id)
+            for entry in entries:
+                entry = copy.deepcopy(entry)
+                if not entry.get("id") or entry["id"] in taken:
+                    entry["id"] = storage_engine.new_med_id()
+                taken.add(entry["id"])
+                new.append(entry)
+            seen = self._signature
+            ids = self._engine.add_meds(new)
+            for entry in new:
+                self._pos_by_id[entry["id"]] = len(self._meds)
+                self._meds.append(entry)
+                self._index_secondary(entry)
+            self._written(seen)
+            return ids
+
+    def update(self, med_id: str, entry: dict):
+        with self._lock:
+            self._ensure_fresh()
+            pos = self._pos_by_id.get(med_id)
+            if pos is None:
+                raise KeyError(f"Medicamento no encontrado: {med_id}")
+            entry = copy.deepcopy(entry)
+            entry["id"] = med_id
+            seen = self._signature
+            try:
+                self._engine.update_med(med_id, entry)
+            except storage_engine.ConflictError:
+                # Otro proceso lo cambió: la próxima lectura trae su versión.
+                self._meds = None
+                raise
+            self._unindex_secondary(self._meds[pos])
+            self._meds[pos] = entry
+            self._index_secondary(entry)
+            self._written(seen)
+            return True
+
+    def invalidate(self):
+        with self._lock:
+            self._meds = None
+
+
+def get_repository():
+    """
+    Devuelve el repositorio de medicamentos del proceso.
+    """
+    global _repository
+    if _repository is None:
+        _repository = MedsRepository(get_engine())
+    return _repository
+
+
 def initialize_empty_meds():
     """
-    Inicializa medicamentos.json como lista vacía si no existe.
+    Inicializa el almacenamiento de medicamentos si no existe
+    (lista vacía, o importación del medicamentos.json legado).
     """
     ensure_storage()
-    if not os.path.exists(MEDS_FILE):
-        with open(MEDS_FILE, "w", encoding="utf-8") as f:
-            json.dump([], f, ensure_ascii=False, indent=2)
+    get_engine().initialize()
+
+
+def get_history():
+    """
+    Devuelve el historial de tomas del proceso.
+    """
+    global _history
+    if _history is None:
+        ensure_storage()
+        _history = history.DoseHistory(HISTORY_DIR)
+    return _history
+
+
+def record_dose(med_id: str, kind: str = "taken", ts: float = None):
+    """Registra una toma ("taken"), omisión ("skipped") o posposición ("snoozed")."""
+    event = get_history().record(med_id, kind, ts)
+    if kind == "taken":
+        _refresh_timeline(med_id)
+    return event
+
+
+def last_dose(med_id: str):
+    """Hora (epoch) de la última toma registrada de un medicamento, o None."""
+    return get_history().last_dose(med_id)
+
+
+def dose_events(start: float = None, end: float = None, med_id: str = None):
+    """Lista de eventos (hora, tipo, id) entre `start` y `end`, ordenados por hora."""
+    return list(get_history().events(start, end, med_id=med_id))
+
+
+def make_reminder(nombre: str, intervalo, unidad: str = "horas", inicio: float = None):
+    """
+    Arma el diccionario "recordatorio" de un medicamento.
+    `unidad` es "horas" o "dias"; el recordatorio siempre se repite.
+    `inicio` es la hora (epoch) desde la que corre el intervalo; por
+    defecto, ahora (el temporizador se vuelve a armar al guardar).
+    """
+    reminder = models.Reminder(intervalo, unidad, nombre=nombre, inicio=time.time() if inicio is None else inicio)
+    return reminder.to_dict()
+
+
+def reminder_seconds(med: dict) -> float:
+    """Intervalo del recordatorio de un medicamento en segundos (0 si no tiene)."""
+    reminder = med.get("recordatorio") or {}
+    try:
+        intervalo = float(reminder.get("intervalo") or 0)
+    except (TypeError, ValueError):
+        return 0.0
+    factor = 86400 if reminder.get("unidad_en") == "days" else 3600
+    return max(intervalo, 0.0) * factor
 
 
 def initialize_default_catalog():
@@ -58,39 +381,145 @@ def initialize_default_catalog():
         json.dump(sample, f, ensure_ascii=False, indent=2)
 
 
+@instrumentation.timed("backend.load_meds")
 def load_meds():
     """
     Devuelve la lista de medicamentos del usuario.
     """
-    initialize_empty_meds()
-    try:
-        with open(MEDS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if isinstance(data, list):
-                return data
-            return []
-    except Exception:
-        return []
+    return get_repository().all()
+
+
+def load_medications():
+    """Lista de medicamentos como registros `models.Medication` (ver `MedsRepository.records`)."""
+    return get_repository().records()
+
+
+def get_med(med_id: str):
+    """Devuelve el medicamento con id `med_id`, o None si no existe."""
+    return get_repository().get(med_id)
+
+
+def find_meds(nombre: str = None, sustancia: str = None):
+    """Busca en la lista del usuario por nombre y/o sustancia exactos (sin acentos)."""
+    return get_repository().find(nombre=nombre, sustancia=sustancia)
 
 
 def add_med(entry: dict):
-    """Añade un medicamento y devuelve su índice dentro de la lista."""
-    meds = load_meds()
-    meds.append(entry)
-    with open(MEDS_FILE, "w", encoding="utf-8") as f:
-        json.dump(meds, f, ensure_ascii=False, indent=2)
-    return len(meds) - 1
+    """Añade un medicamento y devuelve su id estable."""
+    med_id = get_repository().add(entry)
+    _refresh_timeline(med_id)
+    _refresh_regimen(med_id)
+    _changed()
+    return med_id
+
+
+def add_meds(entries):
+    """Añade varios medicamentos en una sola escritura y devuelve sus ids."""
+    ids = get_repository().add_many(entries)
+    for med_id in ids:
+        _refresh_timeline(med_id)
+        _refresh_regimen(med_id)
+    if ids:
+        _changed()
+    return ids
+
+
+def update_med(med_id: str, entry: dict):
+    """Actualiza un medicamento existente por id."""
+    result = get_repository().update(med_id, entry)
+    _refresh_timeline(med_id)
+    _refresh_regimen(med_id)
+    _changed()
+    return result
 
 
-def update_med(index: int, entry: dict):
-    """Actualiza un medicamento existente por índice."""
-    meds = load_meds()
-    if 0 <= index < len(meds):
-        meds[index] = entry
-        with open(MEDS_FILE, "w", encoding="utf-8") as f:
-            json.dump(meds, f, ensure_ascii=False, indent=2)
-        return True
-    raise IndexError("Índice de medicamento fuera de rango")
+def get_timeline():
+    """
+    Devuelve la agenda de próximas tomas (ver timeline.py). Se calcula
+    entera la primera vez y cuando la lista se vuelve a cargar del disco;
+    las altas, ediciones y tomas solo recalculan el medicamento afectado.
+    """
+    global _timeline
+    # Importación diferida: timeline carga NumPy, que solo hace falta para la agenda.
+    import timeline
+    repository = get_repository()
+    with repository._lock:
+        meds = repository.all()
+        generation = repository.generation
+        if _timeline is None or _timeline[0] is not repository or _timeline[1] != generation:
+            agenda = timeline.Timeline().rebuild(meds, get_history().last_doses())
+            _timeline = (repository, generation, agenda)
+        return _timeline[2]
+
+
+def _refresh_timeline(med_id: str):
+    cached = _timeline
+    if cached is None:
+        return
+    repository, generation, agenda = cached
+    with repository._lock:
+        if repository.generation != generation:
+            # Se recargó desde el disco: get_timeline() la reconstruye.
+            return
+        med = repository.get(med_id)
+        if med is None:
+            agenda.remove(med_id)
+        else:
+            agenda.update(med, last_dose(med_id))
+
+
+def upcoming_doses(hours: float = 24, limit: int = None):
+    """
+    Próximas tomas de las siguientes `hours` horas, ordenadas: lista de
+    (hora epoch, medicamento).
+    """
+    with get_repository()._lock:
+        agenda = get_timeline()
+        doses = agenda.upcoming(hours * 3600.0, limit=limit)
+        return [(ts, get_med(med_id)) for ts, med_id in doses]
+
+
+def get_regimen():
+    """
+    Devuelve las sustancias de la lista indexadas para revisar interacciones
+    (ver interactions.py). Se reconstruye cuando la lista se vuelve a cargar
+    del disco o cambia interacciones.json; altas y ediciones solo actualizan
+    el medicamento afectado.
+    """
+    global _regimen
+    repository = get_repository()
+    table = interactions.load_table(INTERACTIONS_FILE)
+    with repository._lock:
+        meds = repository.all()
+        generation = repository.generation
+        if (_regimen is None or _regimen[0] is not repository or _regimen[1] != generation
+                or _regimen[2].table is not table):
+            _regimen = (repository, generation, interactions.Regimen(table, meds))
+        return _regimen[2]
+
+
+def _refresh_regimen(med_id: str):
+    cached = _regimen
+    if cached is None:
+        return
+    repository, generation, regimen = cached
+    with repository._lock:
+        if repository.generation != generation:
+            return
+        med = repository.get(med_id)
+        if med is None:
+            regimen.remove(med_id)
+        else:
+            regimen.update(med)
+
+
+def check_interactions(entry: dict, med_id: str = None):
+    """
+    Avisos de misma sustancia, duplicidad terapéutica e interacciones de
+    `entry` contra el resto de la lista (`med_id` al editar). No guarda nada:
+    se llama antes de `add_med`/`update_med`.
+    """
+    return get_regimen().check(entry, med_id)
 
 
 def load_catalog():
@@ -102,23 +531,26 @@ def load_catalog():
     try:
         with open(CATALOG_FILE, "r", encoding="utf-8") as f:
             data = json.load(f)
+            instrumentation.add_bytes("read", "catalogo.json", f.buffer.tell())
             return data if isinstance(data, list) else []
     except Exception:
         return []
 
 
+def get_catalog_index():
+    """
+    Devuelve el catálogo indexado (binario, abierto con mmap); solo se
+    vuelve a convertir si catalogo.json cambió en disco.
+    """
+    return catalog_bin.get_catalog(CATALOG_FILE, load_catalog, CATALOG_BIN_FILE)
+
+
+@instrumentation.timed("backend.search_catalog")
 def search_catalog(query: str):
     """
-    Busca en el catálogo por nombre o sustancia (insensible a mayúsculas).
-    """
-    catalog = load_catalog()
-    q = (query or "").strip().casefold()
-    if not q:
-        return catalog
-    results = []
-    for item in catalog:
-        nombre = (str(item.get("nombre", ""))).casefold()
-        sust = (str(item.get("sustancia", ""))).casefold()
-        if q in nombre or q in sust:
-            results.append(item)
-    return results
\ No newline at end of file
+    Busca en el catálogo por nombre o sustancia (insensible a mayúsculas y acentos).
+    Los resultados van ordenados por calidad de coincidencia y, si hay pocos
+    aciertos exactos, incluyen aproximados con errores de tipeo.
+    """
+    index = get_catalog_index()
+    return [index.item(i) for i in fuzzy.search(index, query or "")]
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+Copias de seguridad de Dosely: una copia completa y después solo los cambios.
+
+Cada copia es un archivo comprimido con gzip dentro del directorio de copias:
+- NNNNNN-completa.dosely.gz  todos los medicamentos, el historial de tomas y
+                             los archivos del catálogo;
+- NNNNNN-cambios.dosely.gz   solo los medicamentos nuevos, editados o borrados,
+                             las tomas nuevas y los archivos que cambiaron
+                             desde la copia anterior.
+
+estado.json (en el mismo directorio) guarda lo necesario para calcular la
+siguiente copia sin abrir las anteriores: el número de la última, una huella
+de cada medicamento, cuántas tomas había y hasta qué hora, y la firma de cada
+archivo.
+
+Formato: una línea JSON por registro. Las tomas van como registros binarios
+del historial y los archivos como bytes, después de la línea que anuncia su
+tamaño, así que ni la copia ni la restauración cargan todo en memoria. La
+última línea lleva la cantidad de registros y el SHA-256 de todo lo anterior;
+gzip agrega además su propio CRC.
+
+Restaurar reproduce la última copia completa y los cambios que le siguen en
+un directorio nuevo: las tomas de cada copia se escriben directamente como un
+segmento del historial.
+
+Uso:
+    python dosely_cli.py backup copias/          # completa o cambios, según haga falta
+    python dosely_cli.py restore copias/ --storage restaurado/
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+import zlib
+
+import backend
+import history
+import storage_engine
+from catalog_index import file_signature
+
+FORMAT = 1
+STATE_FILE = "estado.json"
+SUFFIX = ".dosely.gz"
+FULL = "completa"
+DELTA = "cambios"
+# Después de tantas copias de cambios la siguiente es completa.
+FULL_EVERY = 30
+# Tamaño de los bloques al copiar archivos y tomas.
+CHUNK = 1 << 20
+# Archivos del catálogo que se copian (junto a catalogo.json).
+CATALOG_FILES = ("catalogo.json", "interacciones.json")
+
+
+class BackupCorruptedError(ValueError):
+    """La copia está incompleta o no coincide con su suma de verificación."""
+
+
+def _digest(med: dict) -> str:
+    data = json.dumps(med, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def archive_name(seq: int, kind: str) -> str:
+    return f"{seq:06d}-{kind}{SUFFIX}"
+
+
+def list_archives(directory: str):
+    """[(número, tipo, ruta)] de las copias de `directory`, en orden."""
+    found = []
+    for name in os.listdir(directory) if os.path.isdir(directory) else ():
+        if not name.endswith(SUFFIX):
+            continue
+        seq, _, kind = name[:-len(SUFFIX)].partition("-")
+        if seq.isdigit() and kind in (FULL, DELTA):
+            found.append((int(seq), kind, os.path.join(directory, name)))
+    return sorted(found)
+
+
+# ---------------------------------------------------------
+# Escritura
+# ---------------------------------------------------------
+class _Writer:
+    """Archivo de copia en escritura: registros JSON, bloques de bytes y el cierre con la suma."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._tmp = path + ".tmp"
+        self._raw = open(self._tmp, "wb")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=6, mtime=0)
+        self._sha = hashlib.sha256()
+        self.records = 0
+
+    def _write(self, data: bytes):
+        self._gz.write(data)
+        self._sha.update(data)
+
+    def record(self, record: dict):
+        self._write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.records += 1
+
+    def blob(self, record: dict, size: int, chunks):
+        """Registro seguido de exactamente `size` bytes tomados de `chunks`."""
+        self.record(dict(record, bytes=size))
+        written = 0
+        for chunk in chunks:
+            written += len(chunk)
+            if written > size:
+                raise RuntimeError(f"{record.get('tipo')}: cambió mientras se copiaba")
+            self._write(chunk)
+        if written != size:
+            raise RuntimeError(f"{record.get('tipo')}: cambió mientras se copiaba")
+        self._write(b"\n")
+
+    def close(self):
+        trailer = {"tipo": "fin", "registros": self.records, "sha256": self._sha.hexdigest()}
+        self._gz.write(json.dumps(trailer).encode("utf-8") + b"\n")
+        self._gz.close()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._raw.close()
+        # El fsync del directorio lo hace write_atomic al guardar estado.json.
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        self._gz.close()
+        self._raw.close()
+        os.remove(self._tmp)
+
+
+def _read_state(directory: str):
+    try:
+        with open(os.path.join(directory, STATE_FILE), "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if isinstance(state, dict) and state.get("formato") == FORMAT else None
+
+
+def _batched(chunks, size: int = CHUNK):
+    """Junta registros chicos en bloques de ~`size` bytes."""
+    buffer = []
+    pending = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        pending += len(chunk)
+        if pending >= size:
+            yield b"".join(buffer)
+            buffer = []
+            pending = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def backup(directory: str, full: bool = False):
+    """
+    Copia el almacenamiento actual de backend en `directory`: completa si es
+    la primera, si se pide `full`, si cambió el origen o tras FULL_EVERY
+    copias de cambios; si no, solo los cambios. Devuelve la ruta de la copia,
+    o None si no había nada nuevo.
+    """
+    os.makedirs(directory, exist_ok=True)
+    state = _read_state(directory)
+    archives = list_archives(directory)
+    origin = os.path.abspath(backend.STORAGE_DIR)
+    last_seq = archives[-1][0] if archives else 0
+    if (full or state is None or state.get("origen") != origin or state.get("seq") != last_seq
+            or state.get("cambios", 0) >= FULL_EVERY):
+        state = None
+    kind = FULL if state is None else DELTA
+    seq = last_seq + 1
+
+    meds = backend.load_meds()
+    doses = backend.get_history()
+    digests = {med["id"]: _digest(med) for med in meds}
+    old_digests = state["meds"] if state else {}
+    changed = [med for med in meds if old_digests.get(med["id"]) != digests[med["id"]]]
+    removed = [med_id for med_id in old_digests if med_id not in digests]
+
+    # Tomas: en una copia de cambios, las posteriores a la última copiada. Si
+    # además apareció alguna con hora anterior (registrada a mano), se
+    # vuelve a copiar el historial entero.
+    total = doses.count()
+    after = state["historial"]["hasta"] if state else None
+    new_doses = total
+    reset = state is None
+    if state:
+        new_doses = total - state["historial"]["eventos"]
+        if new_doses < 0 or sum(1 for _ in doses.raw_events(after)) != new_doses:
+            reset, after, new_doses = True, None, total
+    last_ts = after
+    if new_doses:
+        last_ts = max(last_ts or float("-inf"), max(ts for ts, _k, _m in doses.events(start=after)))
+
+    files = {}
+    catalog_dir = os.path.dirname(backend.CATALOG_FILE)
+    old_files = state["archivos"] if state else {}
+    for name in CATALOG_FILES:
+        path = os.path.join(catalog_dir, name)
+        signature = file_signature(path)
+        if signature is None:
+            continue
+        old = old_files.get(name)
+        if old and tuple(old["firma"]) == signature:
+            files[name] = old
+            continue
+        sha = _file_sha256(path)
+        files[name] = {"firma": list(signature), "sha256": sha, "nuevo": not old or old["sha256"] != sha}
+
+    if kind == DELTA and not changed and not removed and not new_doses and not reset \
+            and not any(f.get("nuevo") for f in files.values()) and set(files) == set(old_files):
+        return None
+
+    path = os.path.join(directory, archive_name(seq, kind))
+    writer = _Writer(path)
+    try:
+        writer.record({"tipo": "cabecera", "formato": FORMAT, "clase": kind, "seq": seq,
+                       "base": seq if kind == FULL else state["base"], "creado": time.time(), "origen": origin})
+        for med in changed:
+            writer.record({"tipo": "med", "datos": med})
+        for med_id in removed:
+            writer.record({"tipo": "med_borrado", "id": med_id})
+        if reset and kind == DELTA:
+            writer.record({"tipo": "historial_reinicio"})
+        if new_doses:
+            writer.blob({"tipo": "tomas", "eventos": new_doses}, new_doses * history.RECORD.size,
+                        _batched(doses.raw_events(None if reset else after)))
+        for name, info in sorted(files.items()):
+            if kind == FULL or info.get("nuevo"):
+                source = os.path.join(catalog_dir, name)
+                with open(source, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    writer.blob({"tipo": "archivo", "nombre": name, "sha256": info["sha256"]}, size,
+                                iter(lambda: f.read(CHUNK), b""))
+        for name in set(old_files) - set(files):
+            writer.record({"tipo": "archivo_borrado", "nombre": name})
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+    new_state = {
+        "formato": FORMAT,
+        "origen": origin,
+        "seq": seq,
+        "base": seq if kind == FULL else state["base"],
+        "cambios": 0 if kind == FULL else state.get("cambios", 0) + 1,
+        "meds": digests,
+        "historial": {"eventos": total, "hasta": last_ts},
+        "archivos": {name: {"firma": info["firma"], "sha256": info["sha256"]} for name, info in files.items()},
+    }
+    storage_engine.write_atomic(os.path.join(directory, STATE_FILE),
+                                json.dumps(new_state, ensure_ascii=False).encode("utf-8"))
+    return path
+
+
+# ---------------------------------------------------------
+# Lectura
+# ---------------------------------------------------------
+# Errores de gzip con una copia cortada o dañada.
+_READ_ERRORS = (OSError, EOFError, zlib.error)
+
+
+def _chunks(stream, size: int, sha):
+    remaining = size
+    while remaining:
+        try:
+            block = stream.read(min(CHUNK, remaining))
+        except _READ_ERRORS as error:
+            raise BackupCorruptedError(f"No se puede leer la copia: {error}") from error
+        if not block:
+            raise BackupCorruptedError("Copia incompleta")
+        sha.update(block)
+        remaining -= len(block)
+        yield block
+
+
+def read_archive(path: str):
+    """
+    Registros de una copia, en orden. Los que llevan "bytes" traen además
+    "contenido", un generador de bloques que hay que consumir antes de pedir
+    el registro siguiente. Falla con BackupCorruptedError si la copia está
+    cortada o no coincide con su suma (al llegar al final).
+    """
+    sha = hashlib.sha256()
+    count = 0
+    try:
+        with gzip.open(path, "rb") as stream:
+            while True:
+                line = stream.readline()
+                if not line:
+                    raise BackupCorruptedError(f"Copia incompleta: {path}")
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    raise BackupCorruptedError(f"Registro dañado en {path}") from None
+                if record.get("tipo") == "fin":
+                    if record.get("registros") != count or record.get("sha256") != sha.hexdigest():
+                        raise BackupCorruptedError(f"La suma de verificación no coincide: {path}")
+                    return
+                sha.update(line)
+                count += 1
+                size = record.get("bytes")
+                if size is not None:
+                    content = _chunks(stream, size, sha)
+                    yield dict(record, contenido=content)
+                    for _block in content:
+                        pass
+                    newline = stream.read(1)
+                    sha.update(newline)
+                    if newline != b"\n":
+                        raise BackupCorruptedError(f"Registro dañado en {path}")
+                else:
+                    yield record
+    except _READ_ERRORS as error:
+        raise BackupCorruptedError(f"No se puede leer la copia {path}: {error}") from error
+
+
+def verify(path: str) -> dict:
+    """Lee la copia entera, comprueba las sumas y devuelve su cabecera."""
+    header = None
+    for record in read_archive(path):
+        if header is None:
+            header = record
+        if record.get("tipo") == "archivo":
+            sha = hashlib.sha256()
+            for block in record["contenido"]:
+                sha.update(block)
+            if sha.hexdigest() != record.get("sha256"):
+                raise BackupCorruptedError(f"{record['nombre']}: la suma no coincide")
+    return header
+
+
+def restore_chain(directory: str, upto: int = None):
+    """Copias a reproducir para restaurar hasta `upto` (por defecto la última): la completa y sus cambios."""
+    archives = [a for a in list_archives(directory) if upto is None or a[0] <= upto]
+    fulls = [i for i, (_seq, kind, _path) in enumerate(archives) if kind == FULL]
+    if not fulls:
+        raise FileNotFoundError(f"No hay copias completas en {directory}")
+    chain = archives[fulls[-1]:]
+    expected = chain[0][0]
+    for seq, _kind, path in chain:
+        if seq != expected:
+            raise BackupCorruptedError(f"Falta la copia {expected:06d} antes de {os.path.basename(path)}")
+        expected += 1
+    return [path for _seq, _kind, path in chain]
+
+
+def restore(directory: str, storage_dir: str, upto: int = None, engine: str = None) -> dict:
+    """
+    Restaura en `storage_dir` (que no debe existir o estar vacío) la última
+    copia completa de `directory` y los cambios posteriores, hasta `upto`.
+    Se trabaja en un directorio temporal que solo reemplaza al destino si
+    todas las copias se leyeron bien. Devuelve un resumen.
+    """
+    storage_dir = os.path.abspath(storage_dir)
+    if os.path.isdir(storage_dir) and os.listdir(storage_dir):
+        raise FileExistsError(f"El destino no está vacío: {storage_dir}")
+    chain = restore_chain(directory, upto)
+    staging = storage_dir + ".restaurando"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    try:
+        meds = {}
+        doses = history.DoseHistory(os.path.join(staging, "historial"))
+        events = 0
+        for path in chain:
+            base = None
+            for record in read_archive(path):
+                kind = record.get("tipo")
+                if kind == "cabecera":
+                    if record.get("formato") != FORMAT:
+                        raise BackupCorruptedError(f"Formato de copia desconocido: {path}")
+                    base = record.get("base")
+                elif kind == "med":
+                    meds[record["datos"]["id"]] = record["datos"]
+                elif kind == "med_borrado":
+                    meds.pop(record["id"], None)
+                elif kind == "historial_reinicio":
+                    doses.clear()
+                    events = 0
+                elif kind == "tomas":
+                    events += doses.import_segment(record["contenido"])
+                elif kind == "archivo":
+                    target = os.path.join(staging, os.path.basename(record["nombre"]))
+                    sha = hashlib.sha256()
+                    with open(target, "wb") as f:
+                        for block in record["contenido"]:
+                            sha.update(block)
+                            f.write(block)
+                    if sha.hexdigest() != record.get("sha256"):
+                        raise BackupCorruptedError(f"{record['nombre']}: la suma no coincide")
+                elif kind == "archivo_borrado":
+                    target = os.path.join(staging, os.path.basename(record["nombre"]))
+                    if os.path.exists(target):
+                        os.remove(target)
+            if base != int(os.path.basename(chain[0])[:6]):
+                raise BackupCorruptedError(f"{os.path.basename(path)} no pertenece a esta cadena de copias")
+        store = backend.open_engine(staging, engine)
+        try:
+            store.initialize()
+            if meds:
+                store.add_meds(list(meds.values()))
+        finally:
+            if hasattr(store, "close"):
+                store.close()
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    if os.path.isdir(storage_dir):
+        os.rmdir(storage_dir)
+    os.replace(staging, storage_dir)
+    return {"copias": len(chain), "medicamentos": len(meds), "tomas": events, "destino": storage_dir}
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks de Dosely sin interfaz (no importa Kivy).
+
+Genera catálogos y listas de medicamentos sintéticos y mide las rutas
+calientes del backend y de notify:
+- catálogo: `load_catalog`, `get_catalog_index` (conversión en frío y
+  apertura en caliente) y `search_catalog` con varias clases de consulta;
+- medicamentos, con cada motor: `load_meds` en frío y en caliente,
+  `add_med` y `update_med`;
+- recordatorios: programar, reprogramar y cancelar miles de recordatorios, y
+  simular meses de disparos con reloj virtual.
+
+Todo corre en un directorio temporal. Los resultados se guardan en JSON para
+comparar corridas entre versiones.
+
+Uso:
+    python bench.py                          # tamaños 1k y 100k
+    python bench.py --sizes 1k,100k,1m -o resultados.json
+    python bench.py --compare base.json      # compara contra una corrida anterior
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import backend
+import notify
+import notify_sim
+import storage_engine
+
+SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+DEFAULT_SIZES = "1k,100k"
+ENGINES = ("sqlite", "json")
+REMINDER_COUNTS = (1_000, 10_000)
+
+QUERIES = {
+    "corta": "pa",
+    "prefijo": "amox",
+    "sustancia": "losartan",
+    "errata": "ibuprfeno",
+    "sin_resultados": "zzqxw",
+}
+
+_PREFIXES = ("Para", "Ibu", "Amoxi", "Ome", "Metfor", "Losar", "Atorva", "Ceti", "Salbu", "Ace",
+             "Diclo", "Napro", "Lorata", "Enala", "Simva", "Cipro", "Azitro", "Predni", "Levo", "Clona")
+_SUFFIXES = ("cetamol", "profeno", "cilina", "prazol", "mina", "tán", "statina", "rizina", "tamol",
+             "fenaco", "xeno", "dina", "pril", "floxacino", "micina", "sona", "tiroxina", "zepam")
+_SALTS = ("", " sódico", " potásico", " cálcica", " clorhidrato", " diclorhidrato", " maleato")
+_FORMS = ("", " Forte", " Retard", " Plus", " Duo", " Flash", " Infantil")
+_MG = (5, 10, 20, 25, 40, 50, 100, 200, 250, 400, 500, 850, 1000)
+
+
+def parse_sizes(text: str):
+    """'1k,100k' -> [1000, 100000]; acepta también 'all' y números."""
+    if text == "all":
+        return sorted(set(SIZES.values()))
+    sizes = []
+    for part in text.split(","):
+        part = part.strip().lower()
+        if part:
+            sizes.append(SIZES[part] if part in SIZES else int(part))
+    return sizes
+
+
+def label(n: int) -> str:
+    for name, value in SIZES.items():
+        if value == n:
+            return name
+    return str(n)
+
+
+def generate_catalog(n: int, seed: int = 1):
+    """Catálogo sintético de `n` productos con nombres y sustancias plausibles."""
+    rng = random.Random(seed)
+    items = []
+    for i in range(n):
+        sustancia = rng.choice(_PREFIXES) + rng.choice(_SUFFIXES)
+        nombre = f"{sustancia}{rng.choice(_FORMS)} {i % 997}"
+        items.append({
+            "nombre": nombre,
+            "sustancia": sustancia + rng.choice(_SALTS),
+            "mg": rng.choice(_MG),
+            "requiere_receta": rng.random() < 0.4,
+        })
+    return items
+
+
+def generate_meds(n: int, seed: int = 2):
+    """Lista sintética de `n` medicamentos del usuario (con id y recordatorio)."""
+    rng = random.Random(seed)
+    meds = []
+    for item in generate_catalog(n, seed):
+        interval = rng.choice((4, 6, 8, 12, 24))
+        meds.append({
+            "id": storage_engine.new_med_id(),
+            "nombre": item["nombre"],
+            "sustancia": item["sustancia"],
+            "mg": item["mg"],
+            "requiere_receta": item["requiere_receta"],
+            "notas": "",
+            "recordatorio": {
+                "intervalo": interval,
+                "unidad": "horas",
+                "unidad_en": "hours",
+                "intervalo_horas": interval,
+                "mensaje": f"Recordatorio de {item['nombre']}",
+                "repetir": True,
+            },
+        })
+    return meds
+
+
+def timed(fn, repeat: int = 1):
+    """Ejecuta `fn` `repeat` veces; devuelve (tiempos en ms, último resultado)."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return times, result
+
+
+class Recorder:
+    """Acumula resultados y los muestra a medida que se miden."""
+
+    def __init__(self, verbose: bool = True):
+        self.results = []
+        self.verbose = verbose
+
+    def add(self, name: str, size: int, times, ops: int = 1, **params):
+        row = {
+            "name": name,
+            "size": size,
+            "params": params,
+            "runs": len(times),
+            "ops": ops,
+            "min_ms": round(min(times), 4),
+            "median_ms": round(statistics.median(times), 4),
+            "mean_ms": round(statistics.fmean(times), 4),
+            "max_ms": round(max(times), 4),
+        }
+        self.results.append(row)
+        if self.verbose:
+            extra = " ".join(f"{k}={v}" for k, v in params.items())
+            per_op = f"  ({row['median_ms'] / ops:.4f} ms/op)" if ops > 1 else ""
+            sys.stderr.write(f"{name:<24} {label(size):>5} {extra:<28} "
+                             f"mediana {row['median_ms']:>10.3f} ms{per_op}\n")
+        return row
+
+
+def bench_catalog(rec: Recorder, n: int, workdir: str, repeat: int):
+    backend.set_storage_dir(os.path.join(workdir, f"catalogo-{label(n)}"))
+    backend.ensure_storage()
+    with open(backend.CATALOG_FILE, "w", encoding="utf-8") as f:
+        json.dump(generate_catalog(n), f, ensure_ascii=False)
+
+    times, _ = timed(backend.load_catalog, repeat=max(1, min(repeat, 3)))
+    rec.add("load_catalog", n, times)
+
+    times, _ = timed(backend.get_catalog_index)
+    rec.add("get_catalog_index", n, times, estado="frio")
+    times, _ = timed(backend.get_catalog_index, repeat=repeat)
+    rec.add("get_catalog_index", n, times, estado="caliente")
+
+    for kind, query in QUERIES.items():
+        times, results = timed(lambda: backend.search_catalog(query), repeat=repeat)
+        rec.add("search_catalog", n, times, consulta=kind, resultados=len(results))
+
+
+def _seed_meds(n: int, directory: str):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "medicamentos.json"), "w", encoding="utf-8") as f:
+        json.dump(generate_meds(n), f, ensure_ascii=False)
+
+
+def bench_meds(rec: Recorder, n: int, workdir: str, repeat: int, ops: int):
+    for engine in ENGINES:
+        directory = os.path.join(workdir, f"meds-{engine}-{label(n)}")
+        _seed_meds(n, directory)
+        backend.STORAGE_ENGINE = engine
+        backend.set_storage_dir(directory)
+        # La primera apertura migra el JSON sembrado (SQLite) o le asigna ids.
+        backend.initialize_empty_meds()
+
+        cold = []
+        for _ in range(max(1, min(repeat, 3))):
+            backend.set_storage_dir(directory)
+            times, meds = timed(backend.load_meds)
+            cold.extend(times)
+        rec.add("load_meds", n, cold, motor=engine, estado="frio")
+        times, meds = timed(backend.load_meds, repeat=repeat)
+        rec.add("load_meds", n, times, motor=engine, estado="caliente")
+
+        new = generate_meds(ops, seed=3)
+        times, _ = timed(lambda: [backend.add_med(m) for m in new])
+        rec.add("add_med", n, times, ops=ops, motor=engine)
+
+        targets = [m["id"] for m in meds[:ops]]
+        template = dict(new[0], notas="editado")
+        times, _ = timed(lambda: [backend.update_med(med_id, template) for med_id in targets])
+        rec.add("update_med", n, times, ops=len(targets), motor=engine)
+    backend.set_storage_dir(workdir)
+
+
+def bench_notify(rec: Recorder, counts=REMINDER_COUNTS):
+    hour = 3600
+    for count in counts:
+        # Recordatorios lejanos: se mide la cola, no el envío.
+        times, handles = timed(lambda: [
+            notify.schedule_notification(24 + i / count, "hours", "Dosely", f"Recordatorio {i}", repeat=True)
+            for i in range(count)
+        ])
+        rec.add("schedule_notification", count, times, ops=count)
+        times, _ = timed(lambda: [h.reschedule(48 * hour + i) for i, h in enumerate(handles)])
+        rec.add("reminder_reschedule", count, times, ops=count)
+        times, _ = timed(lambda: [h.cancel() for h in handles])
+        rec.add("reminder_cancel", count, times, ops=count)
+    # Meses de recordatorios con reloj virtual (ver notify_sim.py).
+    times, report = timed(lambda: notify_sim.simulate(meds=300, days=90))
+    rec.add("notify_simulate", 300, times, ops=report["fires"], dias=90)
+
+
+def _git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return out.stdout.strip() or None
+
+
+def _key(row):
+    return (row["name"], row["size"], json.dumps({k: v for k, v in row["params"].items() if k != "resultados"},
+                                                 sort_keys=True))
+
+
+def compare(base: dict, current: dict):
+    """Imprime la mediana de cada prueba contra la corrida base (>1 es más lento)."""
+    previous = {_key(row): row for row in base.get("results", [])}
+    for row in current["results"]:
+        old = previous.get(_key(row))
+        if not old or not old["median_ms"]:
+            continue
+        ratio = row["median_ms"] / old["median_ms"]
+        params = " ".join(f"{k}={v}" for k, v in row["params"].items() if k != "resultados")
+        print(f"{row['name']:<24} {label(row['size']):>5} {params:<28} "
+              f"{old['median_ms']:>10.3f} -> {row['median_ms']:>10.3f} ms  x{ratio:.2f}")
+
+
+def run(sizes, repeat: int = 5, ops: int = 200, reminders=REMINDER_COUNTS, workdir: str = None,
+        verbose: bool = True):
+    """Corre todas las pruebas y devuelve el documento de resultados."""
+    rec = Recorder(verbose=verbose)
+    own_dir = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="dosely-bench-")
+    previous_engine = backend.STORAGE_ENGINE
+    previous_dir = backend.STORAGE_DIR
+    started = time.time()
+    try:
+        for n in sizes:
+            bench_catalog(rec, n, workdir, repeat)
+            bench_meds(rec, n, workdir, repeat, ops)
+        bench_notify(rec, reminders)
+    finally:
+        backend.STORAGE_ENGINE = previous_engine
+        backend.set_storage_dir(previous_dir)
+        if own_dir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        "meta": {
+            "timestamp": started,
+            "duration_s": round(time.time() - started, 3),
+            "git": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": sizes,
+            "repeat": repeat,
+        },
+        "results": rec.results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks del backend y de notify (sin interfaz).")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="tamaños separados por coma: 1k, 10k, 100k, 1m, un número o 'all'")
+    parser.add_argument("--repeat", type=int, default=5, help="repeticiones de cada lectura o búsqueda")
+    parser.add_argument("--ops", type=int, default=200, help="altas/ediciones por prueba de escritura")
+    parser.add_argument("--reminders", default=",".join(str(c) for c in REMINDER_COUNTS),
+                        help="cantidades de recordatorios a programar")
+    parser.add_argument("-o", "--output", help="archivo JSON de resultados (por defecto, salida estándar)")
+    parser.add_argument("--compare", metavar="BASE.json", help="corrida anterior contra la que comparar")
+    parser.add_argument("--workdir", help="directorio de trabajo (por defecto, uno temporal que se borra)")
+    args = parser.parse_args(argv)
+
+    reminders = [int(c) for c in args.reminders.split(",") if c.strip()]
+    document = run(parse_sizes(args.sizes), repeat=max(args.repeat, 1), ops=max(args.ops, 1),
+                   reminders=reminders, workdir=args.workdir)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(document, f, ensure_ascii=False, indent=2)
+    elif not args.compare:
+        json.dump(document, sys.stdout, ensure_ascii=False, indent=2)
+        sys.stdout.write("\n")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), document)
+
+
+if __name__ == "__main__":
+    main()
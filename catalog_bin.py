@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Formato binario del catálogo (catalogo.bin) para un arranque inmediato.
+
+catalogo.json sigue siendo el formato de intercambio; cuando cambia, se
+convierte automáticamente a este archivo, que se abre con `mmap`. Abrirlo
+solo lee la cabecera (O(1)); los productos se decodifican uno a uno cuando
+se muestran.
+
+Estructura (little-endian):
+- cabecera: HEADER
+- registros: `count` entradas RECORD (offset/longitud del producto en JSON
+  compacto dentro de la tabla de cadenas)
+- offsets de claves: `count + 1` uint32 dentro del bloque de claves
+- bloque de claves: claves de búsqueda normalizadas en UTF-8, cada una
+  terminada en \0 y en el orden de los registros; las consultas cortas lo
+  recorren con `mmap.find` sin decodificar productos
+- trigramas: `gram_count` entradas GRAM ordenadas por bytes, con el rango de
+  su lista de ids en la tabla de postings
+- postings: ids uint32
+- tabla de cadenas: UTF-8
+"""
+import bisect
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import weakref
+from array import array
+
+import catalog_index
+import instrumentation
+from catalog_index import CatalogIndex, file_signature, fold, item_key, ngrams
+
+MAGIC = b"DOSECAT2"
+HEADER = struct.Struct("<8sqqIIQQQQQQ")
+RECORD = struct.Struct("<II")
+GRAM = struct.Struct("<12sII")
+# Offsets de claves y postings: uint32 en el orden nativo (se leen con memoryview.cast).
+OFFSET = struct.Struct("=I")
+
+
+def bin_path_for(json_path: str) -> str:
+    """Ruta del binario que acompaña a un catálogo JSON."""
+    return os.path.splitext(json_path)[0] + ".bin"
+
+
+def write_index(index: CatalogIndex, path: str):
+    """
+    Escribe un CatalogIndex ya construido en formato binario.
+    `index.version` (firma del JSON de origen) queda en la cabecera.
+    """
+    writer = IndexWriter(path)
+    try:
+        for item in index.items:
+            writer.add(item)
+    except BaseException:
+        writer.close()
+        raise
+    writer.finish(index.version)
+
+
+class IndexWriter:
+    """
+    Escribe catalogo.bin a medida que llegan los productos.
+
+    Productos, claves y sus offsets van a bloques temporales en disco junto a
+    `path`; en memoria quedan solo las listas de ids por trigrama. `finish`
+    une los bloques en un temporal propio y lo reemplaza de forma atómica.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._dir = os.path.dirname(os.path.abspath(path))
+        self._count = 0
+        self._keys_len = 0
+        self._strings_len = 0
+        self._postings = {}
+        self._blocks = []
+        self._records = self._block()
+        self._key_offsets = self._block()
+        self._keys = self._block()
+        self._strings = self._block()
+
+    def _block(self):
+        block = tempfile.TemporaryFile(dir=self._dir)
+        self._blocks.append(block)
+        return block
+
+    def add(self, item: dict) -> int:
+        """Añade un producto y devuelve su id."""
+        item_id = self._count
+        item_raw = json.dumps(item, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        self._records.write(RECORD.pack(self._strings_len, len(item_raw)))
+        self._strings.write(item_raw)
+        self._strings_len += len(item_raw)
+        key = item_key(item)
+        key_raw = key.encode("utf-8") + b"\0"
+        self._key_offsets.write(OFFSET.pack(self._keys_len))
+        self._keys.write(key_raw)
+        self._keys_len += len(key_raw)
+        for gram in ngrams(key):
+            gram_raw = gram.encode("utf-8")
+            if len(gram_raw) > GRAM.size - 8:
+                continue
+            ids = self._postings.get(gram_raw)
+            if ids is None:
+                ids = self._postings[gram_raw] = array("I")
+            ids.append(item_id)
+        self._count += 1
+        return item_id
+
+    def __len__(self):
+        return self._count
+
+    def finish(self, version=None):
+        """Escribe el archivo final con `version` (firma del JSON) en la cabecera."""
+        try:
+            self._finish(version)
+        finally:
+            self.close()
+
+    def _finish(self, version):
+        if array("I").itemsize != OFFSET.size:
+            raise RuntimeError("array('I') debe ser de 32 bits")
+        mtime_ns, size = version or (0, 0)
+        self._key_offsets.write(OFFSET.pack(self._keys_len))
+        grams = sorted(self._postings)
+        posting_count = sum(len(ids) for ids in self._postings.values())
+
+        records_off = HEADER.size
+        key_offsets_off = records_off + self._count * RECORD.size
+        keys_off = key_offsets_off + (self._count + 1) * OFFSET.size
+        grams_off = keys_off + self._keys_len
+        postings_off = grams_off + len(grams) * GRAM.size
+        strings_off = postings_off + posting_count * OFFSET.size
+        header = HEADER.pack(MAGIC, mtime_ns, size, self._count, len(grams), records_off,
+                             key_offsets_off, keys_off, grams_off, postings_off, strings_off)
+        # Temporal propio: la app y la línea de comandos pueden convertir a la vez.
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".", suffix=".tmp", dir=self._dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                for block in (self._records, self._key_offsets, self._keys):
+                    block.seek(0)
+                    shutil.copyfileobj(block, f)
+                start = 0
+                for gram_raw in grams:
+                    f.write(GRAM.pack(gram_raw, start, len(self._postings[gram_raw])))
+                    start += len(self._postings[gram_raw])
+                for gram_raw in grams:
+                    self._postings[gram_raw].tofile(f)
+                self._strings.seek(0)
+                shutil.copyfileobj(self._strings, f)
+                f.flush()
+                os.fsync(f.fileno())
+                instrumentation.add_bytes("written", "catalogo.bin", f.tell())
+            os.replace(tmp, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def close(self):
+        """Descarta los bloques temporales (sin escribir el archivo final)."""
+        for block in self._blocks:
+            block.close()
+        self._blocks = []
+        self._postings = {}
+
+
+def read_signature(path: str):
+    """Firma del JSON de origen guardada en la cabecera, o None si no es válido."""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read(HEADER.size)
+    except OSError:
+        return None
+    if len(raw) < HEADER.size:
+        return None
+    magic, mtime_ns, size = HEADER.unpack(raw)[:3]
+    if magic != MAGIC:
+        return None
+    return (mtime_ns, size)
+
+
+class BinaryCatalog:
+    """
+    Catálogo binario abierto con mmap. Misma interfaz de consulta que
+    CatalogIndex (`search`, `narrow`, `prefix`, `item`, `key`, `postings`).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, mtime_ns, size, self._count, self._gram_count, self._records_off, key_offsets_off,
+         self._keys_off, self._grams_off, self._postings_off, self._strings_off) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} no es un catálogo binario de Dosely")
+        self.version = (mtime_ns, size)
+        self._view = memoryview(self._mm)
+        self._key_offsets = self._view[key_offsets_off:self._keys_off].cast("I")
+        self._postings = self._view[self._postings_off:self._strings_off].cast("I")
+        # Libera el mmap al cerrar o cuando se suelta la última referencia.
+        self._finalizer = weakref.finalize(self, _unmap, self._mm, self._view, self._key_offsets, self._postings)
+
+    def __len__(self):
+        return self._count
+
+    def item(self, item_id: int) -> dict:
+        """Decodifica un producto (solo cuando se necesita)."""
+        if not 0 <= item_id < self._count:
+            raise IndexError(item_id)
+        item_off, item_len = RECORD.unpack_from(self._mm, self._records_off + item_id * RECORD.size)
+        start = self._strings_off + item_off
+        if instrumentation.ENABLED:
+            instrumentation.add_bytes("read", "catalogo.bin", item_len)
+        return json.loads(self._mm[start:start + item_len].decode("utf-8"))
+
+    def key_bytes(self, item_id: int) -> bytes:
+        start = self._keys_off + self._key_offsets[item_id]
+        return self._mm[start:self._keys_off + self._key_offsets[item_id + 1] - 1]
+
+    def _scan_keys(self, needle: bytes):
+        """Ids cuya clave contiene `needle`, buscando con mmap.find sobre el bloque de claves."""
+        found = []
+        pos = self._keys_off
+        end = self._grams_off
+        while True:
+            hit = self._mm.find(needle, pos, end)
+            if hit < 0:
+                return found
+            item_id = bisect.bisect_right(self._key_offsets, hit - self._keys_off) - 1
+            found.append(item_id)
+            # Saltar al inicio de la clave siguiente: un id por producto.
+            pos = self._keys_off + self._key_offsets[item_id + 1]
+
+    def key(self, item_id: int) -> str:
+        return self.key_bytes(item_id).decode("utf-8")
+
+    @property
+    def items(self):
+        return catalog_index.ResultSet(self, range(self._count))
+
+    def _gram_at(self, pos: int):
+        return GRAM.unpack_from(self._mm, self._grams_off + pos * GRAM.size)
+
+    def postings(self, gram: str):
+        """Ids de los productos que contienen el trigrama (vista sin copia)."""
+        target = gram.encode("utf-8").ljust(GRAM.size - 8, b"\0")
+        lo, hi = 0, self._gram_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._gram_at(mid)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._gram_count:
+            gram_raw, start, length = self._gram_at(lo)
+            if gram_raw == target:
+                return self._postings[start:start + length]
+        return ()
+
+    def search(self, query: str):
+        q = fold(query)
+        if not q:
+            return range(self._count)
+        qb = q.encode("utf-8")
+        if len(q) < catalog_index.NGRAM:
+            return self._scan_keys(qb)
+        shortest = None
+        for gram in ngrams(q):
+            posting = self.postings(gram)
+            if not len(posting):
+                return []
+            if shortest is None or len(posting) < len(shortest):
+                shortest = posting
+        return [i for i in shortest if qb in self.key_bytes(i)]
+
+    def narrow(self, item_ids, query: str):
+        q = fold(query)
+        if not q:
+            return list(item_ids)
+        qb = q.encode("utf-8")
+        return [i for i in item_ids if qb in self.key_bytes(i)]
+
+    def prefix(self, query: str):
+        q = fold(query)
+        if not q:
+            return range(self._count)
+        return [i for i in self.search(q) if any(word.startswith(q) for word in self.key(i).split())]
+
+    def close(self):
+        self._finalizer()
+
+
+def _unmap(mm, view, *casts):
+    for cast in casts:
+        cast.release()
+    view.release()
+    mm.close()
+
+
+_lock = threading.Lock()
+_open = {}
+
+
+def convert(json_path: str, bin_path: str, loader):
+    """Convierte el catálogo JSON a binario y devuelve el índice construido."""
+    items = loader()
+    index = CatalogIndex(items, version=file_signature(json_path))
+    write_index(index, bin_path)
+    return index
+
+
+def get_catalog(json_path: str, loader, bin_path: str = None):
+    """
+    Devuelve el catálogo binario de `json_path`, convirtiéndolo solo si el
+    JSON cambió (mtime o tamaño) respecto de lo guardado en la cabecera.
+    Si no se puede escribir el binario, usa el índice en memoria.
+    """
+    bin_path = bin_path or bin_path_for(json_path)
+    with _lock:
+        signature = file_signature(json_path)
+        current = _open.get(bin_path)
+        if current is not None and signature is not None and current.version == signature:
+            return current
+        # El catálogo viejo queda para quien lo esté leyendo (una búsqueda en
+        # curso, resultados en pantalla) y se cierra cuando lo suelta el
+        # último; si nadie lo usa, aquí mismo.
+        _open.pop(bin_path, None)
+        current = None
+        if signature is None or read_signature(bin_path) != signature:
+            try:
+                convert(json_path, bin_path, loader)
+            except OSError:
+                return catalog_index.get_index(json_path, loader)
+        catalog = BinaryCatalog(bin_path)
+        _open[bin_path] = catalog
+        return catalog
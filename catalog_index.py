@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Índice en memoria del catálogo de Dosely.
+
+Construye una sola vez las claves normalizadas (sin acentos y sin distinguir
+mayúsculas) de cada producto y un índice de trigramas para responder búsquedas
+por subcadena sin recorrer todo el catálogo. El índice se reconstruye solo
+cuando cambian la fecha de modificación o el tamaño del archivo del catálogo.
+"""
+import bisect
+import os
+import threading
+import unicodedata
+from collections.abc import Sequence
+
+NGRAM = 3
+
+
+def fold(text) -> str:
+    """Normaliza un texto: sin acentos, sin mayúsculas y con espacios simples."""
+    text = unicodedata.normalize("NFKD", str(text or ""))
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(text.casefold().split())
+
+
+def item_key(item: dict) -> str:
+    """Clave de búsqueda de un producto: nombre y sustancia normalizados."""
+    return f"{fold(item.get('nombre', ''))}\n{fold(item.get('sustancia', ''))}"
+
+
+def ngrams(text: str, n: int = NGRAM):
+    """Devuelve el conjunto de n-gramas de un texto ya normalizado."""
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def file_signature(path: str):
+    """Firma (mtime, tamaño) de un archivo, o None si no existe."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class ResultSet(Sequence):
+    """
+    Resultados de una búsqueda como secuencia perezosa: guarda solo los ids y
+    obtiene cada producto del índice cuando se accede a él.
+    """
+
+    def __init__(self, index, ids):
+        self.index = index
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return ResultSet(self.index, self.ids[pos])
+        return self.index.item(self.ids[pos])
+
+
+class CatalogIndex:
+    """
+    Índice de un catálogo ya cargado.
+
+    - `items`: productos en el orden original del archivo.
+    - `keys`: clave normalizada de cada producto (mismo orden).
+    - `version`: firma del archivo del que se construyó.
+    """
+
+    def __init__(self, items=(), version=None):
+        self.items = []
+        self.keys = []
+        self.version = version
+        self._postings = {}
+        self._words = []
+        self._words_sorted = True
+        for item in items:
+            self.add(item)
+
+    def add(self, item: dict) -> int:
+        """Añade un producto al índice y devuelve su id."""
+        item_id = len(self.items)
+        key = item_key(item)
+        self.items.append(item)
+        self.keys.append(key)
+        for gram in ngrams(key):
+            self._postings.setdefault(gram, []).append(item_id)
+        # Palabras para búsquedas por prefijo: (palabra, id), se ordenan al consultar.
+        for word in set(key.split()):
+            self._words.append((word, item_id))
+        self._words_sorted = False
+        return item_id
+
+    def __len__(self):
+        return len(self.items)
+
+    def item(self, item_id: int) -> dict:
+        return self.items[item_id]
+
+    def key(self, item_id: int) -> str:
+        return self.keys[item_id]
+
+    def postings(self, gram: str):
+        """Ids (ordenados) de los productos que contienen el trigrama."""
+        return self._postings.get(gram, ())
+
+    def search(self, query: str):
+        """
+        Ids de los productos cuyo nombre o sustancia contiene `query`.
+        Las consultas de menos de tres caracteres recorren solo las claves ya
+        normalizadas; las demás parten de la lista de trigramas más corta.
+        """
+        q = fold(query)
+        if not q:
+            return list(range(len(self.items)))
+        if len(q) < NGRAM:
+            return [i for i, key in enumerate(self.keys) if q in key]
+        # Basta con la lista de trigramas más corta: cada candidato se
+        # verifica contra la subcadena completa.
+        shortest = None
+        for gram in ngrams(q):
+            posting = self.postings(gram)
+            if not posting:
+                return []
+            if shortest is None or len(posting) < len(shortest):
+                shortest = posting
+        return [i for i in shortest if q in self.key(i)]
+
+    def narrow(self, item_ids, query: str):
+        """Filtra un conjunto previo de ids con una consulta más larga."""
+        q = fold(query)
+        if not q:
+            return list(item_ids)
+        return [i for i in item_ids if q in self.key(i)]
+
+    def prefix(self, query: str):
+        """Ids de los productos con alguna palabra que empieza por `query`."""
+        q = fold(query)
+        if not q:
+            return list(range(len(self.items)))
+        if not self._words_sorted:
+            self._words.sort()
+            self._words_sorted = True
+        start = bisect.bisect_left(self._words, (q, -1))
+        found = set()
+        for pos in range(start, len(self._words)):
+            word, item_id = self._words[pos]
+            if not word.startswith(q):
+                break
+            found.add(item_id)
+        return sorted(found)
+
+
+_lock = threading.Lock()
+_cache = {}
+
+
+def get_index(path: str, loader):
+    """
+    Devuelve el índice del catálogo en `path`, reconstruyéndolo con
+    `loader()` solo si el archivo cambió (mtime o tamaño) desde la última vez.
+    """
+    with _lock:
+        signature = file_signature(path)
+        index = _cache.get(path)
+        if index is not None and signature is not None and index.version == signature:
+            return index
+        items = loader()
+        # El loader puede haber creado el archivo (catálogo por defecto).
+        signature = file_signature(path)
+        index = CatalogIndex(items, version=signature)
+        _cache[path] = index
+        return index
+
+
+def invalidate(path: str = None):
+    """Olvida el índice de `path` (o todos) para forzar su reconstrucción."""
+    with _lock:
+        if path is None:
+            _cache.clear()
+        else:
+            _cache.pop(path, None)
@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+"""
+Dosely sin interfaz: línea de comandos y servicio de recordatorios.
+
+Usa el backend sin importar Kivy ni plyer, pensado para correr en una
+computadora sin pantalla que atiende a muchos pacientes (un almacén por
+paciente, cada uno con su storage/).
+
+Uso:
+    python dosely_cli.py list   --storage pacientes/ana
+    python dosely_cli.py agenda --storage pacientes/ana --horas 168
+    python dosely_cli.py search "ibuprofeno" --storage pacientes/ana
+    python dosely_cli.py add    --storage pacientes/ana --nombre Ibuprofeno --mg 400 --cada 8
+    python dosely_cli.py edit   ID --storage pacientes/ana --cada 12
+    python dosely_cli.py reconcile receta.txt --storage pacientes/ana --add
+    python dosely_cli.py backup copias/ana --storage pacientes/ana
+    python dosely_cli.py restore copias/ana --storage pacientes/ana-restaurada
+    python dosely_cli.py run    --storage pacientes/ana --storage pacientes/luis --sink file:avisos.jsonl
+    python dosely_cli.py profiles create --nombre "Ana Pérez"
+    python dosely_cli.py add    --profile ID --nombre Ibuprofeno --cada 8
+    python dosely_cli.py run    --all-profiles
+
+`run` es un servicio asyncio de un solo hilo: una cola de prioridad con los
+próximos disparos de todos los almacenes. Por almacén solo se guardan los
+recordatorios (no la lista completa) y la base se cierra después de leerla,
+así que cientos de almacenes caben en un proceso. Los cambios en disco se
+detectan por firma de archivos y recargan solo ese almacén.
+
+Destinos de los avisos (`--sink`), una línea JSON por recordatorio:
+- stdout (por defecto)
+- file:RUTA       se agrega al archivo
+- unix:RUTA       socket Unix local; si no hay nadie escuchando se reintenta
+"""
+import argparse
+import asyncio
+import heapq
+import itertools
+import json
+import math
+import os
+import signal
+import sys
+import time
+
+import backend
+import backup
+import history
+import interactions
+import models
+import profiles
+import reconcile
+from catalog_index import file_signature
+
+# Cada cuánto se revisa si cambió algún almacén (segundos).
+POLL_INTERVAL = 30.0
+
+
+# ---------------------------------------------------------
+# Destinos de avisos
+# ---------------------------------------------------------
+class StdoutSink:
+    """Escribe cada aviso como una línea JSON en la salida estándar."""
+
+    async def emit(self, event: dict):
+        sys.stdout.write(json.dumps(event, ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+
+    async def close(self):
+        pass
+
+
+class FileSink:
+    """Agrega cada aviso como una línea JSON a un archivo."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    async def emit(self, event: dict):
+        line = json.dumps(event, ensure_ascii=False) + "\n"
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    async def close(self):
+        pass
+
+
+class UnixSocketSink:
+    """Envía cada aviso a un socket Unix local; reconecta en el siguiente aviso si se cae."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writer = None
+        self.failed = 0
+
+    async def emit(self, event: dict):
+        line = (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+        for _attempt in range(2):
+            try:
+                if self._writer is None:
+                    _reader, self._writer = await asyncio.open_unix_connection(self.path)
+                self._writer.write(line)
+                await self._writer.drain()
+                return
+            except OSError:
+                await self.close()
+        self.failed += 1
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+            self._writer = None
+
+
+def make_sink(spec: str):
+    """Crea un destino a partir de "stdout", "file:RUTA" o "unix:RUTA"."""
+    kind, _, target = (spec or "stdout").partition(":")
+    if kind == "stdout":
+        return StdoutSink()
+    if kind == "file" and target:
+        return FileSink(target)
+    if kind == "unix" and target:
+        return UnixSocketSink(target)
+    raise ValueError(f"Destino inválido: {spec}")
+
+
+# ---------------------------------------------------------
+# Servicio de recordatorios
+# ---------------------------------------------------------
+def store_signature(storage_dir: str):
+    """Firma de los archivos de la lista de un almacén (sin abrir la base)."""
+    return tuple(file_signature(os.path.join(storage_dir, name))
+                 for name in ("dosely.db", "dosely.db-wal", "medicamentos.json", "medicamentos.json.journal"))
+
+
+def detect_engine(storage_dir: str) -> str:
+    """Motor de un almacén existente: SQLite si tiene dosely.db, si no JSON."""
+    if os.path.exists(os.path.join(storage_dir, "dosely.db")):
+        return "sqlite"
+    if os.path.exists(os.path.join(storage_dir, "medicamentos.json")):
+        return "json"
+    return backend.STORAGE_ENGINE
+
+
+def load_reminders(storage_dir: str, engine: str = None):
+    """
+    Lee los recordatorios de un almacén como lista de
+    (id, intervalo en segundos, mensaje, ancla o None). El ancla es la de
+    timeline.reminder_plan: la última toma, si no `recordatorio.inicio`.
+    Sin `engine`, usa el motor que ya tenga el almacén.
+    """
+    import timeline
+    store = backend.open_engine(storage_dir, engine or detect_engine(storage_dir))
+    try:
+        meds = store.load_meds()
+    finally:
+        if hasattr(store, "close"):
+            store.close()
+    doses = None
+    if os.path.isdir(os.path.join(storage_dir, "historial")):
+        # Solo lectura: la app puede estar agregando una toma en este momento.
+        doses = history.DoseHistory(os.path.join(storage_dir, "historial"), read_only=True)
+    reminders = []
+    for med in meds:
+        plan = timeline.reminder_plan(med, doses.last_dose(med["id"]) if doses else None)
+        if plan is None:
+            continue
+        anchor, interval = plan
+        message = (med.get("recordatorio") or {}).get("mensaje") or "Recordatorio de medicación"
+        reminders.append((med["id"], interval, message, anchor))
+    return reminders
+
+
+class ReminderDaemon:
+    """
+    Recordatorios de varios almacenes en un único loop asyncio.
+
+    La cola guarda (hora, seq, almacén, generación, id, intervalo, mensaje);
+    al recargar un almacén sube su generación y sus entradas viejas se
+    descartan al llegar al frente (borrado perezoso). Los disparos se anclan a
+    la hora programada, como en notify.
+    """
+
+    def __init__(self, stores, sink, engine: str = None, poll: float = POLL_INTERVAL, clock=time.time):
+        self.stores = [os.path.abspath(s) for s in stores]
+        self.sink = sink
+        self.engine = engine
+        self.poll = poll
+        self.clock = clock
+        self._heap = []
+        self._seq = itertools.count()
+        self._generation = [0] * len(self.stores)
+        self._signature = [None] * len(self.stores)
+        # Próximo disparo por medicamento: id -> (intervalo, ancla, hora).
+        self._dues = [{} for _ in self.stores]
+        self.fired = 0
+        self.errors = 0
+
+    def pending(self) -> int:
+        return sum(len(dues) for dues in self._dues)
+
+    def load(self, pos: int):
+        """(Re)carga los recordatorios del almacén `pos`."""
+        path = self.stores[pos]
+        self._signature[pos] = store_signature(path)
+        try:
+            reminders = load_reminders(path, self.engine)
+        except Exception as error:
+            # Se conservan los recordatorios que ya tenía (p. ej. archivo dañado).
+            self.errors += 1
+            sys.stderr.write(f"No se pudo leer {path}: {error}\n")
+            return
+        self._generation[pos] += 1
+        generation = self._generation[pos]
+        now = self.clock()
+        previous = self._dues[pos]
+        dues = {}
+        for med_id, interval, message, anchor in reminders:
+            kept = previous.get(med_id)
+            if kept and kept[:2] == (interval, anchor):
+                # Sin cambios: se conserva el próximo disparo (aunque ya haya vencido).
+                due = kept[2]
+            else:
+                # Como Timeline.next_dose: la primera toma posterior a ahora.
+                start = now if anchor is None else anchor
+                due = start + max(math.floor((now - start) / interval) + 1, 1) * interval
+            dues[med_id] = (interval, anchor, due)
+            heapq.heappush(self._heap, (due, next(self._seq), pos, generation, med_id, interval, message))
+        self._dues[pos] = dues
+
+    def refresh(self):
+        """Recarga los almacenes cuyos archivos cambiaron."""
+        for pos, path in enumerate(self.stores):
+            if store_signature(path) != self._signature[pos]:
+                self.load(pos)
+
+    async def fire_due(self):
+        """Envía los recordatorios vencidos y reprograma los siguientes."""
+        now = self.clock()
+        while self._heap and self._heap[0][0] <= now:
+            due, _seq, pos, generation, med_id, interval, message = heapq.heappop(self._heap)
+            if generation != self._generation[pos]:
+                continue
+            await self.sink.emit({
+                "store": self.stores[pos],
+                "med_id": med_id,
+                "title": "Dosely",
+                "message": message,
+                "due": due,
+                "fired": now,
+            })
+            self.fired += 1
+            missed = int((now - due) // interval) + 1
+            due += missed * interval
+            dues = self._dues[pos]
+            dues[med_id] = (interval, dues[med_id][1], due)
+            heapq.heappush(self._heap, (due, next(self._seq), pos, generation, med_id, interval, message))
+
+    def _next_wait(self) -> float:
+        while self._heap and self._heap[0][3] != self._generation[self._heap[0][2]]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return self.poll
+        return min(max(self._heap[0][0] - self.clock(), 0.0), self.poll)
+
+    async def run(self, stop: asyncio.Event = None):
+        """Atiende los recordatorios hasta que se active `stop`."""
+        stop = stop or asyncio.Event()
+        for pos in range(len(self.stores)):
+            self.load(pos)
+        next_poll = time.monotonic() + self.poll
+        try:
+            while not stop.is_set():
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=self._next_wait())
+                except asyncio.TimeoutError:
+                    pass
+                if time.monotonic() >= next_poll:
+                    self.refresh()
+                    next_poll = time.monotonic() + self.poll
+                await self.fire_due()
+        finally:
+            await self.sink.close()
+
+
+async def serve(stores, sink, engine: str = None, poll: float = POLL_INTERVAL):
+    daemon = ReminderDaemon(stores, sink, engine=engine, poll=poll)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    sys.stderr.write(f"Dosely: {len(daemon.stores)} almacén(es), esperando recordatorios\n")
+    await daemon.run(stop)
+    sys.stderr.write(f"Dosely: {daemon.fired} recordatorio(s) enviados\n")
+    return daemon
+
+
+# ---------------------------------------------------------
+# Subcomandos
+# ---------------------------------------------------------
+def _profile_store(args):
+    return profiles.ProfileStore(args.profiles_root) if args.profiles_root else profiles.get_store()
+
+
+def _use_storage(args):
+    # Solo `run` atiende varios almacenes; el resto trabaja sobre uno.
+    if args.storage and len(args.storage) > 1:
+        raise SystemExit(f"{args.command} admite un solo --storage")
+    if args.engine:
+        backend.STORAGE_ENGINE = args.engine
+    if args.profile:
+        profiles.open_profile(args.profile, _profile_store(args))
+        return
+    backend.set_storage_dir(args.storage[0] if args.storage else backend.STORAGE_DIR)
+
+
+def _print(value, as_json: bool):
+    if as_json:
+        print(json.dumps(value, ensure_ascii=False, indent=2))
+
+
+def _med_line(med: dict) -> str:
+    mg = med.get("mg")
+    mg_txt = f" {mg} mg" if mg not in (None, "") else ""
+    reminder = med.get("recordatorio") or {}
+    every = f"  cada {reminder['intervalo']} {reminder.get('unidad', 'horas')}" if reminder.get("intervalo") else ""
+    sustancia = f"  ({med['sustancia']})" if med.get("sustancia") else ""
+    return f"{med.get('id', '')}  {med.get('nombre', '')}{mg_txt}{sustancia}{every}"
+
+
+def cmd_list(args):
+    _use_storage(args)
+    meds = backend.load_meds()
+    if args.json:
+        _print(meds, True)
+        return 0
+    for med in meds:
+        print(_med_line(med))
+    return 0
+
+
+def cmd_agenda(args):
+    _use_storage(args)
+    doses = backend.upcoming_doses(args.horas, limit=args.limit)
+    if args.json:
+        _print([{"hora": ts, "id": med["id"], "nombre": med.get("nombre", "")} for ts, med in doses], True)
+        return 0
+    for ts, med in doses:
+        print(f"{time.strftime('%a %d/%m %H:%M', time.localtime(ts))}  {med.get('nombre', '')}  ({med['id']})")
+    return 0
+
+
+def cmd_search(args):
+    _use_storage(args)
+    results = backend.search_catalog(args.query)[:args.limit]
+    if args.json:
+        _print(results, True)
+        return 0
+    for item in results:
+        mg = f" {item['mg']} mg" if item.get("mg") not in (None, "") else ""
+        rx = "  [receta]" if item.get("requiere_receta") else ""
+        print(f"{item.get('nombre', '')}{mg}  ({item.get('sustancia', '')}){rx}")
+    return 0
+
+
+def _apply_fields(entry: dict, args):
+    """Aplica las opciones a `entry` validándolas con models; SystemExit con el mensaje si no sirven."""
+    current = models.Medication.from_dict(entry)
+    nombre = args.nombre if args.nombre is not None else current.nombre
+    reminder = current.recordatorio
+    every = args.cada if args.cada is not None else (reminder.intervalo if reminder else None)
+    unit = args.unidad or (reminder.unidad if reminder else models.HOURS)
+    # Sin cambios en el intervalo, las tomas siguen contando desde el mismo inicio.
+    inicio = reminder.inicio if reminder and args.cada is None and args.unidad is None else None
+    try:
+        if every is not None:
+            reminder = models.Reminder(every, unit, nombre=(nombre or "").strip(),
+                                       inicio=time.time() if inicio is None else inicio)
+        med = models.Medication(
+            nombre,
+            args.sustancia if args.sustancia is not None else current.sustancia,
+            args.mg if args.mg is not None else current.mg,
+            args.receta if args.receta is not None else current.requiere_receta,
+            args.notas if args.notas is not None else current.notas,
+            reminder,
+            id=current.id,
+        )
+    except ValueError as error:
+        raise SystemExit(f"error: {error}") from None
+    med.extra = current.extra
+    return med.to_dict()
+
+
+def _warn_interactions(entry: dict, med_id: str = None):
+    try:
+        warnings = backend.check_interactions(entry, med_id)
+    except ValueError as error:
+        print(f"Aviso: no se pudo revisar interacciones: {error}", file=sys.stderr)
+        return
+    if warnings:
+        print(interactions.format_warnings(warnings), file=sys.stderr)
+
+
+def cmd_add(args):
+    _use_storage(args)
+    if args.cada is None or args.cada <= 0:
+        raise SystemExit("--cada debe ser mayor que 0")
+    entry = _apply_fields({"nombre": "", "sustancia": "", "mg": None, "requiere_receta": False, "notas": ""}, args)
+    _warn_interactions(entry)
+    med_id = backend.add_med(entry)
+    print(med_id)
+    return 0
+
+
+def cmd_edit(args):
+    _use_storage(args)
+    med = backend.get_med(args.id)
+    if med is None:
+        raise SystemExit(f"Medicamento no encontrado: {args.id}")
+    if args.cada is not None and args.cada <= 0:
+        raise SystemExit("--cada debe ser mayor que 0")
+    entry = _apply_fields(dict(med), args)
+    _warn_interactions(entry, args.id)
+    backend.update_med(args.id, entry)
+    print(_med_line(backend.get_med(args.id)))
+    return 0
+
+
+def cmd_reconcile(args):
+    _use_storage(args)
+    if args.archivo == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(args.archivo, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    results = reconcile.reconcile(lines, workers=args.workers)
+    ids = reconcile.apply(results, args.min_score) if args.add else []
+    if args.json:
+        _print({"resultados": results, "agregados": ids}, True)
+        return 0
+    for result in results:
+        item = result["match"]
+        if item is None or result["score"] < args.min_score:
+            print(f"   ?  {result['linea']}  (sin coincidencia)")
+            continue
+        every = f"  cada {result['cada']} {result['unidad']}" if result["cada"] else ""
+        print(f"{result['score']:.2f}  {result['linea']}  ->  {_med_line(item).strip()}{every}")
+    if args.add:
+        print(f"{len(ids)} medicamento(s) agregados")
+    return 0
+
+
+def cmd_backup(args):
+    _use_storage(args)
+    if args.verificar:
+        for seq, kind, path in backup.list_archives(args.directorio):
+            backup.verify(path)
+            print(f"{seq:06d}  {kind}  ok")
+        return 0
+    path = backup.backup(args.directorio, full=args.completa)
+    print(path or "Sin cambios desde la última copia")
+    return 0
+
+
+def cmd_restore(args):
+    if not args.storage or len(args.storage) > 1:
+        raise SystemExit("restore necesita un único --storage (directorio de destino)")
+    summary = backup.restore(args.directorio, args.storage[0], upto=args.hasta, engine=args.engine)
+    if args.json:
+        _print(summary, True)
+        return 0
+    print(f"{summary['copias']} copia(s): {summary['medicamentos']} medicamento(s), "
+          f"{summary['tomas']} toma(s) en {summary['destino']}")
+    return 0
+
+
+def cmd_profiles(args):
+    store = _profile_store(args)
+    if args.action == "create":
+        if not args.nombre:
+            raise SystemExit("--nombre es obligatorio")
+        print(store.create(args.nombre, args.id))
+    elif args.action == "rebuild":
+        total = store.rebuild_manifest(workers=args.workers)
+        print(f"{total} perfil(es) indexados")
+    else:
+        rows = store.list(limit=args.limit)
+        if args.json:
+            _print(rows, True)
+            return 0
+        for row in rows:
+            print(f"{row['id']}  {row['nombre']}  medicamentos={row['meds']}  recordatorios={row['reminders']}")
+    return 0
+
+
+def cmd_run(args):
+    stores = list(args.storage or [])
+    if args.profile or args.all_profiles:
+        store = _profile_store(args)
+        ids = store.scan() if args.all_profiles else [args.profile]
+        stores.extend(store.path(profile_id) for profile_id in ids)
+    stores = stores or [backend.STORAGE_DIR]
+    asyncio.run(serve(stores, make_sink(args.sink), engine=args.engine, poll=args.poll))
+    return 0
+
+
+def _bool(text: str) -> bool:
+    return str(text).strip().lower() in ("1", "si", "sí", "s", "true", "yes", "y")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="dosely", description="Dosely sin interfaz.")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--storage", action="append", metavar="DIR",
+                        help="directorio de almacenamiento (por defecto ./storage)")
+    common.add_argument("--engine", choices=("sqlite", "json"), help="motor de almacenamiento")
+    common.add_argument("--profile", metavar="ID", help="perfil de paciente (ver profiles.py)")
+    common.add_argument("--profiles-root", metavar="DIR", help="directorio de perfiles (por defecto storage/profiles)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("list", parents=[common], help="lista los medicamentos")
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=cmd_list)
+
+    p = sub.add_parser("agenda", parents=[common], help="próximas tomas")
+    p.add_argument("--horas", type=float, default=24, help="horizonte en horas (por defecto 24)")
+    p.add_argument("--limit", type=int)
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=cmd_agenda)
+
+    p = sub.add_parser("search", parents=[common], help="busca en el catálogo")
+    p.add_argument("query")
+    p.add_argument("--limit", type=int, default=20)
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=cmd_search)
+
+    fields = argparse.ArgumentParser(add_help=False)
+    fields.add_argument("--nombre")
+    fields.add_argument("--sustancia")
+    fields.add_argument("--mg", type=float)
+    fields.add_argument("--receta", type=_bool, metavar="SI|NO")
+    fields.add_argument("--notas")
+    fields.add_argument("--cada", type=float, metavar="N", help="intervalo del recordatorio")
+    fields.add_argument("--unidad", choices=("horas", "dias"))
+
+    p = sub.add_parser("add", parents=[common, fields], help="añade un medicamento")
+    p.set_defaults(func=cmd_add)
+
+    p = sub.add_parser("edit", parents=[common, fields], help="edita un medicamento por id")
+    p.add_argument("id")
+    p.set_defaults(func=cmd_edit)
+
+    p = sub.add_parser("reconcile", parents=[common], help="concilia una receta con el catálogo")
+    p.add_argument("archivo", help="una línea por medicamento; - para leer de la entrada estándar")
+    p.add_argument("--workers", type=int, help="procesos (por defecto uno por CPU; 1 = sin procesos)")
+    p.add_argument("--min-score", type=float, default=reconcile.MIN_SCORE, help="puntaje mínimo para aceptar")
+    p.add_argument("--add", action="store_true", help="agrega los aceptados a la lista")
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=cmd_reconcile)
+
+    p = sub.add_parser("backup", parents=[common], help="copia de seguridad (completa o solo cambios)")
+    p.add_argument("directorio", help="directorio de las copias")
+    p.add_argument("--completa", action="store_true", help="fuerza una copia completa")
+    p.add_argument("--verificar", action="store_true", help="comprueba las copias existentes sin copiar")
+    p.set_defaults(func=cmd_backup)
+
+    p = sub.add_parser("restore", parents=[common], help="restaura copias en un directorio nuevo (--storage)")
+    p.add_argument("directorio", help="directorio de las copias")
+    p.add_argument("--hasta", type=int, metavar="N", help="restaura hasta la copia número N")
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=cmd_restore)
+
+    p = sub.add_parser("run", parents=[common], help="servicio de recordatorios")
+    p.add_argument("--sink", default="stdout", help="stdout, file:RUTA o unix:RUTA")
+    p.add_argument("--poll", type=float, default=POLL_INTERVAL, help="segundos entre revisiones de cambios")
+    p.add_argument("--all-profiles", action="store_true", help="atiende todos los perfiles")
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser("profiles", parents=[common], help="perfiles de pacientes")
+    p.add_argument("action", choices=("list", "create", "rebuild"))
+    p.add_argument("--nombre", help="nombre del paciente (create)")
+    p.add_argument("--id", help="id del perfil (create; por defecto uno nuevo)")
+    p.add_argument("--workers", type=int, help="procesos para rebuild")
+    p.add_argument("--limit", type=int)
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(func=cmd_profiles)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
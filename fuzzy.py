@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Búsqueda tolerante a errores de tipeo y ordenada por calidad de coincidencia.
+
+Funciona sobre cualquier índice del catálogo (CatalogIndex o BinaryCatalog):
+1. Los aciertos exactos por subcadena vienen del índice de trigramas.
+2. Si hay pocos, se buscan candidatos aproximados contando trigramas
+   compartidos (cada edición destruye como mucho tres trigramas, así que un
+   producto a distancia k comparte al menos |T| - 3k trigramas con la consulta).
+3. Los candidatos, de más a menos trigramas compartidos, se verifican con una
+   distancia de edición acotada sobre cualquier subcadena de la clave, dentro
+   de un presupuesto de tiempo.
+
+Orden: coincidencia exacta del campo, prefijo del campo, prefijo de una
+palabra, subcadena y, por último, aproximados por distancia.
+"""
+import time
+from collections import Counter
+from itertools import chain
+
+from catalog_index import NGRAM, fold, ngrams
+
+# Resultados aproximados que se agregan como máximo.
+FUZZY_LIMIT = 20
+# Con más aciertos exactos que esto no se buscan aproximados.
+MIN_EXACT = 10
+# Por encima de esta cantidad de aciertos se conserva el orden del catálogo.
+RANK_LIMIT = 2000
+# Presupuesto de tiempo para verificar candidatos aproximados (segundos).
+BUDGET = 0.03
+# Candidatos aproximados que se verifican como máximo.
+MAX_CANDIDATES = 3000
+# Trigramas presentes en más de esta fracción del catálogo no se cuentan.
+COMMON_FRACTION = 0.02
+
+
+def max_distance(query: str) -> int:
+    """Ediciones toleradas según la longitud de la consulta."""
+    if len(query) < 5:
+        return 0
+    if len(query) < 9:
+        return 1
+    return 2
+
+
+def substring_distance(query: str, text: str, limit: int) -> int:
+    """
+    Menor distancia de edición entre `query` y cualquier subcadena de `text`.
+    Usa el algoritmo de vectores de bits de Myers (una pasada sobre `text`).
+    Devuelve `limit + 1` si la distancia supera `limit`.
+    """
+    m = len(query)
+    if not m:
+        return 0
+    full = (1 << m) - 1
+    high = 1 << (m - 1)
+    peq = {}
+    for i, ch in enumerate(query):
+        peq[ch] = peq.get(ch, 0) | (1 << i)
+    pv, mv, score = full, 0, m
+    best = m
+    for ch in text:
+        eq = peq.get(ch, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = (mv | ~(xh | pv)) & full
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        # Sin "| 1": el inicio de la coincidencia en `text` es libre.
+        ph = (ph << 1) & full
+        mh = (mh << 1) & full
+        pv = (mh | ~(xv | ph)) & full
+        mv = ph & xv
+        if score < best:
+            best = score
+    return best if best <= limit else limit + 1
+
+
+def _exact_rank(query: str, key: str) -> int:
+    fields = key.split("\n")
+    if query in fields:
+        return 0
+    if any(field.startswith(query) for field in fields):
+        return 1
+    if any(word.startswith(query) for word in key.split()):
+        return 2
+    return 3
+
+
+def fuzzy_candidates(index, query: str, exclude=(), budget: float = BUDGET):
+    """
+    Ids aproximados a `query` como lista de (distancia, largo de la clave, id),
+    sin los de `exclude`, ordenados de mejor a peor.
+    """
+    limit = max_distance(query)
+    grams = list(ngrams(query))
+    if not limit or not grams:
+        return []
+    needed = max(1, len(grams) - NGRAM * limit)
+    deadline = time.perf_counter() + budget
+    # Los trigramas muy frecuentes casi no discriminan y son los más caros de
+    # contar: se descartan bajando la cota en uno por cada uno descartado.
+    postings = sorted((index.postings(g) for g in grams), key=len)
+    common = len(index) * COMMON_FRACTION
+    while len(postings) > 1 and needed > 1 and len(postings[-1]) > common:
+        postings.pop()
+        needed -= 1
+    # Conteo de trigramas compartidos (en C, sobre las listas de ids); solo
+    # pasan a verificarse los productos que alcanzan la cota.
+    counts = Counter(chain.from_iterable(postings))
+    excluded = set(exclude)
+    candidates = [(-hits, item_id) for item_id, hits in counts.items()
+                  if hits >= needed and item_id not in excluded]
+    candidates.sort()
+    found = []
+    for checked, (_hits, item_id) in enumerate(candidates):
+        if checked >= MAX_CANDIDATES or time.perf_counter() > deadline:
+            break
+        key = index.key(item_id)
+        distance = substring_distance(query, key, limit)
+        if distance <= limit:
+            found.append((distance, len(key), item_id))
+    found.sort()
+    return found
+
+
+def rank(index, query: str, exact_ids, limit: int = FUZZY_LIMIT, budget: float = BUDGET):
+    """
+    Ordena los aciertos exactos por calidad y, si son pocos, agrega los
+    aproximados. Devuelve una lista de ids.
+    """
+    q = fold(query)
+    exact_ids = list(exact_ids)
+    if not q:
+        return exact_ids
+    if len(exact_ids) <= RANK_LIMIT:
+        keyed = []
+        for i in exact_ids:
+            key = index.key(i)
+            keyed.append((_exact_rank(q, key), len(key), i))
+        keyed.sort()
+        exact_ids = [i for _rank, _len, i in keyed]
+    if len(exact_ids) >= MIN_EXACT:
+        return exact_ids
+    extra = fuzzy_candidates(index, q, exclude=exact_ids, budget=budget)
+    return exact_ids + [i for _distance, _len, i in extra[:limit]]
+
+
+def search(index, query: str, limit: int = FUZZY_LIMIT, budget: float = BUDGET):
+    """Búsqueda ordenada y tolerante a errores sobre `index`."""
+    return rank(index, query, index.search(query), limit=limit, budget=budget)
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+Historial de tomas de Dosely.
+
+Los eventos (tomada, omitida, pospuesta) se guardan como registros binarios de
+tamaño fijo en un log de solo-añadir. Cada cierto número de eventos el log
+activo se ordena por hora y se convierte en un segmento inmutable; cuando hay
+demasiados segmentos se fusionan en uno solo.
+
+- "Última toma de X" se responde desde una tabla en memoria: O(1).
+- Las consultas por rango buscan con bisección dentro de cada segmento
+  ordenado, leyendo del disco solo los registros del rango pedido.
+
+Archivos dentro del directorio del historial:
+- activo-NNNNNN.log  eventos recientes, en orden de llegada (activo.log en
+                     historiales sin segmentos.json)
+- seg-NNNNNN.log     segmentos ordenados por hora
+- segmentos.json     segmentos vigentes y generación del log activo
+- ultimas.json       última toma por medicamento al momento de compactar
+
+Al compactar, el segmento nuevo se escribe primero, después se reemplaza
+segmentos.json y recién entonces se borra lo que ese segmento absorbió. Si se
+corta en el medio, los archivos que segmentos.json no nombra se ignoran (y se
+borran al abrir): ningún evento queda dos veces. Mientras alguien recorre
+`events()` los segmentos absorbidos no se borran: quedan pendientes hasta que
+termina el último lector.
+"""
+import heapq
+import json
+import os
+import re
+import struct
+import threading
+import time
+
+import instrumentation
+
+# hora (epoch, float) | tipo de evento | id del medicamento (ascii, relleno con \0)
+ID_SIZE = 32
+RECORD = struct.Struct(f"<dB{ID_SIZE}s")
+
+KINDS = {"taken": 1, "skipped": 2, "snoozed": 3}
+KIND_NAMES = {code: name for name, code in KINDS.items()}
+
+ACTIVE_FILE = "activo.log"
+LAST_FILE = "ultimas.json"
+MANIFEST_FILE = "segmentos.json"
+_DATA_FILE = re.compile(r"^(?:seg|activo)(?:-\d{6})?\.log(?:\.tmp)?$")
+COMPACT_EVERY = 512
+MAX_SEGMENTS = 8
+
+
+def _encode(ts: float, kind: str, med_id: str) -> bytes:
+    if kind not in KINDS:
+        raise ValueError(f"Tipo de evento desconocido: {kind}")
+    med_id = str(med_id)
+    # El id va en un campo fijo: uno más largo se cortaría y leería distinto.
+    if not med_id or not med_id.isascii() or "\0" in med_id or len(med_id) > ID_SIZE:
+        raise ValueError(f"Id de medicamento inválido para el historial (ASCII, hasta {ID_SIZE} "
+                         f"caracteres): {med_id!r}")
+    return RECORD.pack(float(ts), KINDS[kind], med_id.encode("ascii"))
+
+
+def _decode(raw: bytes):
+    ts, code, med = RECORD.unpack(raw)
+    return ts, KIND_NAMES.get(code, "taken"), med.rstrip(b"\0").decode("ascii")
+
+
+class _Segment:
+    """Segmento inmutable ordenado por hora; se lee con bisección sobre el archivo."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = os.path.getsize(path) // RECORD.size
+        self.start = self._read(0)[0] if self.count else 0.0
+        self.end = self._read(self.count - 1)[0] if self.count else 0.0
+
+    def _read(self, pos: int, f=None):
+        if f is None:
+            with open(self.path, "rb") as fh:
+                return self._read(pos, fh)
+        f.seek(pos * RECORD.size)
+        return _decode(f.read(RECORD.size))
+
+    def events(self, start: float, end: float):
+        """Eventos con start <= hora < end, en orden."""
+        if not self.count or end <= self.start or start > self.end:
+            return
+        with open(self.path, "rb") as f:
+            lo, hi = 0, self.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._read(mid, f)[0] < start:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            f.seek(lo * RECORD.size)
+            for _ in range(lo, self.count):
+                event = _decode(f.read(RECORD.size))
+                if event[0] >= end:
+                    break
+                yield event
+
+    def all(self):
+        with open(self.path, "rb") as f:
+            for _ in range(self.count):
+                yield _decode(f.read(RECORD.size))
+
+
+class DoseHistory:
+    """
+    Historial de tomas guardado en `directory`. Con `read_only` no se crea ni
+    se repara nada en disco (para leer el historial de otro proceso que
+    puede estar escribiendo) y las escrituras fallan.
+    """
+
+    def __init__(self, directory: str, read_only: bool = False):
+        self.directory = directory
+        self.read_only = read_only
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._active = []
+        self._last = {}
+        self._segments = []
+        self._generation = 0
+        # Lectores de events() en curso y segmentos que esperan a que terminen.
+        self._readers = 0
+        self._doomed = []
+        self._load()
+
+    # ------------------------
+    # Carga
+    # ------------------------
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _active_path(self) -> str:
+        if not self._generation:
+            return self._path(ACTIVE_FILE)
+        return self._path(f"activo-{self._generation:06d}.log")
+
+    def _load(self):
+        try:
+            with open(self._path(MANIFEST_FILE), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            names = [os.path.basename(name) for name in manifest["segmentos"]]
+            self._generation = int(manifest["generacion"])
+        except FileNotFoundError:
+            # Historial nuevo o anterior a segmentos.json: vale todo lo que hay.
+            names = sorted(n for n in os.listdir(self.directory) if n.startswith("seg-") and n.endswith(".log"))
+            manifest = None
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            raise ValueError(f"{self._path(MANIFEST_FILE)} está dañado: {error}") from None
+        else:
+            if not self.read_only:
+                self._remove_stale(names)
+        self._segments = [_Segment(self._path(n)) for n in names]
+        if manifest is None and not self.read_only:
+            self._write_manifest()
+        try:
+            with open(self._path(LAST_FILE), "r", encoding="utf-8") as f:
+                for med_id, kinds in json.load(f).items():
+                    for kind, ts in kinds.items():
+                        self._last[(med_id, kind)] = ts
+        except (OSError, ValueError):
+            # Sin tabla guardada: se reconstruye desde los segmentos.
+            for segment in self._segments:
+                for event in segment.all():
+                    self._remember(event)
+        active = self._active_path()
+        if os.path.exists(active):
+            with open(active, "rb") as f:
+                data = f.read()
+            usable = len(data) - len(data) % RECORD.size
+            if usable != len(data) and not self.read_only:
+                # Último registro a medio escribir (corte de energía): se descarta.
+                # Solo lectura: puede ser una toma que otro proceso está
+                # escribiendo ahora, así que solo se ignora.
+                with open(active, "r+b") as f:
+                    f.truncate(usable)
+            for offset in range(0, usable, RECORD.size):
+                event = _decode(data[offset:offset + RECORD.size])
+                self._active.append(event)
+                self._remember(event)
+
+    def _remove_stale(self, names):
+        """Borra lo que quedó de una compactación cortada (no figura en segmentos.json)."""
+        keep = set(names)
+        keep.add(os.path.basename(self._active_path()))
+        for name in os.listdir(self.directory):
+            if _DATA_FILE.match(name) and name not in keep:
+                os.remove(self._path(name))
+
+    def _writable(self):
+        if self.read_only:
+            raise PermissionError(f"Historial abierto solo para lectura: {self.directory}")
+
+    def _remember(self, event):
+        ts, kind, med_id = event
+        if ts >= self._last.get((med_id, kind), float("-inf")):
+            self._last[(med_id, kind)] = ts
+
+    # ------------------------
+    # Escritura
+    # ------------------------
+    def record(self, med_id: str, kind: str = "taken", ts: float = None):
+        """Añade un evento al historial y devuelve (hora, tipo, id)."""
+        self._writable()
+        ts = time.time() if ts is None else float(ts)
+        raw = _encode(ts, kind, med_id)
+        event = (ts, kind, str(med_id))
+        with self._lock:
+            with open(self._active_path(), "ab") as f:
+                f.write(raw)
+                f.flush()
+                os.fsync(f.fileno())
+            instrumentation.add_bytes("written", "historial", len(raw))
+            self._active.append(event)
+            self._remember(event)
+            if len(self._active) >= COMPACT_EVERY:
+                self.compact()
+        return event
+
+    def compact(self):
+        """Convierte el log activo en un segmento ordenado y fusiona si hay demasiados."""
+        self._writable()
+        with self._lock:
+            if self._active:
+                self._write_segment(sorted(self._active))
+                self._write_last()
+                active = self._active_path()
+                # Log nuevo: el viejo deja de valer con segmentos.json.
+                self._generation += 1
+                self._write_manifest()
+                self._active = []
+                if os.path.exists(active):
+                    os.remove(active)
+            if len(self._segments) > MAX_SEGMENTS:
+                old = list(self._segments)
+                self._write_segment(heapq.merge(*(s.all() for s in old)))
+                self._segments = self._segments[len(old):]
+                self._write_manifest()
+                self._discard(segment.path for segment in old)
+
+    def _discard(self, paths):
+        """Borra segmentos que ya no figuran en segmentos.json (o los deja para el último lector)."""
+        self._doomed.extend(paths)
+        if not self._readers:
+            doomed, self._doomed = self._doomed, []
+            for path in doomed:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _next_segment_path(self) -> str:
+        # Los pendientes de borrar también cuentan: su nombre no se reutiliza.
+        paths = [s.path for s in self._segments] + self._doomed
+        number = max((int(os.path.basename(p)[4:-4]) for p in paths), default=-1) + 1
+        return self._path(f"seg-{number:06d}.log")
+
+    def _write_segment(self, events):
+        path = self._next_segment_path()
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            for ts, kind, med_id in events:
+                f.write(_encode(ts, kind, med_id))
+            f.flush()
+            os.fsync(f.fileno())
+            instrumentation.add_bytes("written", "historial", f.tell())
+        os.replace(tmp, path)
+        self._segments.append(_Segment(path))
+
+    def _write_json(self, name: str, data):
+        tmp = self._path(name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(name))
+
+    def _write_last(self):
+        table = {}
+        for (med_id, kind), ts in self._last.items():
+            table.setdefault(med_id, {})[kind] = ts
+        self._write_json(LAST_FILE, table)
+
+    def _write_manifest(self):
+        """Fija qué segmentos y qué log activo valen; lo demás queda para borrar."""
+        self._write_json(MANIFEST_FILE, {"generacion": self._generation,
+                                         "segmentos": [os.path.basename(s.path) for s in self._segments]})
+
+    def import_segment(self, chunks) -> int:
+        """
+        Agrega como segmento nuevo los registros binarios de `chunks` (bytes,
+        ordenados por hora, como los de `raw_events`). Devuelve cuántos eventos
+        se agregaron.
+        """
+        self._writable()
+        with self._lock:
+            path = self._next_segment_path()
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                size = f.tell()
+                f.flush()
+                os.fsync(f.fileno())
+            if size % RECORD.size:
+                os.remove(tmp)
+                raise ValueError("Segmento de historial incompleto")
+            if not size:
+                os.remove(tmp)
+                return 0
+            os.replace(tmp, path)
+            segment = _Segment(path)
+            self._segments.append(segment)
+            self._write_manifest()
+            for event in segment.all():
+                self._remember(event)
+            self._write_last()
+            return segment.count
+
+    def clear(self):
+        """Borra todo el historial."""
+        self._writable()
+        with self._lock:
+            old = [segment.path for segment in self._segments]
+            active = self._active_path()
+            self._segments = []
+            self._generation += 1
+            self._write_manifest()
+            self._discard(old)
+            for path in (active, self._path(LAST_FILE)):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._active = []
+            self._last = {}
+
+    # ------------------------
+    # Consultas
+    # ------------------------
+    def count(self) -> int:
+        """Cantidad de eventos guardados (sin leer los segmentos)."""
+        with self._lock:
+            return sum(s.count for s in self._segments) + len(self._active)
+
+    def raw_events(self, after: float = None):
+        """Eventos con hora > `after` (todos si es None) como registros binarios, ordenados."""
+        for ts, kind, med_id in self.events(start=after):
+            if after is None or ts > after:
+                yield _encode(ts, kind, med_id)
+
+    def last_dose(self, med_id: str, kind: str = "taken"):
+        """Hora (epoch) del último evento `kind` de un medicamento, o None."""
+        return self._last.get((med_id, kind))
+
+    def last_doses(self, kind: str = "taken"):
+        """{id: hora} del último evento `kind` de cada medicamento."""
+        with self._lock:
+            return {med_id: ts for (med_id, k), ts in self._last.items() if k == kind}
+
+    def events(self, start: float = None, end: float = None, med_id: str = None, kind: str = None):
+        """Eventos con start <= hora < end, ordenados por hora."""
+        start = float("-inf") if start is None else start
+        end = float("inf") if end is None else end
+        with self._lock:
+            segments = list(self._segments)
+            active = sorted(e for e in self._active if start <= e[0] < end)
+            # Los segmentos se abren a medida que se leen: una compactación no
+            # los borra hasta que este recorrido termine.
+            self._readers += 1
+        try:
+            streams = [s.events(start, end) for s in segments]
+            streams.append(active)
+            for event in heapq.merge(*streams):
+                if med_id is not None and event[2] != med_id:
+                    continue
+                if kind is not None and event[1] != kind:
+                    continue
+                yield event
+        finally:
+            with self._lock:
+                self._readers -= 1
+                if not self._readers and self._doomed:
+                    self._discard(())
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Importador de catálogos externos de medicamentos.
+
+Lee CSV o JSON Lines fila por fila (memoria constante respecto al archivo de
+origen), mapea las columnas al esquema nombre/sustancia/mg/requiere_receta,
+descarta duplicados y escribe en una sola pasada el catalogo.json del backend
+y su índice de búsqueda (catalogo.bin).
+
+Uso:
+    python importer.py registro.csv
+    python importer.py registro.csv --delimiter ";" --encoding latin-1 \\
+        --map nombre=DENOMINACION --map sustancia=PRINCIPIO_ACTIVO
+    python importer.py productos.jsonl --format jsonl
+"""
+import argparse
+import codecs
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+
+import backend
+import catalog_bin
+import catalog_index
+
+# Nombres de columna habituales en registros sanitarios, por campo de Dosely.
+DEFAULT_COLUMNS = {
+    "nombre": ("nombre", "name", "producto", "nombre_comercial", "denominacion", "brand_name"),
+    "sustancia": ("sustancia", "principio_activo", "sustancia_activa", "active_ingredient", "generic_name"),
+    "mg": ("mg", "dosis", "concentracion", "strength", "dose_mg"),
+    "requiere_receta": ("requiere_receta", "receta", "rx", "prescription", "condicion_venta"),
+}
+
+_TRUE_VALUES = {"1", "true", "si", "sí", "s", "yes", "y", "x", "rx", "con receta", "bajo receta"}
+_NUMBER = re.compile(r"[-+]?\d+(?:[.,]\d+)?")
+
+PROGRESS_EVERY = 5000
+
+
+def _detect_format(path: str) -> str:
+    lower = path.lower()
+    if lower.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    return "csv"
+
+
+def _read_lines(path: str, encoding: str, counter: dict):
+    """Itera las líneas de texto del archivo contando los bytes leídos."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    with open(path, "rb") as f:
+        for raw in f:
+            counter["bytes"] += len(raw)
+            yield decoder.decode(raw)
+
+
+def iter_rows(path: str, fmt: str = None, delimiter: str = None, encoding: str = "utf-8-sig", counter: dict = None):
+    """Itera las filas del origen como diccionarios, sin cargar el archivo completo."""
+    counter = counter if counter is not None else {"bytes": 0}
+    fmt = fmt or _detect_format(path)
+    lines = _read_lines(path, encoding, counter)
+    if fmt == "jsonl":
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield None
+                continue
+            yield row if isinstance(row, dict) else None
+    elif fmt == "csv":
+        first = next(lines, "")
+        if delimiter is None:
+            # El delimitador más frecuente en la cabecera.
+            delimiter = max(",;\t|", key=first.count)
+        reader = csv.reader(_chain(first, lines), delimiter=delimiter)
+        header = [h.strip() for h in next(reader, [])]
+        for values in reader:
+            if values:
+                yield dict(zip(header, values))
+    else:
+        raise ValueError(f"Formato no soportado: {fmt}")
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def resolve_mapping(columns, overrides: dict = None):
+    """Decide qué columna del origen alimenta cada campo de Dosely."""
+    overrides = overrides or {}
+    folded = {catalog_index.fold(c).replace(" ", "_"): c for c in columns}
+    mapping = {}
+    for field, candidates in DEFAULT_COLUMNS.items():
+        if field in overrides:
+            mapping[field] = overrides[field]
+            continue
+        for candidate in candidates:
+            if candidate in folded:
+                mapping[field] = folded[candidate]
+                break
+    if "nombre" not in mapping:
+        raise ValueError("No se encontró la columna del nombre; use --map nombre=COLUMNA")
+    return mapping
+
+
+def _parse_mg(value):
+    if value in (None, ""):
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        number = float(value)
+    else:
+        match = _NUMBER.search(str(value))
+        if not match:
+            return None
+        number = float(match.group().replace(",", "."))
+    return int(number) if abs(number - int(number)) < 1e-9 else number
+
+
+def _parse_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    return catalog_index.fold(value) in _TRUE_VALUES
+
+
+def map_row(row: dict, mapping: dict):
+    """Convierte una fila del origen al esquema del catálogo, o None si no sirve."""
+    nombre = str(row.get(mapping["nombre"]) or "").strip()
+    if not nombre:
+        return None
+    return {
+        "nombre": nombre,
+        "sustancia": str(row.get(mapping.get("sustancia"), "") or "").strip(),
+        "mg": _parse_mg(row.get(mapping.get("mg"))),
+        "requiere_receta": _parse_bool(row.get(mapping.get("requiere_receta"), False)),
+    }
+
+
+def _dedup_key(item: dict) -> int:
+    """Hash de 64 bits de la clave de un producto (tamaño fijo en memoria)."""
+    key = f"{catalog_index.item_key(item)}\n{item['mg']}"
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def import_catalog(path: str, fmt: str = None, mapping: dict = None, delimiter: str = None,
+                   encoding: str = "utf-8-sig", target: str = None, progress=None):
+    """
+    Importa un catálogo externo sobre `target` (por defecto backend.CATALOG_FILE).
+
+    Escribe a un archivo temporal y lo reemplaza de forma atómica al terminar;
+    cada producto va a la vez a los bloques del catálogo binario, así que en
+    memoria quedan solo los trigramas y los hashes de duplicados.
+    Devuelve las estadísticas finales. `progress(stats)` se llama cada
+    PROGRESS_EVERY filas.
+    """
+    target = target or backend.CATALOG_FILE
+    backend.ensure_storage()
+    counter = {"bytes": 0}
+    stats = {"rows": 0, "imported": 0, "duplicates": 0, "skipped": 0, "bytes": 0,
+             "total_bytes": os.path.getsize(path)}
+    seen = set()
+    writer = catalog_bin.IndexWriter(catalog_bin.bin_path_for(target))
+    resolved = None
+    tmp = target + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as out:
+            out.write("[")
+            for row in iter_rows(path, fmt=fmt, delimiter=delimiter, encoding=encoding, counter=counter):
+                stats["rows"] += 1
+                if row is None:
+                    stats["skipped"] += 1
+                    continue
+                if resolved is None:
+                    resolved = resolve_mapping(row.keys(), mapping)
+                item = map_row(row, resolved)
+                if item is None:
+                    stats["skipped"] += 1
+                else:
+                    key = _dedup_key(item)
+                    if key in seen:
+                        stats["duplicates"] += 1
+                    else:
+                        seen.add(key)
+                        out.write(",\n" if stats["imported"] else "\n")
+                        json.dump(item, out, ensure_ascii=False)
+                        writer.add(item)
+                        stats["imported"] += 1
+                if progress and stats["rows"] % PROGRESS_EVERY == 0:
+                    stats["bytes"] = counter["bytes"]
+                    progress(dict(stats))
+            out.write("\n]\n")
+    except BaseException:
+        writer.close()
+        raise
+    seen.clear()  # los hashes ya no hacen falta al unir los bloques
+    os.replace(tmp, target)
+    catalog_index.invalidate(target)
+    writer.finish(catalog_index.file_signature(target))
+    stats["bytes"] = counter["bytes"]
+    if progress:
+        progress(dict(stats))
+    return stats
+
+
+def _print_progress(stats):
+    total = stats["total_bytes"] or 1
+    sys.stderr.write(
+        f"\r{stats['bytes'] * 100 // total:3d}%  filas={stats['rows']}  "
+        f"importadas={stats['imported']}  duplicadas={stats['duplicates']}  omitidas={stats['skipped']}"
+    )
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Importa un catálogo de medicamentos (CSV o JSON Lines).")
+    parser.add_argument("source", help="archivo CSV o JSONL de origen")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="formato (por defecto, según la extensión)")
+    parser.add_argument("--delimiter", help="delimitador CSV (por defecto se detecta)")
+    parser.add_argument("--encoding", default="utf-8-sig", help="codificación del origen")
+    parser.add_argument("--map", action="append", default=[], metavar="CAMPO=COLUMNA",
+                        help="columna de origen para nombre, sustancia, mg o requiere_receta")
+    parser.add_argument("--target", help="catálogo de destino (por defecto storage/catalogo.json)")
+    args = parser.parse_args(argv)
+
+    mapping = {}
+    for pair in args.map:
+        field, _, column = pair.partition("=")
+        if field not in DEFAULT_COLUMNS or not column:
+            parser.error(f"Mapeo inválido: {pair}")
+        mapping[field] = column
+
+    stats = import_catalog(args.source, fmt=args.format, mapping=mapping, delimiter=args.delimiter,
+                           encoding=args.encoding, target=args.target, progress=_print_progress)
+    sys.stderr.write("\n")
+    print(f"Importados {stats['imported']} medicamentos ({stats['duplicates']} duplicados, "
+          f"{stats['skipped']} omitidos) en {args.target or backend.CATALOG_FILE}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentación de las rutas calientes de Dosely.
+
+Se activa con la variable de entorno DOSELY_TRACE:
+- DOSELY_TRACE=1             activa y exporta a dosely-trace.json al salir;
+- DOSELY_TRACE=ruta.json     activa y exporta a esa ruta;
+- DOSELY_TRACE_OVERLAY=1     además muestra un resumen en pantalla (Kivy).
+
+Desactivada, `timed()` devuelve la función sin envolver y el resto de las
+funciones retornan en la primera línea: el costo es prácticamente nulo.
+
+Registra:
+- histogramas de latencia por nombre (`timed`, `span`, `observe`);
+- contadores de bytes leídos y escritos (`add_bytes`);
+- retraso de disparo de los recordatorios (notify.fire_lag).
+
+`export()` escribe el formato de eventos de trazas de Chrome (JSON), que se
+abre con chrome://tracing o https://ui.perfetto.dev; el resumen de
+histogramas y contadores va en "otherData".
+"""
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+_SETTING = os.environ.get("DOSELY_TRACE", "").strip()
+ENABLED = _SETTING.lower() not in ("", "0", "false", "no")
+TRACE_FILE = _SETTING if ENABLED and _SETTING.lower() not in ("1", "true", "yes", "si") else "dosely-trace.json"
+OVERLAY = ENABLED and os.environ.get("DOSELY_TRACE_OVERLAY", "") == "1"
+
+# Eventos conservados para la traza (los más antiguos se descartan).
+MAX_EVENTS = 200_000
+
+_lock = threading.Lock()
+_events = deque(maxlen=MAX_EVENTS)
+_histograms = {}
+_counters = {}
+_pid = os.getpid()
+# Origen de las marcas de tiempo de la traza (microsegundos).
+_T0 = time.perf_counter()
+
+
+class Histogram:
+    """
+    Histograma de latencias en segundos con cubetas de potencias de dos
+    (en microsegundos). Los percentiles son aproximados por exceso.
+    """
+
+    __slots__ = ("count", "total", "min", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        bucket = max(int(seconds * 1_000_000), 0).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, fraction: float) -> float:
+        """Cota superior (segundos) del percentil `fraction` (0-1)."""
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min((1 << bucket) / 1_000_000, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """Resumen en milisegundos."""
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 4),
+            "min_ms": round(self.min * 1000, 4),
+            "p50_ms": round(self.percentile(0.50) * 1000, 4),
+            "p95_ms": round(self.percentile(0.95) * 1000, 4),
+            "p99_ms": round(self.percentile(0.99) * 1000, 4),
+            "max_ms": round(self.max * 1000, 4),
+        }
+
+
+def _us(t: float) -> float:
+    return round((t - _T0) * 1_000_000, 3)
+
+
+def _record_span(name: str, start: float, end: float):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(end - start)
+        _events.append({"name": name, "ph": "X", "ts": _us(start), "dur": round((end - start) * 1_000_000, 3),
+                        "pid": _pid, "tid": threading.get_ident()})
+
+
+def timed(name: str):
+    """
+    Decorador que mide cada llamada en el histograma `name`.
+    Con la instrumentación desactivada devuelve la función original.
+    """
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _record_span(name, start, time.perf_counter())
+        return wrapper
+    return decorate
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        _record_span(self.name, self.start, time.perf_counter())
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str):
+    """Contexto que mide un bloque en el histograma `name`."""
+    return _Span(name) if ENABLED else _NULL_SPAN
+
+
+def observe(name: str, seconds: float):
+    """Agrega una medición ya tomada (p. ej. un retraso) al histograma `name`."""
+    if not ENABLED:
+        return
+    now = time.perf_counter()
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(seconds)
+        _events.append({"name": name, "ph": "C", "ts": _us(now), "pid": _pid,
+                        "args": {"ms": round(seconds * 1000, 3)}})
+
+
+def add_bytes(direction: str, source: str, count: int):
+    """Suma `count` bytes leídos ("read") o escritos ("written") desde `source`."""
+    if not ENABLED or not count:
+        return
+    name = f"bytes.{direction}.{source}"
+    now = time.perf_counter()
+    with _lock:
+        total = _counters[name] = _counters.get(name, 0) + int(count)
+        _events.append({"name": name, "ph": "C", "ts": _us(now), "pid": _pid, "args": {"bytes": total}})
+
+
+def snapshot() -> dict:
+    """Resumen actual: histogramas (ms) y contadores."""
+    with _lock:
+        return {
+            "histograms": {name: h.summary() for name, h in sorted(_histograms.items())},
+            "counters": dict(sorted(_counters.items())),
+        }
+
+
+def reset():
+    """Olvida todas las mediciones."""
+    with _lock:
+        _events.clear()
+        _histograms.clear()
+        _counters.clear()
+
+
+def export(path: str = None) -> str:
+    """Escribe la traza en formato de eventos de Chrome y devuelve la ruta."""
+    path = path or TRACE_FILE
+    summary = snapshot()
+    with _lock:
+        events = list(_events)
+    events.append({"name": "process_name", "ph": "M", "pid": _pid, "args": {"name": "Dosely"}})
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": summary}, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    return path
+
+
+def _export_at_exit():
+    try:
+        export()
+    except OSError:
+        pass
+
+
+if ENABLED:
+    atexit.register(_export_at_exit)
+
+
+def overlay_text(names=None) -> str:
+    """Texto breve para el overlay: p95 y conteo de cada histograma."""
+    summary = snapshot()
+    lines = []
+    for name, stats in summary["histograms"].items():
+        if names and name not in names:
+            continue
+        if stats["count"]:
+            lines.append(f"{name}: p95 {stats['p95_ms']:.1f} ms  n={stats['count']}")
+    for name, total in summary["counters"].items():
+        lines.append(f"{name}: {total / 1024:.1f} KiB")
+    return "\n".join(lines) or "Sin mediciones"
+
+
+def show_overlay(interval: float = 1.0):
+    """
+    Muestra el resumen sobre la ventana de Kivy y lo actualiza cada
+    `interval` segundos. Solo con DOSELY_TRACE_OVERLAY=1.
+    """
+    if not OVERLAY:
+        return None
+    from kivy.clock import Clock
+    from kivy.core.window import Window
+    from kivy.metrics import dp
+    from kivy.uix.label import Label
+
+    label = Label(
+        text=overlay_text(),
+        font_size=dp(11),
+        color=(0.6, 1, 0.6, 1),
+        halign="left",
+        valign="bottom",
+        size_hint=(None, None),
+        padding=(dp(6), dp(6)),
+    )
+
+    def _layout(*_args):
+        label.text_size = (Window.width, None)
+        label.texture_update()
+        label.size = (Window.width, label.texture_size[1])
+        label.pos = (0, 0)
+
+    def _refresh(*_args):
+        label.text = overlay_text()
+        _layout()
+
+    Window.add_widget(label)
+    Window.bind(size=_layout)
+    _layout()
+    Clock.schedule_interval(_refresh, interval)
+    return label
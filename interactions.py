@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Interacciones y duplicidad terapéutica de la lista del usuario.
+
+La tabla local (storage/interacciones.json) tiene tres partes:
+- "sustancias": nombre canónico -> sinónimos y marcas ("aspirina", "aas"...);
+- "grupos": clases terapéuticas (AINE, estatinas...): dos sustancias del
+  mismo grupo en la lista son una duplicidad;
+- "interacciones": pares {"a", "b", "nivel", "mensaje"}; "a" y "b" pueden ser
+  sustancias o grupos.
+
+Al cargarla, cada sustancia recibe un número y las relaciones se guardan como
+máscaras de bits (enteros de Python): por sustancia, sus interacciones y los
+miembros de sus grupos. `Regimen` mantiene la máscara de las sustancias de la
+lista, así que revisar un medicamento nuevo o editado son unas pocas
+operaciones AND, sin recorrer la lista por pares.
+
+Los avisos son orientativos y no reemplazan la consulta con un profesional.
+"""
+import json
+import re
+
+from catalog_index import fold, file_signature
+
+LEVELS = ("grave", "moderada", "leve")
+
+# Separadores de combinaciones ("Paracetamol + cafeína", "A/B").
+_PARTS = re.compile(r"\s*(?:\+|/|,|;|\by\b)\s*")
+
+
+def _bits(mask: int):
+    """Números de los bits encendidos de `mask`."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class InteractionTable:
+    """Tabla de interacciones compilada a números de sustancia y máscaras de bits."""
+
+    def __init__(self, data: dict):
+        self.names = []        # número -> nombre canónico
+        self._ids = {}         # nombre o sinónimo normalizado -> número
+        self.partners = []     # número -> máscara de sustancias con las que interactúa
+        self.classmates = []   # número -> máscara de sustancias de sus grupos (sin ella misma)
+        self.groups = {}       # número -> nombres de sus grupos
+        self._pairs = {}       # (menor, mayor) -> (nivel, mensaje)
+        for name, synonyms in (data.get("sustancias") or {}).items():
+            sid = self._add(name)
+            for synonym in synonyms or ():
+                self._ids.setdefault(fold(synonym), sid)
+
+        members = {}
+        for group, substances in (data.get("grupos") or {}).items():
+            mask = 0
+            for name in substances:
+                mask |= 1 << self._add(name)
+            members[fold(group)] = mask
+            for sid in _bits(mask):
+                self.classmates[sid] |= mask & ~(1 << sid)
+                self.groups.setdefault(sid, []).append(group)
+
+        for rule in data.get("interacciones") or ():
+            level = rule.get("nivel") if rule.get("nivel") in LEVELS else "moderada"
+            message = rule.get("mensaje") or ""
+            side_a = members.get(fold(rule.get("a"))) or 1 << self._add(rule.get("a"))
+            side_b = members.get(fold(rule.get("b"))) or 1 << self._add(rule.get("b"))
+            for a in _bits(side_a):
+                for b in _bits(side_b):
+                    if a == b:
+                        continue
+                    self.partners[a] |= 1 << b
+                    self.partners[b] |= 1 << a
+                    key = (min(a, b), max(a, b))
+                    previous = self._pairs.get(key)
+                    # Si dos reglas cubren el mismo par, gana la más grave.
+                    if previous is None or LEVELS.index(level) < LEVELS.index(previous[0]):
+                        self._pairs[key] = (level, message)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _add(self, name: str) -> int:
+        key = fold(name)
+        sid = self._ids.get(key)
+        if sid is None:
+            sid = self._ids[key] = len(self.names)
+            self.names.append(key)
+            self.partners.append(0)
+            self.classmates.append(0)
+        return sid
+
+    def substance_id(self, text: str):
+        """Número de la sustancia nombrada en `text` ("Losartán potásico" -> losartan), o None."""
+        words = fold(text).split()
+        # Primero el texto completo, después sin las últimas palabras (sales, formas).
+        for end in range(len(words), 0, -1):
+            sid = self._ids.get(" ".join(words[:end]))
+            if sid is not None:
+                return sid
+        return None
+
+    def resolve(self, med: dict) -> int:
+        """Máscara de las sustancias de un medicamento (por nombre y sustancia)."""
+        mask = 0
+        for field in ("sustancia", "nombre"):
+            for part in _PARTS.split(fold(med.get(field))):
+                sid = self.substance_id(part) if part else None
+                if sid is not None:
+                    mask |= 1 << sid
+        return mask
+
+    def pair(self, a: int, b: int):
+        """(nivel, mensaje) de la interacción entre dos sustancias, o None."""
+        return self._pairs.get((min(a, b), max(a, b)))
+
+
+class Regimen:
+    """
+    Sustancias de la lista del usuario como máscara de bits, con los dueños
+    de cada una para poder nombrar con qué medicamento choca un alta.
+    """
+
+    def __init__(self, table: InteractionTable, meds=()):
+        self.table = table
+        self.present = 0
+        self._masks = {}   # id del medicamento -> máscara
+        self._owners = {}  # número de sustancia -> {id: nombre}
+        for med in meds:
+            self.update(med)
+
+    def remove(self, med_id: str):
+        mask = self._masks.pop(med_id, 0)
+        for sid in _bits(mask):
+            owners = self._owners[sid]
+            owners.pop(med_id, None)
+            if not owners:
+                del self._owners[sid]
+                self.present &= ~(1 << sid)
+
+    def update(self, med: dict):
+        """Agrega o reemplaza un medicamento guardado."""
+        med_id = med["id"]
+        self.remove(med_id)
+        mask = self.table.resolve(med)
+        if not mask:
+            return
+        self._masks[med_id] = mask
+        self.present |= mask
+        for sid in _bits(mask):
+            self._owners.setdefault(sid, {})[med_id] = med.get("nombre", "")
+
+    def _others(self, med_id: str) -> int:
+        """Sustancias de la lista sin contar las que solo aporta `med_id`."""
+        present = self.present
+        for sid in _bits(self._masks.get(med_id, 0)):
+            if len(self._owners[sid]) == 1:
+                present &= ~(1 << sid)
+        return present
+
+    def _with(self, sid: int, med_id: str):
+        owners = self._owners.get(sid, {})
+        return [(other, name) for other, name in owners.items() if other != med_id]
+
+    def check(self, entry: dict, med_id: str = None):
+        """
+        Avisos para guardar `entry` (con `med_id` si es una edición), ordenados
+        de más a menos grave. Cada aviso es un diccionario con "tipo"
+        ("misma_sustancia", "duplicidad" o "interaccion"), "nivel", "mensaje"
+        y "medicamentos" (los nombres de la lista con los que choca).
+        """
+        table = self.table
+        mask = table.resolve(entry)
+        if not mask:
+            return []
+        others = self._others(med_id)
+        warnings = []
+        seen = set()
+
+        def warn(kind, level, message, sid):
+            meds = self._with(sid, med_id)
+            key = (kind, sid)
+            if meds and key not in seen:
+                seen.add(key)
+                warnings.append({"tipo": kind, "nivel": level, "mensaje": message, "sustancia": table.names[sid],
+                                 "medicamentos": [name for _id, name in meds], "ids": [i for i, _n in meds]})
+
+        same = mask & others
+        for sid in _bits(same):
+            warn("misma_sustancia", "grave", f"Ya tiene en la lista un medicamento con {table.names[sid]}.", sid)
+        for own in _bits(mask):
+            for sid in _bits(table.classmates[own] & others & ~same):
+                groups = [g for g in table.groups.get(own, ()) if g in table.groups.get(sid, ())]
+                warn("duplicidad", "moderada",
+                     f"Duplicidad terapéutica ({', '.join(groups)}): {table.names[own]} y {table.names[sid]}.", sid)
+            for sid in _bits(table.partners[own] & others):
+                level, message = table.pair(own, sid)
+                warn("interaccion", level, f"{table.names[own]} + {table.names[sid]}: {message}".strip(), sid)
+        warnings.sort(key=lambda w: LEVELS.index(w["nivel"]))
+        return warnings
+
+
+_tables = {}
+
+
+def load_table(path: str) -> InteractionTable:
+    """
+    Tabla compilada de `path`; se vuelve a compilar solo si el archivo
+    cambió. Sin archivo, la tabla está vacía (no hay avisos). Si el archivo
+    está dañado falla con ValueError: no se revisa con una tabla a medias.
+    """
+    signature = file_signature(path)
+    cached = _tables.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    data = {}
+    if signature is not None:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except ValueError as error:
+            raise ValueError(f"{path} no es JSON válido: {error}") from None
+        if not isinstance(data, dict):
+            raise ValueError(f"{path}: se esperaba un objeto con sustancias, grupos e interacciones")
+    try:
+        table = InteractionTable(data)
+    except (AttributeError, TypeError) as error:
+        raise ValueError(f"{path} tiene un formato inválido: {error}") from None
+    _tables[path] = (signature, table)
+    return table
+
+
+def format_warnings(warnings) -> str:
+    """Texto para mostrar los avisos, uno por línea."""
+    lines = []
+    for warning in warnings:
+        meds = ", ".join(warning["medicamentos"])
+        lines.append(f"[{warning['nivel']}] {warning['mensaje']} (en la lista: {meds})")
+    return "\n".join(lines)
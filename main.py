@@ -14,27 +14,53 @@ Ejecución en escritorio:
 
 Este proyecto está pensado para poder compilarse a Android con Buildozer.
 """
+import startup
+
 import os
 import sys
+import time
 from functools import partial
 
 from kivy import require as kivy_require
 kivy_require("2.3.0")
 
 from kivy.lang import Builder
-from kivy.uix.screenmanager import ScreenManager
+from kivy.factory import Factory
+from kivy.logger import Logger
 from kivy.clock import Clock
 from kivy.core.window import Window
 from kivy.utils import platform
 from kivy.metrics import dp
 
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+startup.mark("importar kivy")
+
 from kivymd.app import MDApp
 from kivymd.uix.list import TwoLineListItem
 from kivymd.toast import toast
-from kivymd.uix.menu import MDDropdownMenu
+startup.mark("importar kivymd")
 
+# notify (plyer), MDDropdownMenu y la tubería de búsqueda se importan al
+# usarse por primera vez para no demorar el arranque.
+import async_backend
 import backend
-import notify
+import instrumentation
+import models
+from catalog_index import ResultSet
+startup.mark("importar dosely")
+
+
+class CatalogResultItem(RecycleDataViewBehavior, TwoLineListItem):
+    """
+    Fila de resultados del catálogo. Los datos del RecycleView solo guardan el
+    id del producto; el registro se decodifica cuando la fila se hace visible.
+    """
+
+    def refresh_view_attrs(self, rv, index, data):
+        if "item_id" in data:
+            app = MDApp.get_running_app()
+            data = app._result_row(data["catalog"].item(data["item_id"]))
+        return super().refresh_view_attrs(rv, index, data)
 
 
 class DoselyApp(MDApp):
@@ -45,8 +71,15 @@ class DoselyApp(MDApp):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self._edit_index = None
+        self._edit_id = None
         self._reminder_handles = {}
+        self._home_rows = {}
+        self._pending_query = ""
+        self._search_trigger = Clock.create_trigger(self._run_search, 0.15)
+        self._search_pipeline = None
+        self._notify_lost_seen = 0
+        self._home_request = 0
+        self._saving = False
 
     def build(self):
         # Estilo Material 3 y tema oscuro con colores suaves.
@@ -68,73 +101,115 @@ class DoselyApp(MDApp):
         self.theme_cls.primary_hue = "500"
         self.theme_cls.accent_palette = "Gray"
         self.theme_cls.accent_hue = "50"
-        # Cargar archivo .kv
-        return Builder.load_file("ui.kv")
-
-    @staticmethod
-    def _format_number(value):
-        if value in (None, ""):
-            return ""
-        try:
-            number = float(value)
-        except (TypeError, ValueError):
-            return str(value)
-        if abs(number - int(number)) < 1e-9:
-            return str(int(number))
-        text = f"{number:.6g}"
-        return text.rstrip("0").rstrip(".") if "." in text else text
+        # Cargar archivo .kv (solo se construye la pantalla de inicio; el
+        # resto se crea al abrirse por primera vez, ver _screen).
+        root = Builder.load_file("ui.kv")
+        startup.mark("construir interfaz")
+        return root
 
     def on_start(self):
         """
-        Inicializa almacenamiento, crea archivos si faltan y refresca la pantalla de inicio.
+        Refresca la pantalla de inicio en el primer frame.
+        El almacenamiento se prepara al leer la lista (migra el JSON legado si
+        hace falta) y el catálogo recién al abrir la búsqueda.
         """
-        backend.ensure_storage()
-        # Asegurar que el catálogo base exista; si no, crearlo con ejemplos.
-        if not os.path.exists(backend.CATALOG_FILE):
-            backend.initialize_default_catalog()
-        # Crear medicamentos.json si no existe.
-        if not os.path.exists(backend.MEDS_FILE):
-            backend.initialize_empty_meds()
-        # Poblar lista de inicio
-        Clock.schedule_once(lambda *_: self.refresh_home(), 0.05)
+        startup.mark("iniciar ventana")
+        Clock.schedule_once(self._first_refresh, 0)
+        # Solo con DOSELY_TRACE=1 y DOSELY_TRACE_OVERLAY=1 (ver instrumentation.py).
+        instrumentation.show_overlay()
+
+    def on_stop(self):
+        # Terminar las escrituras pendientes antes de salir.
+        async_backend.shutdown(wait=True)
+
+    def on_resume(self):
+        # Al volver a primer plano, avisar si hubo recordatorios que no se mostraron.
+        self._report_lost_notifications()
+
+    def _report_lost_notifications(self):
+        notify = sys.modules.get("notify")  # solo si ya se programó alguno
+        if notify is None:
+            return
+        stats = notify.dispatcher_stats()
+        lost = stats["failed"] + stats["rejected"]
+        if lost > self._notify_lost_seen:
+            toast(f"{lost - self._notify_lost_seen} recordatorio(s) no se pudieron mostrar")
+        self._notify_lost_seen = lost
+
+    def _first_refresh(self, *_args):
+        self.refresh_home(on_done=self._startup_done)
+
+    def _startup_done(self):
+        startup.mark("primer refresco de inicio")
+        startup.finish(Logger.info)
 
     # ------------------------
     # Navegación
     # ------------------------
+    # Pantallas definidas en ui.kv que se construyen bajo demanda.
+    _SCREEN_CLASSES = {
+        "search": "SearchScreen",
+        "add": "AddScreen",
+        "edit": "EditScreen",
+    }
+
+    def _screen(self, name):
+        """Devuelve la pantalla `name`, construyéndola la primera vez que se usa."""
+        if not self.root.has_screen(name):
+            self.root.add_widget(Factory.get(self._SCREEN_CLASSES[name])())
+        return self.root.get_screen(name)
+
+    def _show(self, name):
+        self._screen(name)
+        self.root.current = name
+
+    def _get_search_pipeline(self):
+        if self._search_pipeline is None:
+            from search_pipeline import SearchPipeline
+            self._search_pipeline = SearchPipeline(self._on_search_results)
+        return self._search_pipeline
+
     def open_search(self):
-        self.root.current = "search"
+        self._show("search")
         self.clear_search()
-        # Mostrar todo el catálogo inicialmente
-        catalog = backend.load_catalog()
-        self.populate_search_results(catalog)
+        # Mostrar todo el catálogo inicialmente, sin esperar al debounce.
+        # El catálogo se abre (o se crea e indexa) en el hilo de búsqueda.
+        self._search_trigger.cancel()
+        self._get_search_pipeline().submit("")
 
     def open_add(self, prefill=None):
-        self._edit_index = None
-        self.root.current = "add"
+        self._edit_id = None
+        self._show("add")
         self._populate_form("add", prefill or {})
 
-    def open_edit(self, index, *_args):
-        meds = backend.load_meds()
-        if not (0 <= index < len(meds)):
+    def open_edit(self, med_id, *_args):
+        async_backend.get_med(
+            med_id,
+            on_done=partial(self._show_edit, med_id),
+            on_error=lambda e: toast(f"No se pudo abrir el medicamento: {e}"),
+        )
+
+    def _show_edit(self, med_id, med):
+        if med is None:
             toast("No se encontró el medicamento seleccionado")
             return
-        self._edit_index = index
-        self._populate_form("edit", meds[index])
-        self.root.current = "edit"
+        self._edit_id = med_id
+        self._populate_form("edit", med)
+        self._show("edit")
         
     def _populate_form(self, screen_name, data):
-        screen = self.root.get_screen(screen_name)
+        screen = self._screen(screen_name)
         ids = screen.ids
         entry = data or {}
 
         ids.name_field.text = entry.get("nombre", "")
         ids.subs_field.text = entry.get("sustancia", "")
-        ids.mg_field.text = self._format_number(entry.get("mg"))
+        ids.mg_field.text = models.format_number(entry.get("mg"))
         ids.rx_switch.active = bool(entry.get("requiere_receta", False))
         ids.notes_field.text = entry.get("notas", "")
 
         reminder = entry.get("recordatorio") or {}
-        ids.delay_field.text = self._format_number(reminder.get("intervalo"))
+        ids.delay_field.text = models.format_number(reminder.get("intervalo"))
         unit_label = reminder.get("unidad", "horas") or "horas"
         ids.unit_item.text = unit_label
 
@@ -142,7 +217,7 @@ class DoselyApp(MDApp):
         """Ensure form screens open at the top position with no focus."""
         def _apply(_dt):
             try:
-                screen = self.root.get_screen(screen_name)
+                screen = self._screen(screen_name)
                 scroll = screen.ids.get("form_scroll")
                 if scroll:
                     scroll.scroll_y = 1
@@ -158,215 +233,281 @@ class DoselyApp(MDApp):
         self.root.current = "home"
 
     def back_to_search(self):
-        self.root.current = "search"
+        self._show("search")
 
     # ------------------------
     # Home
     # ------------------------
-    def refresh_home(self):
+    def refresh_home(self, on_done=None):
+        """
+        Carga los medicamentos guardados en el hilo de E/S y los muestra en
+        HomeScreen (ver _show_home). `on_done()` se llama tras mostrarlos.
+        """
+        self._home_request += 1
+        async_backend.load_medications(
+            on_done=partial(self._show_home, self._home_request, on_done),
+            on_error=lambda e: toast(f"No se pudo cargar la lista: {e}"),
+        )
+
+    @instrumentation.timed("ui.refresh_home")
+    def _show_home(self, request, on_done, meds):
         """
-        Carga medicamentos guardados y los muestra en HomeScreen.
+        La lista es un RecycleView: solo se crean widgets para las filas visibles,
+        y si el orden no cambió solo se reemplazan las filas modificadas.
         """
-        meds = backend.load_meds()
+        if request != self._home_request:
+            # Llegó una lectura más nueva: esta ya no sirve.
+            return
+        self._fill_home(meds)
+        if on_done is not None:
+            on_done()
+
+    def _fill_home(self, meds):
         home = self.root.get_screen("home")
         list_widget = home.ids.meds_list
-        list_widget.clear_widgets()
 
         if not meds:
             # Estado vacío
-            item = TwoLineListItem(
-                text="No hay medicamentos guardados",
-                secondary_text="Use el botón + para añadir",
-                disabled=True,
-            )
-            list_widget.add_widget(item)
+            self._home_rows = {}
+            list_widget.data = [self._placeholder_row(
+                "No hay medicamentos guardados",
+                "Use el botón + para añadir",
+            )]
             return
 
-        for idx, med in enumerate(meds):
-            nombre = med.get("nombre", "Desconocido")
-            sust = med.get("sustancia", "")
-            mg = med.get("mg")
-            mg_txt_val = self._format_number(mg)
-            mg_txt = f"{mg_txt_val} mg" if mg_txt_val else ""
-            receta = " • Requiere receta" if med.get("requiere_receta") else ""
-            reminder = med.get("recordatorio") or {}
-            reminder_txt = ""
-            if reminder.get("intervalo"):
-                interval_txt = self._format_number(reminder.get("intervalo"))
-                unit_txt = reminder.get("unidad", "horas")
-                reminder_txt = f" • Cada {interval_txt} {unit_txt}"
-            primary = f"{nombre} {mg_txt}".strip()
-            secondary = f"{sust}{receta}{reminder_txt}".strip()
-
-            item = TwoLineListItem(
-                text=primary if primary else nombre,
-                secondary_text=secondary if secondary else "",
-                on_release=partial(self.open_edit, idx),
-            )
-            list_widget.add_widget(item)
+        rows = []
+        cache = {}
+        for med in meds:
+            med_id = med.id
+            cached = self._home_rows.get(med_id)
+            # El repositorio devuelve el mismo registro si el medicamento no cambió.
+            row = cached[1] if cached and cached[0] is med else self._med_row(med)
+            cache[med_id] = (med, row)
+            rows.append(row)
+
+        old_ids = list(self._home_rows)
+        self._home_rows = cache
+        if old_ids == list(cache) and len(list_widget.data) == len(rows):
+            # Diff por id: mismo orden, se actualizan solo las filas cambiadas.
+            for pos, row in enumerate(rows):
+                if list_widget.data[pos] is not row:
+                    list_widget.data[pos] = row
+            return
+        list_widget.data = rows
+
+    @staticmethod
+    def _placeholder_row(text, secondary_text):
+        # Las filas se reciclan: todas deben definir las mismas claves.
+        return {
+            "text": text,
+            "secondary_text": secondary_text,
+            "disabled": True,
+            "on_release": lambda *_: None,
+        }
+
+    def _med_row(self, med):
+        return {
+            "text": med.title,
+            "secondary_text": med.subtitle,
+            "disabled": False,
+            "on_release": partial(self.open_edit, med.id),
+        }
 
     # ------------------------
     # Búsqueda
     # ------------------------
     def clear_search(self):
-        search_screen = self.root.get_screen("search")
+        search_screen = self._screen("search")
         search_screen.ids.search_field.text = ""
-        search_screen.ids.results_list.clear_widgets()
+        search_screen.ids.results_list.data = []
 
     def filter_search(self, query):
         """
         Filtra catálogo por nombre o sustancia.
+        La búsqueda espera a que el usuario deje de escribir y corre fuera del hilo de la UI.
         """
-        results = backend.search_catalog(query or "")
+        self._pending_query = query or ""
+        self._search_trigger.cancel()
+        self._search_trigger()
+
+    def _run_search(self, *_args):
+        self._get_search_pipeline().submit(self._pending_query)
+
+    def _on_search_results(self, generation, _query, results):
+        # Llamado desde el hilo de búsqueda: volver al hilo principal.
+        Clock.schedule_once(partial(self._apply_search_results, generation, results))
+
+    def _apply_search_results(self, generation, results, *_args):
+        # Descartar resultados de consultas ya superadas.
+        if not self._get_search_pipeline().is_current(generation):
+            return
         self.populate_search_results(results)
 
+    @instrumentation.timed("ui.populate_search_results")
     def populate_search_results(self, results):
         """
         Llena la lista de resultados con items tocables que abren la pantalla de Añadir.
         """
-        search_screen = self.root.get_screen("search")
+        search_screen = self._screen("search")
         list_widget = search_screen.ids.results_list
-        list_widget.clear_widgets()
+
+        from search_pipeline import FailedSearch
+        if isinstance(results, FailedSearch):
+            list_widget.data = [self._placeholder_row(
+                "No se pudo buscar en el catálogo",
+                "Intente de nuevo en unos segundos",
+            )]
+            return
 
         if not results:
-            item = TwoLineListItem(
-                text="Sin resultados",
-                secondary_text="Pruebe con otro término de búsqueda o",
-                disabled=True,
-            )
-            list_widget.add_widget(item)
+            list_widget.data = [self._placeholder_row(
+                "Sin resultados",
+                "Pruebe con otro término de búsqueda o",
+            )]
             return
 
-        for r in results:
-            nombre = r.get("nombre", "")
-            sust = r.get("sustancia", "")
-            mg = r.get("mg")
-            mg_txt_val = self._format_number(mg)
-            mg_txt = f"{mg_txt_val} mg" if mg_txt_val else ""
-            primary = f"{nombre} {mg_txt}".strip()
-            secondary = sust
-
-            item = TwoLineListItem(
-                text=primary if primary else nombre,
-                secondary_text=secondary,
-                on_release=partial(self._open_add_from_result, r),
-            )
-            list_widget.add_widget(item)
+        if isinstance(results, ResultSet):
+            # Decodificación perezosa: ver CatalogResultItem.
+            list_widget.data = [{"catalog": results.index, "item_id": i} for i in results.ids]
+        else:
+            list_widget.data = [self._result_row(r) for r in results]
+        list_widget.scroll_y = 1
+
+    def _result_row(self, r):
+        item = models.CatalogItem.from_dict(r)
+        return {
+            "text": item.title,
+            "secondary_text": item.subtitle,
+            "disabled": False,
+            "on_release": partial(self._open_add_from_result, item),
+        }
 
-    def _open_add_from_result(self, entry, *_args):
+    def _open_add_from_result(self, item, *_args):
         """
         Abre AddScreen con datos prellenados del catálogo.
         """
-        # Asegurar campos esperados
-        prefill = {
-            "nombre": entry.get("nombre", ""),
-            "sustancia": entry.get("sustancia", ""),
-            "mg": entry.get("mg", ""),
-            "requiere_receta": entry.get("requiere_receta", False),
-            "notas": "",
-        }
-        self.open_add(prefill=prefill)
+        self.open_add(prefill=item.prefill())
 
     # ------------------------
     # Guardado
     # ------------------------
     def save_med(self, screen_name="add"):
-        """Valida y guarda un medicamento desde la pantalla indicada."""
+        """
+        Valida y guarda un medicamento desde la pantalla indicada.
+        La revisión de interacciones y la escritura corren en el hilo de E/S;
+        la pantalla cambia al terminar.
+        """
+        if self._saving:
+            # Ya hay un guardado en curso (doble toque).
+            return
         entry = self._collect_entry_from_form(screen_name)
         if entry is None:
             return
+        med_id = None
+        if screen_name == "edit":
+            if self._edit_id is None:
+                toast("No hay un medicamento seleccionado para editar")
+                return
+            med_id = self._edit_id
+
+        # Antes de escribir se revisan interacciones y duplicados con el resto
+        # de la lista; si hay avisos, el usuario decide si guarda igual.
+        self._saving = True
+        async_backend.check_interactions(
+            entry, med_id,
+            on_done=partial(self._on_interactions_checked, entry, med_id),
+            on_error=partial(self._on_interactions_failed, entry, med_id),
+        )
+
+    def _on_interactions_checked(self, entry, med_id, warnings):
+        if not warnings:
+            self._write_med(entry, med_id)
+            return
+        self._saving = False
+        import interactions
+        self._confirm_save(entry, med_id, "Revise antes de guardar", interactions.format_warnings(warnings))
+
+    def _on_interactions_failed(self, entry, med_id, error):
+        # Sin revisión no se guarda en silencio: decide el usuario.
+        self._saving = False
+        self._confirm_save(entry, med_id, "No se pudo revisar interacciones",
+                           f"{error}\n\n¿Guardar de todos modos?")
+
+    def _confirm_save(self, entry, med_id, title, text):
+        from kivymd.uix.button import MDFlatButton
+        from kivymd.uix.dialog import MDDialog
+
+        def close(*_args):
+            dialog.dismiss()
+
+        def save_anyway(*_args):
+            dialog.dismiss()
+            if not self._saving:
+                self._saving = True
+                self._write_med(entry, med_id)
+
+        dialog = MDDialog(
+            title=title,
+            text=text,
+            buttons=[
+                MDFlatButton(text="Cancelar", on_release=close),
+                MDFlatButton(text="Guardar igual", on_release=save_anyway),
+            ],
+        )
+        dialog.open()
+
+    def _write_med(self, entry, med_id):
+        if med_id is not None:
+            on_done = partial(self._on_saved, entry, "Medicamento actualizado", med_id)
+            async_backend.update_med(med_id, entry, on_done=on_done, on_error=self._on_save_failed)
+        else:
+            on_done = partial(self._on_saved, entry, "Medicamento guardado", None)
+            async_backend.add_med(entry, on_done=on_done, on_error=self._on_save_failed)
+
+    def _on_saved(self, entry, toast_msg, med_id, result):
+        self._saving = False
+        med_id = med_id or result
+        reminder = entry.get("recordatorio") or {}
+        delay_txt = models.format_number(reminder.get("intervalo"))
+        summary_unit = reminder.get("unidad", "horas")
 
         try:
-            if screen_name == "edit":
-                if self._edit_index is None:
-                    toast("No hay un medicamento seleccionado para editar")
-                    return
-                backend.update_med(self._edit_index, entry)
-                index = self._edit_index
-                toast_msg = "Medicamento actualizado"
-            else:
-                index = backend.add_med(entry)
-                toast_msg = "Medicamento guardado"
-
-            reminder = entry.get("recordatorio") or {}
-            delay_txt = self._format_number(reminder.get("intervalo"))
-            summary_unit = reminder.get("unidad", "horas")
+            self._schedule_reminder_for_entry(med_id, entry)
+        except Exception as reminder_error:
+            toast(f"Guardado, pero el recordatorio falló: {reminder_error}")
+        else:
+            toast(f"{toast_msg}. Recordatorio cada {delay_txt} {summary_unit}")
 
-            try:
-                self._schedule_reminder_for_entry(index, entry)
-            except Exception as reminder_error:
-                toast(f"Guardado, pero el recordatorio falló: {reminder_error}")
-            else:
-                toast(f"{toast_msg}. Recordatorio cada {delay_txt} {summary_unit}")
-
-            self._edit_index = None
-            self.back_to_home()
-            self.refresh_home()
-        except Exception as e:
-            toast(f"Error al guardar: {e}")
+        self._edit_id = None
+        self.back_to_home()
+        self.refresh_home()
+
+    def _on_save_failed(self, error):
+        self._saving = False
+        toast(f"Error al guardar: {error}")
 
     def _collect_entry_from_form(self, screen_name):
-        screen = self.root.get_screen(screen_name)
+        screen = self._screen(screen_name)
         ids = screen.ids
 
-        nombre = (ids.name_field.text or "").strip()
-        sust = (ids.subs_field.text or "").strip()
-        mg_text = (ids.mg_field.text or "").strip().replace(",", ".")
-        rx = bool(ids.rx_switch.active)
-        notas = (ids.notes_field.text or "").strip()
-        delay_text = (ids.delay_field.text or "").strip().replace(",", ".")
-        unit_label = (ids.unit_item.text or "horas").strip().lower()
-
-        if not delay_text:
-            toast("Indique cada cuántas horas se repetirá el recordatorio")
-            return None
         try:
-            delay_value = float(delay_text)
-        except ValueError:
-            toast("Ingrese un valor numérico válido para el recordatorio")
-            return None
-        if delay_value <= 0:
-            toast("El recordatorio debe ser mayor que 0")
-            return None
-
-        if not nombre:
-            toast("El nombre es obligatorio")
+            med = models.Medication.from_form(
+                nombre=ids.name_field.text,
+                sustancia=ids.subs_field.text,
+                mg=ids.mg_field.text,
+                requiere_receta=ids.rx_switch.active,
+                notas=ids.notes_field.text,
+                intervalo=ids.delay_field.text,
+                unidad=(ids.unit_item.text or "horas"),
+                # El temporizador se vuelve a armar al guardar.
+                inicio=time.time(),
+            )
+        except ValueError as error:
+            toast(str(error))
             return None
+        return med.to_dict()
 
-        mg = None
-        if mg_text:
-            try:
-                mg_value = float(mg_text)
-            except ValueError:
-                toast("Ingrese un valor numérico válido para mg")
-                return None
-            mg = int(mg_value) if abs(mg_value - int(mg_value)) < 1e-9 else mg_value
-
-        unit_label = "dias" if unit_label.startswith("dia") else "horas"
-        unit_en = "days" if unit_label == "dias" else "hours"
-        delay_clean = int(delay_value) if abs(delay_value - int(delay_value)) < 1e-9 else delay_value
-
-        message = f"Recordatorio de {nombre}" if nombre else "Recordatorio de medicación"
-        reminder = {
-            "intervalo": delay_clean,
-            "unidad": unit_label,
-            "unidad_en": unit_en,
-            "intervalo_horas": delay_clean if unit_en == "hours" else delay_clean * 24,
-            "mensaje": message,
-            "repetir": True,
-        }
-
-        entry = {
-            "nombre": nombre,
-            "sustancia": sust,
-            "mg": mg,
-            "requiere_receta": rx,
-            "notas": notas,
-            "recordatorio": reminder,
-        }
-        return entry
-
-    def _schedule_reminder_for_entry(self, index, entry):
+    def _schedule_reminder_for_entry(self, med_id, entry):
         reminder = entry.get("recordatorio") or {}
         intervalo = reminder.get("intervalo")
         unidad_en = reminder.get("unidad_en")
@@ -376,17 +517,43 @@ class DoselyApp(MDApp):
         if not intervalo or not unidad_en:
             return None
 
-        previous = self._reminder_handles.pop(index, None)
+        previous = self._reminder_handles.pop(med_id, None)
         if previous and hasattr(previous, "cancel"):
             try:
                 previous.cancel()
             except Exception:
                 pass
 
+        import notify
         handler = notify.schedule_notification(intervalo, unidad_en, "Dosely", mensaje, repeat=repetir)
-        self._reminder_handles[index] = handler
+        self._reminder_handles[med_id] = handler
         return handler
 
+    def mark_dose_taken(self):
+        """Registra en el historial una toma del medicamento que se está editando."""
+        if self._edit_id is None:
+            toast("No hay un medicamento seleccionado")
+            return
+        async_backend.submit(
+            self._record_taken,
+            self._edit_id,
+            on_done=self._on_dose_recorded,
+            on_error=lambda e: toast(f"No se pudo registrar la toma: {e}"),
+        )
+
+    @staticmethod
+    def _record_taken(med_id):
+        # En el hilo de E/S: devuelve la toma anterior y registra la nueva.
+        previous = backend.last_dose(med_id)
+        backend.record_dose(med_id, "taken")
+        return previous
+
+    def _on_dose_recorded(self, previous):
+        if previous:
+            toast(f"Toma registrada. Anterior: {time.strftime('%d/%m %H:%M', time.localtime(previous))}")
+        else:
+            toast("Toma registrada")
+
     def ensure_visible(self, screen_name, widget, padding=140):
         """Scroll the screen's ScrollView so `widget` is visible when the soft keyboard shows.
         On desktop (no soft keyboard), do nothing to avoid jumping.
@@ -396,7 +563,7 @@ class DoselyApp(MDApp):
             is_desktop = platform in ("win", "linux", "macosx")
             if is_desktop and getattr(Window, "keyboard_height", 0) == 0:
                 return
-            screen = self.root.get_screen(screen_name)
+            screen = self._screen(screen_name)
             scroll = screen.ids.get("form_scroll") or screen.ids.get("add_scroll") or screen.ids.get("scroll")
             if scroll and widget:
                 Clock.schedule_once(lambda *_: scroll.scroll_to(widget, padding=dp(padding), animate=True), 0)
@@ -424,6 +591,7 @@ class DoselyApp(MDApp):
                 "on_release": partial(self._select_unit, caller, label),
             })
         try:
+            from kivymd.uix.menu import MDDropdownMenu
             self._unit_menu = MDDropdownMenu(
                 caller=caller,
                 items=items,
@@ -445,7 +613,7 @@ class DoselyApp(MDApp):
     def schedule_from_add(self):
         """Programa un recordatorio recurrente desde la pantalla de alta."""
         try:
-            add_screen = self.root.get_screen("add")
+            add_screen = self._screen("add")
             delay_txt = (add_screen.ids.delay_field.text or "").strip().replace(",", ".")
             if not delay_txt:
                 toast("Ingrese un tiempo para el recordatorio")
@@ -467,6 +635,7 @@ class DoselyApp(MDApp):
             message = f"Recordatorio de {nombre}" if nombre else "Recordatorio de medicación"
 
             delay_clean = int(delay) if abs(delay - int(delay)) < 1e-9 else delay
+            import notify
             notify.schedule_notification(delay_clean, unit_en, "Dosely", message, repeat=True)
             toast(f"Recordatorio programado cada {delay_clean} {unit_label}")
         except Exception as e:
@@ -480,6 +649,7 @@ class DoselyApp(MDApp):
         Dispara una notificación inmediata y programa otra a los 5 segundos.
         """
         try:
+            import notify
             notify.send_notification("Dosely", "Este es un recordatorio de prueba")
             notify.schedule_notification(0.002, "hours", "Dosely", "Recordatorio programado (0.002h)")
             toast("Notificaciones enviadas")
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Registros de Dosely: `Medication`, `Reminder` y `CatalogItem`.
+
+Son clases con __slots__ (sin __dict__ por instancia) que reemplazan a los
+diccionarios anidados en la interfaz:
+- el constructor valida y normaliza los datos (formularios, línea de comandos)
+  y falla con ValueError y un mensaje para el usuario;
+- `from_dict()` convierte lo que ya está guardado sin volver a validarlo, y
+  `to_dict()` produce el mismo formato JSON de medicamentos.json (las claves
+  desconocidas se conservan);
+- los textos que muestra la lista (`title`, `subtitle`, ...) se calculan una
+  sola vez y quedan guardados en el registro.
+
+Los registros no se modifican: `replace()` devuelve una copia con cambios.
+"""
+import math
+
+HOURS = "horas"
+DAYS = "dias"
+_UNITS_EN = {HOURS: "hours", DAYS: "days"}
+
+
+def format_number(value) -> str:
+    """Número para mostrar: sin decimales de más ("8", "0.5", "12.25")."""
+    if value in (None, ""):
+        return ""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return str(value)
+    if not math.isfinite(number):
+        return str(value)
+    if abs(number - int(number)) < 1e-9:
+        return str(int(number))
+    text = f"{number:.6g}"
+    return text.rstrip("0").rstrip(".") if "." in text else text
+
+
+def compact_number(number: float):
+    """Entero si no tiene parte decimal (8.0 -> 8), si no el mismo float."""
+    if not math.isfinite(number):
+        return number
+    return int(number) if abs(number - int(number)) < 1e-9 else number
+
+
+def parse_number(text, error: str):
+    """Número escrito por el usuario (acepta coma decimal); ValueError(`error`) si no lo es."""
+    try:
+        if isinstance(text, (int, float)) and not isinstance(text, bool):
+            number = float(text)
+        else:
+            number = float(str(text).strip().replace(",", "."))
+    except (ValueError, OverflowError):
+        raise ValueError(error) from None
+    # "inf", "nan" o "1e999" no son cantidades válidas.
+    if not math.isfinite(number):
+        raise ValueError(error)
+    return compact_number(number)
+
+
+def normalize_unit(unidad) -> str:
+    """"horas" o "dias" (acepta "día", "Dias", "days"...)."""
+    text = str(unidad or "").strip().lower()
+    return DAYS if text.startswith(("dia", "día", "day")) else HOURS
+
+
+class Reminder:
+    """Recordatorio periódico de un medicamento."""
+
+    __slots__ = ("intervalo", "unidad", "mensaje", "repetir", "inicio", "extra", "_text")
+
+    def __init__(self, intervalo, unidad: str = HOURS, mensaje: str = None, repetir: bool = True,
+                 inicio: float = None, nombre: str = ""):
+        intervalo = parse_number(intervalo, "Ingrese un valor numérico válido para el recordatorio")
+        if intervalo <= 0:
+            raise ValueError("El recordatorio debe ser mayor que 0")
+        self.intervalo = intervalo
+        self.unidad = normalize_unit(unidad)
+        self.mensaje = mensaje or (f"Recordatorio de {nombre}" if nombre else "Recordatorio de medicación")
+        self.repetir = bool(repetir)
+        self.inicio = None if inicio is None else round(float(inicio), 3)
+        self.extra = None
+        self._text = None
+
+    @property
+    def unidad_en(self) -> str:
+        return _UNITS_EN[self.unidad]
+
+    @property
+    def hours(self) -> float:
+        """Intervalo en horas."""
+        return self.intervalo * 24 if self.unidad == DAYS else self.intervalo
+
+    @property
+    def seconds(self) -> float:
+        return self.hours * 3600.0
+
+    @property
+    def text(self) -> str:
+        """"Cada 8 horas"."""
+        if self._text is None:
+            self._text = f"Cada {format_number(self.intervalo)} {self.unidad}"
+        return self._text
+
+    @classmethod
+    def from_dict(cls, data):
+        """Recordatorio guardado, o None si no tiene intervalo válido."""
+        if not data:
+            return None
+        try:
+            intervalo = float(data.get("intervalo") or 0)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        if not math.isfinite(intervalo) or intervalo <= 0:
+            return None
+        intervalo = compact_number(intervalo)
+        reminder = cls.__new__(cls)
+        reminder.intervalo = intervalo
+        unidad = data.get("unidad")
+        if unidad is None:
+            unidad = DAYS if data.get("unidad_en") == "days" else HOURS
+        reminder.unidad = normalize_unit(unidad)
+        reminder.mensaje = data.get("mensaje") or "Recordatorio de medicación"
+        reminder.repetir = bool(data.get("repetir", True))
+        inicio = data.get("inicio")
+        reminder.inicio = float(inicio) if isinstance(inicio, (int, float)) else None
+        extra = {k: v for k, v in data.items() if k not in _REMINDER_KEYS}
+        reminder.extra = extra or None
+        reminder._text = None
+        return reminder
+
+    def to_dict(self) -> dict:
+        data = {
+            "intervalo": self.intervalo,
+            "unidad": self.unidad,
+            "unidad_en": self.unidad_en,
+            "intervalo_horas": compact_number(float(self.hours)),
+            "mensaje": self.mensaje,
+            "repetir": self.repetir,
+        }
+        if self.inicio is not None:
+            data["inicio"] = self.inicio
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __eq__(self, other):
+        return isinstance(other, Reminder) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"Reminder({self.intervalo!r}, {self.unidad!r})"
+
+
+_REMINDER_KEYS = frozenset(("intervalo", "unidad", "unidad_en", "intervalo_horas", "mensaje", "repetir", "inicio"))
+
+
+class Medication:
+    """Medicamento de la lista del usuario."""
+
+    __slots__ = ("id", "nombre", "sustancia", "mg", "requiere_receta", "notas", "recordatorio", "extra",
+                 "_title", "_subtitle")
+
+    def __init__(self, nombre: str, sustancia: str = "", mg=None, requiere_receta: bool = False,
+                 notas: str = "", recordatorio: Reminder = None, id: str = None):
+        nombre = (nombre or "").strip()
+        if not nombre:
+            raise ValueError("El nombre es obligatorio")
+        if mg not in (None, ""):
+            mg = parse_number(mg, "Ingrese un valor numérico válido para mg")
+            if mg < 0:
+                raise ValueError("Los mg no pueden ser negativos")
+        else:
+            mg = None
+        if recordatorio is not None and not isinstance(recordatorio, Reminder):
+            raise ValueError("Recordatorio inválido")
+        self.id = id or None
+        self.nombre = nombre
+        self.sustancia = (sustancia or "").strip()
+        self.mg = mg
+        self.requiere_receta = bool(requiere_receta)
+        self.notas = (notas or "").strip()
+        self.recordatorio = recordatorio
+        self.extra = None
+        self._title = None
+        self._subtitle = None
+
+    @classmethod
+    def from_form(cls, nombre, sustancia, mg, requiere_receta, notas, intervalo, unidad, inicio: float = None,
+                  id: str = None):
+        """Medicamento a partir de los textos del formulario (ValueError con el mensaje a mostrar)."""
+        if not str(intervalo or "").strip():
+            raise ValueError("Indique cada cuántas horas se repetirá el recordatorio")
+        reminder = Reminder(intervalo, unidad, inicio=inicio, nombre=(nombre or "").strip())
+        return cls(nombre, sustancia, mg, requiere_receta, notas, reminder, id=id)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Convierte un medicamento guardado (sin validar: ya pasó por el constructor)."""
+        med = cls.__new__(cls)
+        med.id = data.get("id")
+        med.nombre = data.get("nombre") or ""
+        med.sustancia = data.get("sustancia") or ""
+        mg = data.get("mg")
+        med.mg = None if mg in (None, "") else mg
+        med.requiere_receta = bool(data.get("requiere_receta", False))
+        med.notas = data.get("notas") or ""
+        med.recordatorio = Reminder.from_dict(data.get("recordatorio"))
+        extra = {k: v for k, v in data.items() if k not in _MEDICATION_KEYS}
+        med.extra = extra or None
+        med._title = None
+        med._subtitle = None
+        return med
+
+    def to_dict(self) -> dict:
+        data = {
+            "nombre": self.nombre,
+            "sustancia": self.sustancia,
+            "mg": self.mg,
+            "requiere_receta": self.requiere_receta,
+            "notas": self.notas,
+        }
+        if self.recordatorio is not None:
+            data["recordatorio"] = self.recordatorio.to_dict()
+        if self.extra:
+            data.update(self.extra)
+        if self.id:
+            data["id"] = self.id
+        return data
+
+    def replace(self, **changes):
+        """Copia con los campos indicados cambiados (sin validar de nuevo)."""
+        unknown = set(changes) - _MEDICATION_KEYS - {"extra"}
+        if unknown:
+            raise TypeError(f"Campos desconocidos: {', '.join(sorted(unknown))}")
+        med = Medication.__new__(Medication)
+        for name in self.__slots__:
+            setattr(med, name, changes.get(name, getattr(self, name)) if name[0] != "_" else None)
+        return med
+
+    @property
+    def mg_text(self) -> str:
+        """"400 mg" o ""."""
+        number = format_number(self.mg)
+        return f"{number} mg" if number else ""
+
+    @property
+    def title(self) -> str:
+        """Primera línea de la lista: nombre y mg."""
+        if self._title is None:
+            self._title = f"{self.nombre} {self.mg_text}".strip() or self.nombre or "Desconocido"
+        return self._title
+
+    @property
+    def subtitle(self) -> str:
+        """Segunda línea: sustancia, receta y recordatorio."""
+        if self._subtitle is None:
+            receta = " • Requiere receta" if self.requiere_receta else ""
+            reminder = f" • {self.recordatorio.text}" if self.recordatorio else ""
+            self._subtitle = f"{self.sustancia}{receta}{reminder}".strip()
+        return self._subtitle
+
+    def __eq__(self, other):
+        return isinstance(other, Medication) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"Medication({self.nombre!r}, id={self.id!r})"
+
+
+_MEDICATION_KEYS = frozenset(("id", "nombre", "sustancia", "mg", "requiere_receta", "notas", "recordatorio"))
+
+
+class CatalogItem:
+    """Producto del catálogo base."""
+
+    __slots__ = ("nombre", "sustancia", "mg", "requiere_receta", "extra", "_title")
+
+    def __init__(self, nombre: str, sustancia: str = "", mg=None, requiere_receta: bool = False):
+        nombre = (nombre or "").strip()
+        if not nombre:
+            raise ValueError("El nombre es obligatorio")
+        self.nombre = nombre
+        self.sustancia = (sustancia or "").strip()
+        self.mg = None if mg in (None, "") else parse_number(mg, "Ingrese un valor numérico válido para mg")
+        self.requiere_receta = bool(requiere_receta)
+        self.extra = None
+        self._title = None
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        item = cls.__new__(cls)
+        item.nombre = data.get("nombre") or ""
+        item.sustancia = data.get("sustancia") or ""
+        mg = data.get("mg")
+        item.mg = None if mg in (None, "") else mg
+        item.requiere_receta = bool(data.get("requiere_receta", False))
+        extra = {k: v for k, v in data.items() if k not in _CATALOG_KEYS}
+        item.extra = extra or None
+        item._title = None
+        return item
+
+    def to_dict(self) -> dict:
+        data = {"nombre": self.nombre, "sustancia": self.sustancia, "mg": self.mg,
+                "requiere_receta": self.requiere_receta}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    @property
+    def title(self) -> str:
+        if self._title is None:
+            number = format_number(self.mg)
+            self._title = f"{self.nombre} {number} mg".strip() if number else self.nombre
+        return self._title
+
+    @property
+    def subtitle(self) -> str:
+        return self.sustancia
+
+    def prefill(self) -> dict:
+        """Datos con los que se abre el formulario de alta."""
+        return {"nombre": self.nombre, "sustancia": self.sustancia, "mg": "" if self.mg is None else self.mg,
+                "requiere_receta": self.requiere_receta, "notas": ""}
+
+    def __repr__(self):
+        return f"CatalogItem({self.nombre!r})"
+
+
+_CATALOG_KEYS = frozenset(("nombre", "sustancia", "mg", "requiere_receta"))
@@ -1,44 +1,422 @@
 # -*- coding: utf-8 -*-
-"""Utilities para enviar notificaciones locales con repeticiones opcionales."""
+"""
+Utilities para enviar notificaciones locales con repeticiones opcionales.
+
+Todos los recordatorios comparten un único hilo planificador con una cola de
+prioridad (heap) ordenada por la hora absoluta del próximo disparo. Las
+repeticiones se calculan desde la hora programada y no desde la hora real en
+que se disparó la anterior, así que no acumulan retraso con los días.
+
+Los recordatorios vencidos no se envían desde el planificador: pasan a una
+cola de envío acotada con un único hilo que agrupa los que vencen dentro de
+la misma ventana en una sola notificación y limita la cantidad de
+notificaciones por minuto (ver `_Dispatcher`).
+
+Ambos toman la hora de un reloj inyectable (`SystemClock` por defecto). Con
+un `VirtualClock` y `threaded=False` no se crean hilos: quien los usa avanza
+el reloj y llama a `fire_due()` y `pump()` (ver notify_sim.py, que simula
+meses de recordatorios en milisegundos).
+"""
+import heapq
+import itertools
 import threading
+import time
+from collections import deque
 from typing import Optional
 
-from plyer import notification
+import instrumentation
+
+# Espera máxima del planificador antes de volver a mirar el reloj; cubre
+# cambios de hora del sistema y suspensiones del dispositivo.
+_MAX_WAIT = 60.0
+
+# Los recordatorios que vencen dentro de esta ventana (segundos) se agrupan.
+GROUP_WINDOW = 2.0
+# Notificaciones entregadas como máximo por RATE_PERIOD segundos.
+RATE_LIMIT = 4
+RATE_PERIOD = 60.0
+# Capacidad de la cola de envío; llena, rechaza los nuevos (contrapresión).
+QUEUE_LIMIT = 256
+# Líneas que muestra una notificación agrupada.
+GROUP_LINES = 5
+
+
+class SystemClock:
+    """Reloj real del sistema."""
+
+    @staticmethod
+    def time() -> float:
+        return time.time()
+
+    @staticmethod
+    def monotonic() -> float:
+        return time.monotonic()
+
+
+class VirtualClock:
+    """Reloj simulado: la hora solo cambia con `advance()` o `set()`."""
+
+    def __init__(self, start: float = 0.0):
+        self.now = float(start)
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += max(seconds, 0)
+
+    def set(self, now: float):
+        """Adelanta el reloj hasta `now` (nunca lo atrasa)."""
+        self.now = max(self.now, float(now))
+
+
+class Reminder:
+    """Handle de un recordatorio programado. Se puede cancelar o reprogramar."""
+
+    def __init__(self, scheduler, due: float, interval: float, title: str, message: str):
+        self._scheduler = scheduler
+        self.due = due
+        self.interval = interval
+        self.title = title
+        self.message = message
+        self.cancelled = False
+        self._token = 0
+
+    @property
+    def repeating(self) -> bool:
+        return self.interval > 0
+
+    def cancel(self):
+        self._scheduler.cancel(self)
+
+    def reschedule(self, delay_seconds: float, interval: Optional[float] = None):
+        """Mueve el próximo disparo a `delay_seconds` desde ahora."""
+        self._scheduler.reschedule(self, delay_seconds, interval)
+
+
+class _Scheduler:
+    """
+    Planificador de un solo hilo basado en un heap de (hora, seq, recordatorio).
+    Los vencidos se entregan a `dispatcher` (por defecto, el del módulo).
+    """
+
+    def __init__(self, clock=None, dispatcher=None, threaded: bool = True):
+        self.clock = clock or SystemClock()
+        self.dispatcher = dispatcher
+        self.threaded = threaded
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._stale = 0
+        self._thread = None
+
+    def add(self, delay_seconds: float, interval: float, title: str, message: str) -> Reminder:
+        reminder = Reminder(self, self.clock.time() + max(delay_seconds, 0), max(interval, 0), title, message)
+        with self._lock:
+            self._push(reminder)
+            self._ensure_thread()
+            self._cond.notify()
+        return reminder
+
+    def cancel(self, reminder: Reminder):
+        with self._lock:
+            if reminder.cancelled:
+                return
+            reminder.cancelled = True
+            reminder._token += 1
+            self._mark_stale()
+            self._cond.notify()
+
+    def reschedule(self, reminder: Reminder, delay_seconds: float, interval: Optional[float] = None):
+        with self._lock:
+            if not reminder.cancelled:
+                # La entrada anterior queda obsoleta en el heap (borrado perezoso).
+                reminder._token += 1
+                self._mark_stale()
+            reminder.cancelled = False
+            if interval is not None:
+                reminder.interval = max(interval, 0)
+            reminder.due = self.clock.time() + max(delay_seconds, 0)
+            self._push(reminder)
+            self._ensure_thread()
+            self._cond.notify()
 
+    def pending(self) -> int:
+        """Número de recordatorios activos."""
+        with self._lock:
+            return len(self._heap) - self._stale
 
-class _RepeatingNotification:
-    """Gestiona el envío periódico de una notificación."""
+    def _push(self, reminder: Reminder):
+        heapq.heappush(self._heap, (reminder.due, next(self._seq), reminder._token, reminder))
 
-    def __init__(self, interval_seconds: float, title: str, message: str):
-        self._interval = max(interval_seconds, 0)
-        self._title = title
-        self._message = message
-        self._stop_event = threading.Event()
-        self._timer: Optional[threading.Timer] = None
+    def _mark_stale(self):
+        self._stale += 1
+        # Compactar cuando la mitad del heap son entradas obsoletas.
+        if self._stale > 32 and self._stale * 2 > len(self._heap):
+            self._heap = [e for e in self._heap if e[2] == e[3]._token and not e[3].cancelled]
+            heapq.heapify(self._heap)
+            self._stale = 0
 
-    def _dispatch(self):
-        if self._stop_event.is_set():
+    def _ensure_thread(self):
+        if not self.threaded:
             return
-        send_notification(self._title, self._message)
-        self._timer = threading.Timer(self._interval, self._dispatch)
-        self._timer.daemon = True
-        self._timer.start()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="dosely-reminders", daemon=True)
+            self._thread.start()
 
-    def start(self):
-        if self._interval <= 0:
+    def _peek(self):
+        """Hora del próximo disparo válido (descarta las entradas obsoletas), o None."""
+        while self._heap:
+            due, _seq, token, reminder = self._heap[0]
+            if token == reminder._token and not reminder.cancelled:
+                return due
+            heapq.heappop(self._heap)
+            self._stale = max(self._stale - 1, 0)
+        return None
+
+    def _pop_ready(self, now: float):
+        """(recordatorio, hora programada) del primero vencido a la hora `now`, o None."""
+        due = self._peek()
+        if due is None or due > now:
+            return None
+        reminder = heapq.heappop(self._heap)[3]
+        if reminder.repeating:
+            # Siguiente disparo anclado a la hora programada; si el
+            # dispositivo estuvo dormido se saltan los que ya pasaron.
+            missed = int((now - due) // reminder.interval) + 1
+            reminder.due = due + missed * reminder.interval
+            self._push(reminder)
+        else:
+            reminder.cancelled = True
+        return reminder, due
+
+    def _pop_due(self):
+        """
+        Espera al próximo recordatorio vencido y devuelve (recordatorio, hora
+        programada del disparo), con el lock tomado.
+        """
+        while True:
+            due = self._peek()
+            if due is None:
+                self._cond.wait()
+                continue
+            now = self.clock.time()
+            if due > now:
+                self._cond.wait(min(due - now, _MAX_WAIT))
+                continue
+            return self._pop_ready(now)
+
+    def _fire(self, reminder: Reminder, due: float, now: float):
+        if instrumentation.ENABLED:
+            # Retraso del disparo respecto de la hora programada.
+            instrumentation.observe("notify.fire_lag", now - due)
+        (self.dispatcher or _dispatcher).submit(reminder.title, reminder.message)
+
+    def next_due(self):
+        """Hora del próximo disparo, o None si no hay recordatorios activos."""
+        with self._lock:
+            return self._peek()
+
+    def fire_due(self, on_fire=None, until: float = None) -> int:
+        """
+        Dispara, sin hilo, todos los recordatorios vencidos a la hora del reloj
+        y devuelve cuántos. `on_fire(recordatorio, hora programada)` se llama
+        con cada uno antes de entregarlo.
+
+        Con `until` (simulaciones) también dispara, en orden, lo que vence
+        hasta esa hora, cada uno como si el reloj marcara su hora programada;
+        con un `VirtualClock`, `on_fire` puede adelantarlo hasta cada disparo.
+        """
+        now = self.clock.time()
+        limit = now if until is None else max(until, now)
+        # Los vencidos se sacan del heap juntos, con una sola toma del lock.
+        batch = []
+        with self._lock:
+            due = self._peek()
+            while due is not None and due <= limit:
+                batch.append(self._pop_ready(max(due, now)))
+                due = self._peek()
+        for reminder, due in batch:
+            if on_fire is not None:
+                on_fire(reminder, due)
+            self._fire(reminder, due, self.clock.time())
+        return len(batch)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                reminder, due = self._pop_due()
+            self._fire(reminder, due, self.clock.time())
+
+
+class _Dispatcher:
+    """
+    Cola acotada de notificaciones con un único hilo de envío.
+
+    El hilo espera GROUP_WINDOW segundos desde la primera notificación
+    pendiente, junta todas las que llegaron y las entrega como una sola. Si ya
+    se entregaron RATE_LIMIT en el último RATE_PERIOD, sigue acumulando hasta
+    que se libere un cupo.
+
+    `send(título, mensaje)` entrega cada notificación (por defecto,
+    `send_notification`).
+    """
+
+    def __init__(self, window: float = GROUP_WINDOW, rate_limit: int = RATE_LIMIT,
+                 rate_period: float = RATE_PERIOD, limit: int = QUEUE_LIMIT,
+                 clock=None, send=None, threaded: bool = True):
+        self.clock = clock or SystemClock()
+        self.send = send
+        self.threaded = threaded
+        self.window = window
+        self.rate_limit = max(int(rate_limit), 1)
+        self.rate_period = rate_period
+        self.limit = max(int(limit), 1)
+        self._queue = deque()
+        self._sent_at = deque()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._thread = None
+        self._stats = {"accepted": 0, "rejected": 0, "delivered": 0, "notifications": 0, "failed": 0}
+        self._last_error = None
+
+    def submit(self, title: str, message: str) -> bool:
+        """Encola una notificación. Devuelve False si la cola está llena."""
+        with self._lock:
+            if len(self._queue) >= self.limit:
+                self._stats["rejected"] += 1
+                return False
+            self._queue.append((self.clock.monotonic(), title, message))
+            self._stats["accepted"] += 1
+            if self.threaded:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="dosely-notify", daemon=True)
+                    self._thread.start()
+                self._cond.notify()
+            return True
+
+    def saturated(self) -> bool:
+        """Indica si la cola está llena y se están rechazando notificaciones."""
+        with self._lock:
+            return len(self._queue) >= self.limit
+
+    def stats(self) -> dict:
+        """Contadores de la cola: aceptadas, rechazadas, entregadas, fallidas, pendientes."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._queue)
+            stats["last_error"] = self._last_error
+            return stats
+
+    def _wait_time(self, now: float):
+        """Segundos hasta poder enviar el próximo lote (<= 0: ya), o None si la cola está vacía."""
+        if not self._queue:
+            return None
+        while self._sent_at and now - self._sent_at[0] >= self.rate_period:
+            self._sent_at.popleft()
+        # Con la cola llena no se espera el resto de la ventana.
+        wait = 0.0 if len(self._queue) >= self.limit else self._queue[0][0] + self.window - now
+        if len(self._sent_at) >= self.rate_limit:
+            wait = max(wait, self._sent_at[0] + self.rate_period - now)
+        return wait
+
+    def _take_batch(self, now: float):
+        batch = list(self._queue)
+        self._queue.clear()
+        self._sent_at.append(now)
+        return batch
+
+    def _next_batch(self):
+        with self._lock:
+            while True:
+                wait = self._wait_time(self.clock.monotonic())
+                if wait is not None and wait <= 0:
+                    return self._take_batch(self.clock.monotonic())
+                self._cond.wait(wait)
+
+    def next_wakeup(self):
+        """Hora (del reloj) en que se podrá enviar el próximo lote, o None si no hay nada pendiente."""
+        with self._lock:
+            now = self.clock.monotonic()
+            wait = self._wait_time(now)
+            return None if wait is None else now + max(wait, 0.0)
+
+    def pump(self) -> int:
+        """Envía, sin hilo, los lotes listos a la hora del reloj y devuelve cuántas notificaciones."""
+        sent = 0
+        while True:
+            with self._lock:
+                now = self.clock.monotonic()
+                wait = self._wait_time(now)
+                if wait is None or wait > 0:
+                    return sent
+                batch = self._take_batch(now)
+            self._deliver(batch)
+            sent += 1
+            if not self._queue:
+                # El lote se lleva toda la cola: no queda nada por revisar.
+                return sent
+
+    @staticmethod
+    def _merge(batch):
+        """Título y mensaje de una notificación que agrupa `batch`."""
+        if len(batch) == 1:
+            return batch[0][1], batch[0][2]
+        titles = {title for _at, title, _message in batch}
+        title = titles.pop() if len(titles) == 1 else "Dosely"
+        counts = {}
+        for _at, _title, message in batch:
+            counts[message] = counts.get(message, 0) + 1
+        lines = [m if n == 1 else f"{m} (x{n})" for m, n in counts.items()]
+        if len(lines) > GROUP_LINES:
+            lines = lines[:GROUP_LINES] + [f"y {len(lines) - GROUP_LINES} más"]
+        return f"{title}: {len(batch)} recordatorios", "\n".join(lines)
+
+    def _deliver(self, batch):
+        title, message = self._merge(batch)
+        send = self.send or send_notification
+        try:
+            if instrumentation.ENABLED:
+                with instrumentation.span("notify.dispatch"):
+                    send(title, message)
+            else:
+                send(title, message)
+        except Exception as error:
+            with self._lock:
+                self._stats["failed"] += len(batch)
+                self._last_error = f"{type(error).__name__}: {error}"
             return
-        self._timer = threading.Timer(self._interval, self._dispatch)
-        self._timer.daemon = True
-        self._timer.start()
+        with self._lock:
+            self._stats["delivered"] += len(batch)
+            self._stats["notifications"] += 1
+
+    def _run(self):
+        while True:
+            self._deliver(self._next_batch())
+
+
+_dispatcher = _Dispatcher()
+_scheduler = _Scheduler(dispatcher=_dispatcher)
 
-    def cancel(self):
-        self._stop_event.set()
-        if self._timer:
-            self._timer.cancel()
+
+def make_scheduler(clock=None, send=None, threaded: bool = True, **dispatcher_options):
+    """
+    Crea un planificador independiente del de la aplicación, con su propio
+    despachador (`scheduler.dispatcher`). Pensado para simulaciones y pruebas:
+    `make_scheduler(VirtualClock(), send=..., threaded=False)`.
+    """
+    dispatcher = _Dispatcher(clock=clock, send=send, threaded=threaded, **dispatcher_options)
+    return _Scheduler(clock=dispatcher.clock, dispatcher=dispatcher, threaded=threaded)
 
 
 def send_notification(title: str, message: str):
     """Envía una notificación inmediata."""
+    # plyer se importa con la primera notificación, no al arrancar la app.
+    from plyer import notification
     notification.notify(
         title=title,
         message=message,
@@ -48,19 +426,32 @@ def send_notification(title: str, message: str):
 
 
 def schedule_notification(delay: float, delay_unit: str, title: str, message: str, repeat: bool = False):
-    """Programa una notificación diferida y opcionalmente repetitiva."""
+    """
+    Programa una notificación diferida y opcionalmente repetitiva.
+    Devuelve un `Reminder` con `cancel()` y `reschedule()`.
+    """
     conversion_factors = {
         "hours": 3600,
         "days": 86400,
     }
     seconds = max(delay, 0) * conversion_factors.get(delay_unit, 1)
+    interval = seconds if repeat else 0
+    if repeat and interval <= 0:
+        # Igual que antes: una repetición sin intervalo no se programa.
+        reminder = Reminder(_scheduler, _scheduler.clock.time(), 0, title, message)
+        reminder.cancelled = True
+        return reminder
+    return _scheduler.add(seconds, interval, title, message)
+
+
+def dispatch_notification(title: str, message: str) -> bool:
+    """
+    Encola una notificación en el despachador (agrupada y con límite de
+    frecuencia). Devuelve False si la cola está llena.
+    """
+    return _dispatcher.submit(title, message)
 
-    if repeat:
-        handler = _RepeatingNotification(seconds, title, message)
-        handler.start()
-        return handler
 
-    timer = threading.Timer(seconds, send_notification, args=(title, message))
-    timer.daemon = True
-    timer.start()
-    return timer
\ No newline at end of file
+def dispatcher_stats() -> dict:
+    """Contadores del despachador de notificaciones (ver `_Dispatcher.stats`)."""
+    return _dispatcher.stats()
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Simulación de recordatorios con reloj virtual (sin esperas ni hilos).
+
+Programa recordatorios repetitivos para cientos de medicamentos en un
+planificador de notify con `VirtualClock` y lo recorre de a un día: los
+disparos del día salen juntos del planificador (`fire_due(until=...)`) y el
+reloj se adelanta a cada uno, entregando antes los lotes del despachador que
+correspondan. Mide:
+- disparos realizados contra los esperados, por recordatorio (los que faltan
+  o sobran son errores);
+- deriva: distancia entre el disparo n de cada recordatorio y
+  `primero + n * intervalo`, calculado aquí a partir del retraso inicial y no
+  de lo que informa el planificador;
+- retraso de entrega: desde la hora programada hasta que el despachador envía
+  la notificación (con `--lag`, el hilo además "despierta" tarde);
+- despachador: notificaciones agrupadas, entregadas, rechazadas y el ritmo
+  de disparos y envíos por segundo real.
+
+Uso:
+    python notify_sim.py                         # 300 medicamentos, 90 días
+    python notify_sim.py --meds 500 --days 180 --lag 30 --json
+
+Sale con código 1 si faltan disparos o la deriva supera `--max-drift`, así
+que sirve como prueba en integración continua.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+import notify
+
+DAY = 86400.0
+# Intervalos (horas) de los recordatorios simulados.
+INTERVALS = (4, 6, 8, 12, 24, 48)
+# Deriva tolerada (segundos) por defecto.
+MAX_DRIFT = 1e-3
+
+
+def simulate(meds: int = 300, days: float = 90, intervals=INTERVALS, lag: float = 0.0, seed: int = 1,
+             start: float = 1_700_000_000.0, **dispatcher_options) -> dict:
+    """
+    Simula `days` días de recordatorios de `meds` medicamentos y devuelve el
+    informe. `lag` es el retraso máximo (segundos, aleatorio) con que se
+    atiende cada disparo; `dispatcher_options` se pasan a `_Dispatcher`
+    (window, rate_limit, rate_period, limit).
+    """
+    rng = random.Random(seed)
+    clock = notify.VirtualClock(start)
+    scheduler = notify.make_scheduler(clock, send=lambda _title, _message: None, threaded=False,
+                                      **dispatcher_options)
+    dispatcher = scheduler.dispatcher
+    end = start + days * DAY
+
+    plans = {}
+    for i in range(meds):
+        interval = rng.choice(intervals) * 3600.0
+        delay = rng.uniform(0, interval)
+        reminder = scheduler.add(delay, interval, "Dosely", f"Recordatorio {i}")
+        # [primer disparo, intervalo, disparos]; la hora esperada se calcula
+        # aquí, no se toma del planificador.
+        plans[reminder] = [start + delay, interval, 0]
+
+    stats = {"drift": 0.0, "skipped": 0, "delay_total": 0.0, "delay_max": 0.0, "delays": 0}
+    queued = []  # horas programadas de lo que espera en el despachador (su cola)
+
+    def pump_until(now):
+        """Entrega los lotes del despachador que salen antes de `now`."""
+        while queued:
+            ready = dispatcher.next_wakeup()
+            if ready > now:
+                return
+            clock.set(ready)
+            dispatcher.pump()
+            for scheduled in queued:
+                late = ready - scheduled
+                stats["delay_total"] += late
+                if late > stats["delay_max"]:
+                    stats["delay_max"] = late
+            stats["delays"] += len(queued)
+            queued.clear()
+
+    def on_fire(reminder, due):
+        plan = plans[reminder]
+        # El disparo n de cada recordatorio debe caer en primero + n * intervalo.
+        off = due - (plan[0] + plan[2] * plan[1])
+        plan[2] += 1
+        if off:
+            stats["drift"] = max(stats["drift"], abs(off))
+            if off >= plan[1] / 2:
+                stats["skipped"] += round(off / plan[1])
+        # El hilo despierta a la hora programada (más `lag`); antes salen los
+        # lotes que el despachador ya tenía listos.
+        wake = due + rng.uniform(0, lag) if lag else due
+        pump_until(wake)
+        clock.set(wake)
+        # Con la cola llena el despachador rechaza la notificación.
+        if len(queued) < dispatcher.limit:
+            queued.append(due)
+
+    wakeups = 0
+    fires = 0
+    wall = time.perf_counter()
+    # Un día por vuelta: los disparos del día se sacan juntos del planificador
+    # en lugar de despertar una vez por cada uno.
+    day = start
+    while day < end:
+        day = min(day + DAY, end)
+        fires += scheduler.fire_due(on_fire, until=day)
+        wakeups += 1
+    pump_until(end)
+    wall = time.perf_counter() - wall
+
+    # Disparos esperados por recordatorio: uno que sobra en otro no tapa uno que falta.
+    expected = missed = extra = 0
+    for first, interval, count in plans.values():
+        wanted = int((end - first) // interval) + 1 if first <= end else 0
+        expected += wanted
+        missed += max(wanted - count, 0)
+        extra += max(count - wanted, 0)
+    dispatched = dispatcher.stats()
+    return {
+        "meds": meds,
+        "days": days,
+        "lag_s": lag,
+        "wall_ms": round(wall * 1000, 3),
+        "wakeups": wakeups,
+        "fires": fires,
+        "expected_fires": expected,
+        "missed_fires": missed,
+        "extra_fires": extra,
+        "skipped_fires": stats["skipped"],
+        "max_drift_s": stats["drift"],
+        "mean_delay_s": round(stats["delay_total"] / stats["delays"], 6) if stats["delays"] else 0.0,
+        "max_delay_s": round(stats["delay_max"], 6),
+        "notifications": dispatched["notifications"],
+        "delivered": dispatched["delivered"],
+        "rejected": dispatched["rejected"],
+        "failed": dispatched["failed"],
+        "pending": dispatched["pending"],
+        "fires_per_s": round(fires / wall) if wall else None,
+        "notifications_per_s": round(dispatched["notifications"] / wall) if wall else None,
+    }
+
+
+def check(report: dict, max_drift: float = MAX_DRIFT):
+    """Lista de problemas del informe (vacía si la simulación es correcta)."""
+    problems = []
+    if report["missed_fires"] or report["skipped_fires"]:
+        problems.append(f"faltan {report['missed_fires']} disparos ({report['skipped_fires']} saltados)")
+    if report["extra_fires"]:
+        problems.append(f"sobran {report['extra_fires']} disparos")
+    if report["max_drift_s"] > max_drift:
+        problems.append(f"deriva de {report['max_drift_s']:.6f} s (máximo {max_drift} s)")
+    if report["delivered"] + report["rejected"] + report["failed"] + report["pending"] != report["fires"]:
+        problems.append("el despachador no da cuenta de todos los disparos")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simula recordatorios de notify con un reloj virtual.")
+    parser.add_argument("--meds", type=int, default=300, help="medicamentos (recordatorios)")
+    parser.add_argument("--days", type=float, default=90, help="días simulados")
+    parser.add_argument("--lag", type=float, default=0.0, help="retraso máximo al atender un disparo (s)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-drift", type=float, default=MAX_DRIFT, help="deriva tolerada (s)")
+    parser.add_argument("--json", action="store_true", help="informe en JSON")
+    args = parser.parse_args(argv)
+
+    report = simulate(args.meds, args.days, lag=args.lag, seed=args.seed)
+    problems = check(report, args.max_drift)
+    if args.json:
+        print(json.dumps(dict(report, problems=problems), ensure_ascii=False, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:<20} {value}")
+        for problem in problems:
+            print(f"ERROR: {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Perfiles de pacientes: un almacén independiente por paciente.
+
+Estructura:
+- storage/profiles/manifest.db      índice liviano (SQLite) con un resumen
+                                   por perfil: nombre y cantidades
+- storage/profiles/ab/<id>/         almacén del perfil (dosely.db, historial/...)
+- storage/profiles/ab/<id>/perfil.json
+                                   datos del perfil; permiten reconstruir el índice
+
+"ab" son dos dígitos hexadecimales derivados del id: repartir los perfiles en
+256 subdirectorios mantiene los directorios chicos con miles de pacientes, y
+la ruta de un perfil se calcula a partir de su id sin recorrer nada.
+
+Abrir un perfil solo apunta el backend a su almacén; no se lee ningún otro.
+Las operaciones sobre todos los perfiles (`map_profiles`, `rebuild_manifest`)
+se reparten entre procesos.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import backend
+import storage_engine
+
+PROFILE_FILE = "perfil.json"
+MANIFEST_FILE = "manifest.db"
+_VALID_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def profiles_root() -> str:
+    """Directorio de perfiles por defecto (storage/profiles)."""
+    return os.path.join(backend.STORAGE_DIR, "profiles")
+
+
+def shard_of(profile_id: str) -> str:
+    """Subdirectorio (00-ff) de un perfil."""
+    return hashlib.blake2b(profile_id.encode("utf-8"), digest_size=1).hexdigest()
+
+
+def summarize(profile_id: str, path: str):
+    """
+    Resumen de un perfil leído de su almacén: (id, nombre, medicamentos,
+    recordatorios, hora). Es una función de módulo para poder correr en otros
+    procesos.
+    """
+    nombre = ""
+    try:
+        with open(os.path.join(path, PROFILE_FILE), "r", encoding="utf-8") as f:
+            nombre = json.load(f).get("nombre", "")
+    except (OSError, ValueError):
+        pass
+    kind = "sqlite" if os.path.exists(os.path.join(path, "dosely.db")) else None
+    if kind is None and os.path.exists(os.path.join(path, "medicamentos.json")):
+        kind = "json"
+    meds = []
+    if kind:
+        engine = backend.open_engine(path, kind)
+        try:
+            meds = engine.load_meds()
+        finally:
+            if hasattr(engine, "close"):
+                engine.close()
+    reminders = sum(1 for med in meds if backend.reminder_seconds(med) > 0)
+    return profile_id, nombre, len(meds), reminders, time.time()
+
+
+class ProfileStore:
+    """Perfiles bajo un directorio raíz, con su índice en manifest.db."""
+
+    def __init__(self, root: str = None):
+        self.root = os.path.abspath(root or profiles_root())
+        self._lock = threading.RLock()
+        self._conn = None
+
+    # ------------------------
+    # Índice
+    # ------------------------
+    def _manifest(self):
+        if self._conn is None:
+            os.makedirs(self.root, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.root, MANIFEST_FILE), check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS profiles ("
+                "id TEXT PRIMARY KEY, nombre TEXT NOT NULL, meds INTEGER NOT NULL DEFAULT 0, "
+                "reminders INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _upsert(self, rows, replace: bool = False):
+        """Inserta o actualiza filas; con `replace`, en la misma transacción se borran las demás."""
+        with self._lock:
+            conn = self._manifest()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if replace:
+                    conn.execute("DELETE FROM profiles")
+                conn.executemany(
+                    "INSERT INTO profiles (id, nombre, meds, reminders, updated) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET nombre = excluded.nombre, meds = excluded.meds, "
+                    "reminders = excluded.reminders, updated = excluded.updated",
+                    rows,
+                )
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    @staticmethod
+    def _row(row):
+        return {"id": row[0], "nombre": row[1], "meds": row[2], "reminders": row[3], "updated": row[4]}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # ------------------------
+    # Perfiles
+    # ------------------------
+    def path(self, profile_id: str) -> str:
+        """Almacén del perfil (no verifica que exista)."""
+        if not _VALID_ID.match(profile_id or ""):
+            raise ValueError(f"Id de perfil inválido: {profile_id!r}")
+        return os.path.join(self.root, shard_of(profile_id), profile_id)
+
+    def exists(self, profile_id: str) -> bool:
+        return os.path.isfile(os.path.join(self.path(profile_id), PROFILE_FILE))
+
+    def create(self, nombre: str, profile_id: str = None) -> str:
+        """Crea un perfil vacío y devuelve su id."""
+        profile_id = profile_id or storage_engine.new_med_id()
+        path = self.path(profile_id)
+        if self.exists(profile_id):
+            raise ValueError(f"El perfil ya existe: {profile_id}")
+        os.makedirs(path, exist_ok=True)
+        data = {"id": profile_id, "nombre": nombre, "creado": time.time()}
+        tmp = os.path.join(path, PROFILE_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(path, PROFILE_FILE))
+        self._upsert([(profile_id, nombre, 0, 0, time.time())])
+        return profile_id
+
+    def get(self, profile_id: str):
+        """Resumen de un perfil desde el índice, o None."""
+        with self._lock:
+            row = self._manifest().execute(
+                "SELECT id, nombre, meds, reminders, updated FROM profiles WHERE id = ?", (profile_id,)
+            ).fetchone()
+        return self._row(row) if row else None
+
+    def list(self, offset: int = 0, limit: int = None):
+        """Resúmenes de los perfiles ordenados por nombre (solo lee el índice)."""
+        with self._lock:
+            rows = self._manifest().execute(
+                "SELECT id, nombre, meds, reminders, updated FROM profiles ORDER BY nombre, id LIMIT ? OFFSET ?",
+                (-1 if limit is None else int(limit), int(offset)),
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            (total,) = self._manifest().execute("SELECT COUNT(*) FROM profiles").fetchone()
+        return total
+
+    def update_summary(self, profile_id: str, meds=None):
+        """
+        Actualiza el resumen del perfil en el índice. Con `meds` (lista ya
+        cargada) no vuelve a leer el almacén.
+        """
+        if meds is None:
+            row = summarize(profile_id, self.path(profile_id))
+        else:
+            current = self.get(profile_id) or {}
+            reminders = sum(1 for med in meds if backend.reminder_seconds(med) > 0)
+            row = (profile_id, current.get("nombre", ""), len(meds), reminders, time.time())
+        self._upsert([row])
+
+    def scan(self):
+        """Ids de los perfiles presentes en disco (recorre los subdirectorios)."""
+        if not os.path.isdir(self.root):
+            return
+        for shard in sorted(os.listdir(self.root)):
+            shard_path = os.path.join(self.root, shard)
+            if len(shard) != 2 or not os.path.isdir(shard_path):
+                continue
+            for profile_id in sorted(os.listdir(shard_path)):
+                if os.path.isfile(os.path.join(shard_path, profile_id, PROFILE_FILE)):
+                    yield profile_id
+
+    # ------------------------
+    # Operaciones masivas
+    # ------------------------
+    def map_profiles(self, func, profile_ids=None, workers: int = None, chunksize: int = 64):
+        """
+        Aplica `func(profile_id, path)` a cada perfil en procesos separados y
+        devuelve los resultados en el mismo orden. `func` debe ser una función
+        de módulo (se envía a otros procesos). Con `workers=1` corre aquí.
+        """
+        profile_ids = list(self.scan() if profile_ids is None else profile_ids)
+        paths = [self.path(profile_id) for profile_id in profile_ids]
+        if workers == 1 or len(profile_ids) < 2:
+            return [func(profile_id, path) for profile_id, path in zip(profile_ids, paths)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(func, profile_ids, paths, chunksize=max(1, int(chunksize))))
+
+    def rebuild_manifest(self, workers: int = None) -> int:
+        """Reconstruye el índice leyendo todos los perfiles en paralelo."""
+        rows = self.map_profiles(summarize, workers=workers)
+        # Un lector nunca ve el índice vacío: el borrado y la carga van juntos.
+        self._upsert(rows, replace=True)
+        return len(rows)
+
+
+_store = None
+_active = None
+
+
+def get_store() -> ProfileStore:
+    """Perfiles bajo storage/profiles (se fija la primera vez que se usa)."""
+    global _store
+    if _store is None:
+        _store = ProfileStore()
+    return _store
+
+
+def _sync_summary(storage_dir: str):
+    if _active and os.path.abspath(storage_dir) == _active[1].path(_active[0]):
+        _active[1].update_summary(_active[0], backend.load_meds())
+
+
+def open_profile(profile_id: str, store: ProfileStore = None):
+    """
+    Apunta el backend al almacén del perfil. Solo se lee ese perfil, y sus
+    altas y ediciones actualizan el resumen del índice. El catálogo sigue
+    siendo el compartido.
+    """
+    global _active
+    store = store or get_store()
+    if not store.exists(profile_id):
+        raise KeyError(f"Perfil no encontrado: {profile_id}")
+    backend.set_storage_dir(store.path(profile_id), catalog_dir=os.path.dirname(backend.CATALOG_FILE))
+    _active = (profile_id, store)
+    backend.add_listener(_sync_summary)
+    return store.path(profile_id)
+
+
+def active_profile():
+    """Id del perfil abierto, o None."""
+    return _active[0] if _active else None
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Conciliación de recetas contra el catálogo.
+
+Recibe las líneas de una receta en texto libre ("Ibuprofeno 400 mg c/8h",
+"Losartán potásico 50mg 1 comp por día", ...), las normaliza y busca cada una
+en el catálogo por nombre, sustancia y mg. Devuelve el mejor producto con un
+puntaje de 0 a 1 y algunas alternativas; `apply()` guarda los aceptados en la
+lista del usuario con una sola escritura.
+
+Con muchas líneas el trabajo se reparte entre procesos. Cada proceso abre el
+mismo catalogo.bin con mmap (solo lectura): el sistema comparte sus páginas y
+no se copia el catálogo a cada proceso.
+"""
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import backend
+import catalog_bin
+import fuzzy
+from catalog_index import fold
+
+# Puntaje mínimo para aceptar una coincidencia.
+MIN_SCORE = 0.6
+# Alternativas que se devuelven además de la mejor.
+ALTERNATIVES = 3
+# Candidatos del buscador que se puntúan por línea.
+CANDIDATES = 20
+# Con menos líneas que esto no vale la pena arrancar procesos.
+PARALLEL_MIN = 64
+
+_DOSE = re.compile(r"(\d+(?:[.,]\d+)?)\s*(mg|mcg|ug|μg|g)\b")
+_EVERY = re.compile(r"(?:c/|cada\s+)(\d+(?:[.,]\d+)?)\s*(h|hs|hr|hrs|horas?|d|dias?)\b")
+_TIMES_A_DAY = re.compile(r"(\d+)\s*(?:veces|vez|x)\s*(?:al|por|/)\s*dia\b")
+_DAILY = re.compile(r"\b(?:por dia|al dia|/dia|diario|diaria|cada dia|c/dia)\b")
+# Palabras de la indicación que no forman parte del nombre del producto.
+_NOISE = frozenset((
+    "tomar", "toma", "tomas", "comp", "comprimido", "comprimidos", "tab", "tableta", "tabletas", "caps",
+    "capsula", "capsulas", "gotas", "sobre", "sobres", "via", "oral", "vo", "por", "dia", "al", "de", "con",
+    "en", "y", "cada", "durante", "dias", "horas", "hs", "h", "mg", "x", "c",
+))
+_UNITS_MG = {"mg": 1, "g": 1000, "mcg": 0.001, "ug": 0.001, "μg": 0.001}  # fold() convierte µ en μ
+
+
+def _number(text: str) -> float:
+    return float(text.replace(",", "."))
+
+
+def parse_line(line: str) -> dict:
+    """
+    Separa una línea de receta en consulta (nombre o sustancia), mg y
+    frecuencia: {"linea", "consulta", "mg", "cada", "unidad"}. "cada" es None
+    si la línea no indica frecuencia.
+    """
+    text = fold(line)
+    mg = None
+    dose = _DOSE.search(text)
+    if dose:
+        mg = _number(dose.group(1)) * _UNITS_MG[dose.group(2)]
+        mg = int(mg) if abs(mg - int(mg)) < 1e-9 else round(mg, 3)
+    every, unit = None, "horas"
+    match = _EVERY.search(text)
+    times = _TIMES_A_DAY.search(text)
+    if match:
+        every = _number(match.group(1))
+        unit = "dias" if match.group(2).startswith("d") else "horas"
+    elif times and int(times.group(1)) > 0:
+        every = 24 / int(times.group(1))
+    elif _DAILY.search(text):
+        every = 24
+    if every is not None:
+        every = int(every) if abs(every - int(every)) < 1e-9 else round(every, 3)
+    # La consulta es lo que queda antes de la dosis, sin palabras de indicación.
+    name = text[:dose.start()] if dose and dose.start() > 0 else text
+    for pattern in (_EVERY, _TIMES_A_DAY, _DAILY):
+        name = pattern.sub(" ", name)
+    words = [w for w in re.split(r"[^\w]+", name) if w and not w.isdigit() and w not in _NOISE]
+    return {"linea": line.strip(), "consulta": " ".join(words), "mg": mg, "cada": every, "unidad": unit}
+
+
+def _name_score(query: str, key: str) -> float:
+    """Parecido entre la consulta y la clave (nombre\\nsustancia) de un producto."""
+    fields = key.split("\n")
+    if query in fields:
+        return 1.0
+    if any(field.startswith(query) for field in fields):
+        return 0.9
+    if any(word.startswith(query) for word in key.split()):
+        return 0.8
+    if query in key:
+        return 0.7
+    limit = fuzzy.max_distance(query)
+    distance = fuzzy.substring_distance(query, key, limit)
+    return max(0.6 - 0.1 * distance, 0.0) if distance <= limit else 0.0
+
+
+def _mg_score(wanted, item_mg) -> float:
+    if wanted is None or item_mg in (None, ""):
+        return 0.5
+    try:
+        return 1.0 if abs(float(item_mg) - float(wanted)) < 1e-6 else 0.0
+    except (TypeError, ValueError):
+        return 0.5
+
+
+def match_line(catalog, parsed: dict) -> dict:
+    """Puntúa los candidatos del catálogo para una línea ya separada."""
+    query = parsed["consulta"]
+    scored = []
+    if query:
+        words = query.split()
+        # Sin aciertos con la consulta completa ("ibuprofeno forte retard"),
+        # se prueba con la primera palabra.
+        ids = fuzzy.search(catalog, query)[:CANDIDATES]
+        if not ids and len(words) > 1:
+            query = words[0]
+            ids = fuzzy.search(catalog, query)[:CANDIDATES]
+        for item_id in ids:
+            item = catalog.item(item_id)
+            score = 0.8 * _name_score(query, catalog.key(item_id)) + 0.2 * _mg_score(parsed["mg"], item.get("mg"))
+            scored.append((round(score, 3), item))
+    scored.sort(key=lambda pair: -pair[0])
+    best = scored[0] if scored else (0.0, None)
+    return dict(parsed, score=best[0], match=best[1],
+                alternativas=[{"score": s, "item": item} for s, item in scored[1:1 + ALTERNATIVES]])
+
+
+_worker_catalog = None
+
+
+def _open_worker(bin_path: str):
+    global _worker_catalog
+    _worker_catalog = catalog_bin.BinaryCatalog(bin_path)
+
+
+def _match_chunk(parsed_lines):
+    return [match_line(_worker_catalog, parsed) for parsed in parsed_lines]
+
+
+def reconcile(lines, workers: int = None, chunksize: int = 32):
+    """
+    Concilia las líneas de una receta (se ignoran las vacías) y devuelve un
+    resultado por línea, en el mismo orden (ver `match_line`). Con
+    `workers=1`, o pocas líneas, corre en este proceso.
+    """
+    parsed = [parse_line(line) for line in lines if line and line.strip()]
+    catalog = backend.get_catalog_index()
+    if workers == 1 or len(parsed) < PARALLEL_MIN or not isinstance(catalog, catalog_bin.BinaryCatalog):
+        return [match_line(catalog, p) for p in parsed]
+    chunksize = max(1, int(chunksize))
+    chunks = [parsed[i:i + chunksize] for i in range(0, len(parsed), chunksize)]
+    workers = workers or min(len(chunks), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_open_worker, initargs=(catalog.path,)) as pool:
+        return [result for chunk in pool.map(_match_chunk, chunks) for result in chunk]
+
+
+def to_entry(result: dict) -> dict:
+    """Medicamento para la lista del usuario a partir de una línea conciliada."""
+    item = result["match"]
+    entry = {
+        "nombre": item.get("nombre", ""),
+        "sustancia": item.get("sustancia", ""),
+        "mg": item.get("mg"),
+        "requiere_receta": bool(item.get("requiere_receta", False)),
+        "notas": f"Receta: {result['linea']}",
+    }
+    if result["cada"]:
+        entry["recordatorio"] = backend.make_reminder(entry["nombre"], result["cada"], result["unidad"])
+    return entry
+
+
+def apply(results, min_score: float = MIN_SCORE):
+    """Guarda en la lista las líneas con puntaje >= `min_score` (una sola escritura); devuelve los ids."""
+    entries = [to_entry(r) for r in results if r["match"] is not None and r["score"] >= min_score]
+    return backend.add_meds(entries) if entries else []
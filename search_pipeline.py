@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Tubería de búsqueda incremental del catálogo.
+
+La búsqueda corre en un hilo propio para no bloquear la interfaz:
+- solo se atiende la consulta más reciente; las anteriores se descartan;
+- si la consulta nueva contiene a la anterior, se filtran los resultados
+  previos en vez de buscar otra vez en todo el catálogo;
+- un LRU pequeño guarda consulta→resultados por versión del catálogo;
+- los resultados se ordenan por calidad e incluyen aproximados (ver fuzzy.py).
+
+No depende de Kivy: quien la usa recibe los resultados en `deliver` (desde el
+hilo de búsqueda, como `ResultSet` perezoso) y decide cómo volver al hilo de
+la interfaz. Si la búsqueda falla, el error se registra y se entrega un
+`FailedSearch` vacío para que la lista pueda mostrar un aviso.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+
+import backend
+import fuzzy
+from catalog_index import ResultSet, fold
+
+
+class FailedSearch(Sequence):
+    """Resultado vacío de una búsqueda que falló; `error` es la excepción."""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+    def __len__(self):
+        return 0
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return self
+        raise IndexError(pos)
+
+
+def _log_failure(query: str):
+    try:
+        from kivy.logger import Logger
+    except ImportError:  # sin interfaz (pruebas, scripts)
+        Logger = logging.getLogger(__name__)
+    Logger.exception(f"Dosely: error al buscar {query!r} en el catálogo")
+
+
+class SearchPipeline:
+    """Atiende consultas en segundo plano y entrega solo la más reciente."""
+
+    def __init__(self, deliver, index_provider=None, cache_size: int = 32):
+        self._deliver = deliver
+        self._index_provider = index_provider or backend.get_catalog_index
+        self._cache_size = max(int(cache_size), 0)
+        self._cache = OrderedDict()
+        self._last = None  # (versión, consulta normalizada, ids)
+        self._cond = threading.Condition()
+        self._pending = None
+        self._generation = 0
+        self._thread = None
+
+    def submit(self, query: str) -> int:
+        """Encola una consulta y devuelve su número de generación."""
+        with self._cond:
+            self._generation += 1
+            self._pending = (self._generation, query or "")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="dosely-search", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+            return self._generation
+
+    def is_current(self, generation: int) -> bool:
+        """Indica si `generation` sigue siendo la última consulta enviada."""
+        return generation == self._generation
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                generation, query = self._pending
+                self._pending = None
+            try:
+                results = self._search(query, generation)
+            except Exception as error:
+                _log_failure(query)
+                results = FailedSearch(error)
+            if results is not None and self.is_current(generation):
+                self._deliver(generation, query, results)
+
+    def _search(self, query: str, generation: int):
+        index = self._index_provider()
+        folded = fold(query)
+        key = (index.version, folded)
+
+        ranked = self._cache.get(key)
+        if ranked is not None:
+            self._cache.move_to_end(key)
+            exact = None
+        else:
+            last = self._last
+            if last and last[0] == index.version and last[1] and last[1] in folded:
+                exact = index.narrow(last[2], folded)
+            else:
+                exact = index.search(folded)
+            if not self.is_current(generation):
+                return None
+            ranked = fuzzy.rank(index, folded, exact)
+            self._remember(key, ranked)
+
+        # Para filtrar la próxima consulta solo sirven los aciertos exactos.
+        self._last = (index.version, folded, exact) if exact is not None else None
+        if not self.is_current(generation):
+            return None
+        # Los productos se decodifican recién al mostrarse.
+        return ResultSet(index, ranked)
+
+    def _remember(self, key, ids):
+        if not self._cache_size:
+            return
+        self._cache[key] = ids
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
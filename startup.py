@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Medición del arranque de Dosely por fases.
+
+main.py importa este módulo antes que nada y marca el final de cada fase con
+`mark()`. Cuando la pantalla de inicio ya muestra la lista, `finish()` arma
+el informe: duración de cada fase y tiempo acumulado desde el inicio.
+
+El informe se escribe siempre en el log; si la variable de entorno
+DOSELY_STARTUP_REPORT apunta a un archivo, también se guarda allí en JSON
+para comparar entre versiones.
+"""
+import json
+import os
+import time
+
+_START = time.perf_counter()
+_marks = []  # (fase, segundos desde _START)
+_finished = False
+
+
+def mark(phase: str):
+    """Marca el final de una fase del arranque."""
+    if not _finished:
+        _marks.append((phase, time.perf_counter() - _START))
+
+
+def phases():
+    """Lista de fases como diccionarios con `fase`, `ms` y `total_ms`."""
+    result = []
+    previous = 0.0
+    for phase, elapsed in _marks:
+        result.append({
+            "fase": phase,
+            "ms": round((elapsed - previous) * 1000, 2),
+            "total_ms": round(elapsed * 1000, 2),
+        })
+        previous = elapsed
+    return result
+
+
+def report() -> str:
+    """Informe legible del arranque, una fase por línea."""
+    lines = ["Dosely: arranque por fases"]
+    for row in phases():
+        lines.append(f"  {row['fase']:<28} {row['ms']:>9.1f} ms  (acumulado {row['total_ms']:.1f} ms)")
+    return "\n".join(lines)
+
+
+def finish(log=None) -> str:
+    """
+    Cierra la medición (las marcas posteriores se ignoran), escribe el
+    informe con `log` y, si corresponde, en DOSELY_STARTUP_REPORT.
+    Devuelve el informe.
+    """
+    global _finished
+    if _finished:
+        return report()
+    _finished = True
+    text = report()
+    if log is not None:
+        for line in text.splitlines():
+            log(line)
+    path = os.environ.get("DOSELY_STARTUP_REPORT")
+    if path:
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"fases": phases()}, f, ensure_ascii=False, indent=2)
+        except OSError:
+            pass
+    return text
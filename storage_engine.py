@@ -0,0 +1,632 @@
+# -*- coding: utf-8 -*-
+"""
+Motores de almacenamiento para la lista de medicamentos del usuario.
+
+- `SqliteEngine` (por defecto): una fila por medicamento, inserciones y
+  actualizaciones indexadas de una sola fila dentro de transacciones.
+- `JsonEngine` (legado): el medicamentos.json de siempre, con las altas y
+  ediciones en un diario de solo-añadir (ver la clase).
+
+Ambos exponen la misma interfaz que usa `backend`: `initialize`, `load_meds`,
+`add_med`, `add_meds`, `update_med` y `signature` (cambia cuando otro proceso modifica
+los datos en disco). Después de cada escritura, `last_write` guarda la firma
+de justo antes y justo después de escribir, tomadas con el lock del motor:
+si la primera no es la que se leyó, otro proceso escribió en el medio.
+Cada medicamento se identifica por su clave estable "id";
+los datos antiguos sin id se migran al abrirlos.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo se coordinan los hilos del proceso
+    fcntl = None
+
+import instrumentation
+from catalog_index import file_signature
+
+JOURNAL_SUFFIX = ".journal"
+LOCK_SUFFIX = ".lock"
+# Registros en el diario a partir de los cuales se reescribe medicamentos.json.
+CHECKPOINT_EVERY = 256
+
+_log = logging.getLogger(__name__)
+
+
+class StorageCorruptedError(ValueError):
+    """Los datos en disco no se pueden leer; no se sobrescriben."""
+
+
+class ConflictError(RuntimeError):
+    """Otro proceso modificó el medicamento después de leerlo."""
+
+
+def new_med_id() -> str:
+    """Genera un id estable para un medicamento."""
+    return uuid.uuid4().hex
+
+
+def assign_ids(meds) -> bool:
+    """Asigna un id a las entradas que no lo tienen. Devuelve True si hubo cambios."""
+    changed = False
+    seen = set()
+    for med in meds:
+        med_id = med.get("id")
+        if not med_id or med_id in seen:
+            med["id"] = med_id = new_med_id()
+            changed = True
+        seen.add(med_id)
+    return changed
+
+
+def _fsync_dir(path: str):
+    # Hace durable el renombrado (solo POSIX).
+    if os.name != "posix":
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path: str, data: bytes):
+    """Escribe `data` en un temporal y lo renombra sobre `path`: nunca queda a medias."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(path)
+
+
+def journal_line(record: dict) -> bytes:
+    """Línea del diario: crc32 en hexadecimal, espacio y el registro en JSON."""
+    payload = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+
+def parse_journal(data: bytes, path: str = "diario", torn_lines: bool = False):
+    """
+    Registros de `data` y cantidad de bytes válidos. Una última línea
+    incompleta o con crc incorrecto es una escritura cortada y se ignora; una
+    línea dañada en medio del diario es un error. Con `torn_lines` (sin lock
+    entre procesos) también se saltan: ahí una escritura cortada queda
+    cerrada por la línea siguiente y no se distingue de un daño.
+    """
+    records = []
+    offset = 0
+    while offset < len(data):
+        end = data.find(b"\n", offset)
+        if end < 0:
+            break
+        line = data[offset:end]
+        if not line:
+            # Separador de una escritura sin lock (ver JsonEngine._append).
+            offset = end + 1
+            continue
+        record = None
+        if len(line) > 9 and line[8:9] == b" ":
+            try:
+                if int(line[:8], 16) == zlib.crc32(line[9:]):
+                    record = json.loads(line[9:].decode("utf-8"))
+            except ValueError:
+                record = None
+        if not isinstance(record, dict):
+            if torn_lines:
+                offset = end + 1
+                continue
+            if data.find(b"\n", end + 1) >= 0:
+                raise StorageCorruptedError(f"{path}: registro dañado en el byte {offset}")
+            break
+        records.append(record)
+        offset = end + 1
+    return records, offset
+
+
+class _Write:
+    """Escritura pendiente del diario (ver `JsonEngine._submit`)."""
+
+    __slots__ = ("med_id", "med", "new", "expected", "done", "error")
+
+    def __init__(self, med_id: str, med: dict, new: bool, expected: int = None):
+        self.med_id = med_id
+        self.med = med
+        self.new = new
+        self.expected = expected
+        self.done = False
+        self.error = None
+
+
+class JsonEngine:
+    """
+    Almacena la lista en medicamentos.json más un diario de escrituras.
+
+    - medicamentos.json es la foto completa de la lista; solo se reemplaza
+      con renombrado atómico (archivo temporal, fsync, os.replace).
+    - medicamentos.json.journal recibe cada alta o edición como una línea
+      "crc32 json" con el medicamento completo y su revisión. Al leer, la foto
+      más el diario dan la lista actual; una última línea a medio escribir
+      (proceso terminado a la mitad) se descarta.
+    - Cada CHECKPOINT_EVERY registros la lista se vuelca a una foto nueva y el
+      diario vuelve a empezar.
+
+    Varios procesos pueden escribir a la vez: cada escritura toma un lock de
+    archivo solo para ponerse al día con el diario y añadir sus líneas, así que
+    nadie reescribe el archivo completo de otro. Las escrituras concurrentes
+    de un mismo proceso se agrupan en un solo fsync. Una edición comprueba la
+    revisión del medicamento: si otro proceso lo cambió después de leerlo,
+    falla con `ConflictError` en lugar de pisar ese cambio.
+    """
+
+    name = "json"
+
+    def __init__(self, meds_file: str):
+        self.meds_file = meds_file
+        self.journal_file = meds_file + JOURNAL_SUFFIX
+        self._lock = threading.RLock()
+        self._lock_fd = None
+        self._lock_depth = 0
+        # Agrupación de escrituras (group commit).
+        self._cond = threading.Condition(threading.Lock())
+        self._pending = []
+        self._flushing = False
+        # Estado en memoria: foto + diario aplicados.
+        self._meds = None
+        self._pos = {}
+        self._revs = {}
+        self._seen = {}
+        self._snapshot_sig = None
+        self._journal_ino = None
+        self._offset = 0
+        self._journal_records = 0
+        self.last_write = None
+
+    # ------------------------
+    # Lock entre procesos
+    # ------------------------
+    @contextmanager
+    def _file_lock(self):
+        with self._lock:
+            self._lock_depth += 1
+            try:
+                if self._lock_depth == 1 and fcntl is not None:
+                    if self._lock_fd is None:
+                        self._lock_fd = os.open(self.meds_file + LOCK_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and self._lock_fd is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def close(self):
+        with self._lock:
+            if self._lock_fd is not None:
+                os.close(self._lock_fd)
+                self._lock_fd = None
+
+    # ------------------------
+    # Lectura
+    # ------------------------
+    def initialize(self):
+        if os.path.exists(self.meds_file):
+            return
+        with self._file_lock():
+            if not os.path.exists(self.meds_file):
+                write_atomic(self.meds_file, b"[]")
+
+    def signature(self):
+        return file_signature(self.meds_file), file_signature(self.journal_file)
+
+    def _read_snapshot(self):
+        try:
+            with open(self.meds_file, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return []
+        instrumentation.add_bytes("read", "medicamentos.json", len(raw))
+        try:
+            data = json.loads(raw.decode("utf-8"))
+        except ValueError as error:
+            raise StorageCorruptedError(f"{self.meds_file} está dañado: {error}") from error
+        if not isinstance(data, list):
+            raise StorageCorruptedError(f"{self.meds_file} no contiene una lista de medicamentos")
+        return [med for med in data if isinstance(med, dict)]
+
+    def _apply(self, record: dict):
+        if "base" in record:
+            self._revs.update(record["base"])
+            return
+        med_id = record["id"]
+        pos = self._pos.get(med_id)
+        if pos is None:
+            self._pos[med_id] = len(self._meds)
+            self._meds.append(record["med"])
+        else:
+            self._meds[pos] = record["med"]
+        self._revs[med_id] = record["rev"]
+        self._journal_records += 1
+
+    def _read_journal(self) -> bool:
+        """Aplica las líneas nuevas del diario. False si hay que releer todo (diario reemplazado)."""
+        try:
+            f = open(self.journal_file, "r+b")
+        except FileNotFoundError:
+            return self._journal_ino is None
+        with f:
+            st = os.fstat(f.fileno())
+            if self._journal_ino is not None and (st.st_ino != self._journal_ino or st.st_size < self._offset):
+                return False
+            f.seek(self._offset)
+            data = f.read()
+            records, valid = parse_journal(data, self.journal_file, torn_lines=fcntl is None)
+            for record in records:
+                self._apply(record)
+            if valid < len(data) and fcntl is not None:
+                # Última línea a medio escribir: se descarta. Sin lock entre
+                # procesos (Windows) podría ser la escritura en curso de otro
+                # proceso, así que al leer solo se ignora (ver _append).
+                f.truncate(self._offset + valid)
+            self._journal_ino = st.st_ino
+            self._offset += valid
+        instrumentation.add_bytes("read", "medicamentos.journal", valid)
+        return True
+
+    def _reload(self):
+        meds = self._read_snapshot()
+        fixed = assign_ids(meds)
+        self._snapshot_sig = file_signature(self.meds_file)
+        self._meds = []
+        self._pos = {}
+        for med in meds:
+            self._pos[med["id"]] = len(self._meds)
+            self._meds.append(med)
+        self._revs = dict.fromkeys(self._pos, 0)
+        self._journal_ino = None
+        self._offset = 0
+        self._journal_records = 0
+        self._read_journal()
+        if fixed:
+            self._checkpoint()
+
+    def _refresh(self):
+        """Pone el estado en memoria al día con el disco (con el lock de archivo tomado)."""
+        if self._meds is None or file_signature(self.meds_file) != self._snapshot_sig or not self._read_journal():
+            self._reload()
+
+    def load_meds(self):
+        self.initialize()
+        with self._file_lock():
+            try:
+                self._refresh()
+            except BaseException:
+                self._meds = None
+                raise
+            self._seen = dict(self._revs)
+            return list(self._meds)
+
+    def revision(self, med_id: str):
+        """Revisión del medicamento según la última lectura, o None."""
+        with self._lock:
+            return self._seen.get(med_id)
+
+    # ------------------------
+    # Escritura
+    # ------------------------
+    def add_med(self, entry: dict) -> str:
+        self._submit(_Write(entry["id"], entry, new=True))
+        return entry["id"]
+
+    def add_meds(self, entries) -> list:
+        """Añade varios medicamentos en una sola escritura del diario: todos o ninguno."""
+        entries = list(entries)
+        self._submit(*(_Write(entry["id"], entry, new=True) for entry in entries))
+        return [entry["id"] for entry in entries]
+
+    def update_med(self, med_id: str, entry: dict, revision: int = None):
+        """
+        Reemplaza un medicamento. Falla con `ConflictError` si cambió en disco
+        desde la revisión `revision` (por defecto, la de la última lectura).
+        """
+        self._submit(_Write(med_id, entry, new=False, expected=revision))
+        return True
+
+    def _submit(self, *writes: _Write):
+        """
+        Encola las escrituras como un grupo: se guardan todas o ninguna. Si
+        nadie está escribiendo, este hilo escribe todos los grupos pendientes
+        con un solo fsync; si no, espera a que lo haga otro.
+        """
+        with self._cond:
+            self._pending.append(writes)
+        while True:
+            with self._cond:
+                while self._flushing and not all(write.done for write in writes):
+                    self._cond.wait()
+                if all(write.done for write in writes):
+                    break
+                self._flushing = True
+                batch, self._pending = self._pending, []
+            try:
+                self._flush(batch)
+            finally:
+                with self._cond:
+                    self._flushing = False
+                    self._cond.notify_all()
+        for write in writes:
+            if write.error is not None:
+                raise write.error
+
+    def _check(self, group):
+        """
+        Registros del diario para un grupo, o None si alguna escritura no
+        vale (el error queda en todas las del grupo).
+        """
+        revs = {}  # lo que el grupo ya cambió, para ids repetidos dentro de él
+        records = []
+        for write in group:
+            current = revs[write.med_id] if write.med_id in revs else self._revs.get(write.med_id)
+            error = None
+            if write.new and current is not None:
+                error = ValueError(f"Id de medicamento repetido: {write.med_id}")
+            elif not write.new and current is None:
+                error = KeyError(f"Medicamento no encontrado: {write.med_id}")
+            elif not write.new and write.med_id not in revs:
+                expected = write.expected
+                if expected is None:
+                    expected = self._seen.get(write.med_id, current)
+                if expected != current:
+                    error = ConflictError(f"El medicamento {write.med_id} cambió en disco "
+                                          f"(revisión {current}, se leyó la {expected})")
+            if error is not None:
+                for other in group:
+                    other.error = error
+                return None
+            revs[write.med_id] = (current or 0) + 1
+            records.append({"id": write.med_id, "rev": revs[write.med_id], "med": write.med})
+        return records
+
+    def _flush(self, batch):
+        writes = [write for group in batch for write in group]
+        try:
+            with self._file_lock():
+                before = self.signature()
+                self.initialize()
+                self._refresh()
+                lines = []
+                for group in batch:
+                    for record in self._check(group) or ():
+                        self._apply(record)
+                        self._seen[record["id"]] = record["rev"]
+                        lines.append(journal_line(record))
+                if lines:
+                    self._append(b"".join(lines))
+                    if self._journal_records >= CHECKPOINT_EVERY:
+                        self._try_checkpoint()
+                self.last_write = (before, self.signature())
+        except BaseException as error:
+            # El estado en memoria puede ir por delante del disco: se relee.
+            self._meds = None
+            for write in writes:
+                if write.error is None:
+                    write.error = error
+        finally:
+            for write in writes:
+                write.done = True
+
+    def _append(self, data: bytes):
+        with open(self.journal_file, "ab") as f:
+            st = os.fstat(f.fileno())
+            if st.st_ino == self._journal_ino and st.st_size > self._offset:
+                # Resto cortado que la lectura no quitó: la línea nueva no
+                # puede quedar pegada a él. Sin lock entre procesos puede ser
+                # la escritura en curso de otro: no se corta, la línea nueva
+                # empieza en un renglón propio.
+                if fcntl is not None:
+                    f.truncate(self._offset)
+                else:
+                    data = b"\n" + data
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())
+        if self._journal_ino is None:
+            _fsync_dir(self.journal_file)
+        instrumentation.add_bytes("written", "medicamentos.journal", len(data))
+        self._journal_ino = st.st_ino
+        self._offset = st.st_size
+
+    def _try_checkpoint(self):
+        """
+        Checkpoint después de escribir en el diario. Las líneas ya son
+        durables, así que si falla no se informa como error de la escritura:
+        se reintenta en una escritura siguiente.
+        """
+        try:
+            self._checkpoint()
+        except Exception:
+            _log.exception("No se pudo reescribir %s; se reintentará", self.meds_file)
+            # La foto pudo cambiar sin reiniciar el diario: se relee de disco.
+            self._meds = None
+
+    def _checkpoint(self):
+        """Vuelca la lista a una foto nueva y reinicia el diario."""
+        data = json.dumps(self._meds, ensure_ascii=False, indent=2).encode("utf-8")
+        write_atomic(self.meds_file, data)
+        instrumentation.add_bytes("written", "medicamentos.json", len(data))
+        # Si se corta aquí, el diario viejo se vuelve a aplicar sobre la foto
+        # nueva: cada línea es el medicamento completo, así que da lo mismo.
+        header = journal_line({"base": self._revs})
+        write_atomic(self.journal_file, header)
+        self._snapshot_sig = file_signature(self.meds_file)
+        self._journal_ino = os.stat(self.journal_file).st_ino
+        self._offset = len(header)
+        self._journal_records = 0
+
+
+class SqliteEngine:
+    """
+    Almacena cada medicamento en una fila de SQLite, con el id como clave
+    primaria y la columna indexada `pos` para conservar el orden de la lista.
+    En el primer uso importa el medicamentos.json existente, si lo hay.
+    """
+
+    name = "sqlite"
+
+    SCHEMA_VERSION = 2
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS meds (id TEXT PRIMARY KEY, pos INTEGER NOT NULL, data TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS meds_pos ON meds (pos)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    )
+
+    def __init__(self, db_file: str, legacy_json: str = None):
+        self.db_file = db_file
+        self.legacy_json = legacy_json
+        self._conn = None
+        self._lock = threading.RLock()
+        self.last_write = None
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn = conn
+            self._migrate_schema()
+            self._migrate_legacy_json()
+        return self._conn
+
+    @contextmanager
+    def transaction(self):
+        """Ejecuta varios pasos como una sola transacción atómica."""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Con el lock de escritura tomado: incluye todo lo que otros
+                # confirmaron antes. El commit propio no cambia data_version.
+                (version,) = conn.execute("PRAGMA data_version").fetchone()
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            self.last_write = (version, version)
+
+    def _migrate_schema(self):
+        conn = self._conn
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        if version >= self.SCHEMA_VERSION:
+            return
+        with self.transaction() as tx:
+            columns = [row[1] for row in tx.execute("PRAGMA table_info(meds)")]
+            old_rows = []
+            if columns and "id" not in columns:
+                # Versión 1: filas indexadas solo por posición.
+                old_rows = tx.execute("SELECT data FROM meds ORDER BY pos").fetchall()
+                tx.execute("DROP TABLE meds")
+            for statement in self.SCHEMA:
+                tx.execute(statement)
+            meds = []
+            for (data,) in old_rows:
+                try:
+                    meds.append(json.loads(data))
+                except ValueError:
+                    continue
+            assign_ids(meds)
+            self._insert_many(tx, meds)
+            tx.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    @staticmethod
+    def _insert_many(tx, meds, start: int = 0):
+        written = 0
+
+        def rows():
+            nonlocal written
+            for pos, med in enumerate(meds, start):
+                data = json.dumps(med, ensure_ascii=False)
+                if instrumentation.ENABLED:
+                    written += len(data.encode("utf-8"))
+                yield med["id"], pos, data
+
+        tx.executemany("INSERT INTO meds (id, pos, data) VALUES (?, ?, ?)", rows())
+        instrumentation.add_bytes("written", "sqlite", written)
+
+    def _migrate_legacy_json(self):
+        conn = self._conn
+        done = conn.execute("SELECT value FROM meta WHERE key = 'legacy_json_migrated'").fetchone()
+        if done:
+            return
+        meds = []
+        if self.legacy_json and os.path.exists(self.legacy_json):
+            legacy = JsonEngine(self.legacy_json)
+            try:
+                meds = legacy.load_meds()
+            finally:
+                legacy.close()
+        with self.transaction() as tx:
+            if not tx.execute("SELECT 1 FROM meds LIMIT 1").fetchone():
+                self._insert_many(tx, meds)
+            tx.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_json_migrated', '1')")
+
+    def initialize(self):
+        with self._lock:
+            self._connect()
+
+    def signature(self):
+        # data_version solo cambia con commits de otras conexiones.
+        with self._lock:
+            (version,) = self._connect().execute("PRAGMA data_version").fetchone()
+        return version
+
+    def load_meds(self):
+        with self._lock:
+            rows = self._connect().execute("SELECT data FROM meds ORDER BY pos").fetchall()
+        if instrumentation.ENABLED:
+            instrumentation.add_bytes("read", "sqlite", sum(len(data.encode("utf-8")) for (data,) in rows))
+        meds = []
+        for (data,) in rows:
+            try:
+                meds.append(json.loads(data))
+            except ValueError:
+                continue
+        return meds
+
+    def add_med(self, entry: dict) -> str:
+        with self.transaction() as tx:
+            (pos,) = tx.execute("SELECT COALESCE(MAX(pos) + 1, 0) FROM meds").fetchone()
+            self._insert_many(tx, [entry], start=pos)
+        return entry["id"]
+
+    def add_meds(self, entries) -> list:
+        """Añade varios medicamentos en una sola transacción."""
+        entries = list(entries)
+        with self.transaction() as tx:
+            (pos,) = tx.execute("SELECT COALESCE(MAX(pos) + 1, 0) FROM meds").fetchone()
+            self._insert_many(tx, entries, start=pos)
+        return [entry["id"] for entry in entries]
+
+    def update_med(self, med_id: str, entry: dict):
+        data = json.dumps(entry, ensure_ascii=False)
+        with self.transaction() as tx:
+            cursor = tx.execute("UPDATE meds SET data = ? WHERE id = ?", (data, med_id))
+        if cursor.rowcount:
+            instrumentation.add_bytes("written", "sqlite", len(data.encode("utf-8")))
+            return True
+        raise KeyError(f"Medicamento no encontrado: {med_id}")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
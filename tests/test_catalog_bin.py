@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de catalog_bin: el catálogo reemplazado no deja mmaps abiertos."""
+import gc
+import json
+import os
+
+import catalog_bin
+
+
+def _write_catalog(path, names):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump([{"nombre": name, "sustancia": name} for name in names], f)
+
+
+def _loader(path):
+    def load():
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return load
+
+
+def _touch_newer(path, names):
+    st = os.stat(path)
+    _write_catalog(path, names)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def test_replaced_catalog_is_closed_without_readers(tmp_path):
+    path = str(tmp_path / "catalogo.json")
+    _write_catalog(path, ["ibuprofeno"])
+    old = catalog_bin.get_catalog(path, _loader(path))
+    finalizer = old._finalizer
+    del old
+    _touch_newer(path, ["ibuprofeno", "paracetamol"])
+    new = catalog_bin.get_catalog(path, _loader(path))
+    gc.collect()
+    assert not finalizer.alive
+    assert len(new) == 2
+    new.close()
+
+
+def test_replaced_catalog_stays_open_for_its_reader(tmp_path):
+    path = str(tmp_path / "catalogo.json")
+    _write_catalog(path, ["ibuprofeno"])
+    reader = catalog_bin.get_catalog(path, _loader(path))
+    _touch_newer(path, ["paracetamol"])
+    new = catalog_bin.get_catalog(path, _loader(path))
+    assert new is not reader
+    # El lector sigue viendo su versión hasta soltarla.
+    assert reader.item(0)["nombre"] == "ibuprofeno"
+    finalizer = reader._finalizer
+    del reader
+    gc.collect()
+    assert not finalizer.alive
+    new.close()
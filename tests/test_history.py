@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Pruebas del historial: ids válidos y compactaciones cortadas."""
+import os
+
+import pytest
+
+import history
+from history import DoseHistory
+
+
+def _fill(hist, count, start=0):
+    for i in range(start, start + count):
+        hist.record(f"med{i % 3}", ts=1000.0 + i)
+
+
+def _ts(hist):
+    return [event[0] for event in hist.events()]
+
+
+@pytest.mark.parametrize("med_id", ["x" * 33, "ibuprofeño", "", "a\0b"])
+def test_invalid_ids_are_rejected_before_writing(tmp_path, med_id):
+    hist = DoseHistory(str(tmp_path))
+    with pytest.raises(ValueError):
+        hist.record(med_id, ts=1.0)
+    assert DoseHistory(str(tmp_path)).count() == 0
+
+
+def test_longest_valid_id_round_trips(tmp_path):
+    med_id = "f" * history.ID_SIZE
+    DoseHistory(str(tmp_path)).record(med_id, ts=5.0)
+    assert DoseHistory(str(tmp_path)).last_dose(med_id) == 5.0
+
+
+def _crash(monkeypatch, target, name):
+    def fail(*args, **kwargs):
+        raise OSError("corte de energía simulado")
+    monkeypatch.setattr(target, name, fail)
+
+
+@pytest.mark.parametrize("step", ["manifest", "remove"])
+def test_crash_while_compacting_active_log(tmp_path, monkeypatch, step):
+    hist = DoseHistory(str(tmp_path))
+    _fill(hist, 10)
+    with monkeypatch.context() as m:
+        if step == "manifest":
+            _crash(m, DoseHistory, "_write_manifest")
+        else:
+            _crash(m, history.os, "remove")
+        with pytest.raises(OSError):
+            hist.compact()
+
+    reopened = DoseHistory(str(tmp_path))
+    assert _ts(reopened) == [1000.0 + i for i in range(10)]
+    _fill(reopened, 5, start=10)
+    assert _ts(DoseHistory(str(tmp_path))) == [1000.0 + i for i in range(15)]
+
+
+@pytest.mark.parametrize("step", ["manifest", "remove"])
+def test_crash_while_merging_segments(tmp_path, monkeypatch, step):
+    monkeypatch.setattr(history, "MAX_SEGMENTS", 2)
+    hist = DoseHistory(str(tmp_path))
+    for n in range(2):
+        _fill(hist, 4, start=4 * n)
+        hist.compact()
+    _fill(hist, 4, start=8)
+
+    real_write = DoseHistory._write_manifest
+    calls = []
+
+    def write_manifest(self):
+        # El primero es el del log activo; el segundo, el de la fusión.
+        calls.append(None)
+        if len(calls) == 2:
+            raise OSError("corte de energía simulado")
+        real_write(self)
+
+    real_remove = os.remove
+
+    def remove(path):
+        # Se borra el log activo viejo; se corta al borrar los segmentos fusionados.
+        if os.path.basename(path).startswith("seg-"):
+            raise OSError("corte de energía simulado")
+        real_remove(path)
+
+    with monkeypatch.context() as m:
+        if step == "manifest":
+            m.setattr(DoseHistory, "_write_manifest", write_manifest)
+        else:
+            m.setattr(history.os, "remove", remove)
+        with pytest.raises(OSError):
+            hist.compact()
+
+    reopened = DoseHistory(str(tmp_path))
+    assert _ts(reopened) == [1000.0 + i for i in range(12)]
+    assert reopened.count() == 12
+    leftovers = sorted(n for n in os.listdir(tmp_path) if n.endswith(".log"))
+    assert len(leftovers) == len(reopened._segments) + os.path.exists(reopened._active_path())
+
+
+def test_legacy_history_without_manifest(tmp_path):
+    hist = DoseHistory(str(tmp_path))
+    _fill(hist, 3)
+    assert os.path.exists(tmp_path / history.ACTIVE_FILE)
+    hist.compact()
+    os.remove(tmp_path / history.MANIFEST_FILE)
+    # Como lo dejaba la versión anterior: segmentos y sin índice.
+    reopened = DoseHistory(str(tmp_path))
+    assert reopened.count() == 3
+
+
+
+def test_merge_waits_for_readers(tmp_path, monkeypatch):
+    monkeypatch.setattr(history, "MAX_SEGMENTS", 2)
+    hist = DoseHistory(str(tmp_path))
+    for n in range(2):
+        _fill(hist, 4, start=4 * n)
+        hist.compact()
+    real_events = history._Segment.events
+    merges = []
+
+    def events(segment, start, end):
+        # La fusión llega después de listar los segmentos y antes de abrirlos.
+        if not merges:
+            merges.append(None)
+            _fill(hist, 4, start=8)
+            hist.compact()
+        return real_events(segment, start, end)
+
+    monkeypatch.setattr(history._Segment, "events", events)
+    assert _ts(hist) == [1000.0 + i for i in range(8)]
+    merged = [os.path.basename(s.path) for s in hist._segments]
+    assert len(merged) == 1
+    assert sorted(n for n in os.listdir(tmp_path) if n.startswith("seg-")) == merged
+    assert _ts(hist) == [1000.0 + i for i in range(12)]
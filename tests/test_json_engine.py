@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de JsonEngine: diario, escrituras cortadas, checkpoints y conflictos."""
+import json
+import multiprocessing
+import os
+
+import pytest
+
+import storage_engine
+from storage_engine import ConflictError, JsonEngine, StorageCorruptedError
+
+
+def _med(med_id, nombre=None):
+    return {"id": med_id, "nombre": nombre or med_id, "sustancia": "", "mg": None,
+            "requiere_receta": False, "notas": ""}
+
+
+def _engine(tmp_path):
+    return JsonEngine(str(tmp_path / "medicamentos.json"))
+
+
+def _writer(meds_file, worker, count):
+    engine = JsonEngine(meds_file)
+    for i in range(count):
+        engine.add_med(_med(f"p{worker}-{i}"))
+    engine.close()
+
+
+@pytest.mark.skipif(storage_engine.fcntl is None, reason="sin lock entre procesos")
+def test_concurrent_processes_lose_nothing(tmp_path, monkeypatch):
+    # Varios checkpoints durante la prueba.
+    monkeypatch.setattr(storage_engine, "CHECKPOINT_EVERY", 32)
+    meds_file = str(tmp_path / "medicamentos.json")
+    JsonEngine(meds_file).initialize()
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=_writer, args=(meds_file, w, 60)) for w in range(4)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join(60)
+        assert p.exitcode == 0
+    ids = [med["id"] for med in JsonEngine(meds_file).load_meds()]
+    assert len(ids) == len(set(ids)) == 240
+    for w in range(4):
+        # Cada proceso conserva su orden de altas.
+        own = [i for i in ids if i.startswith(f"p{w}-")]
+        assert own == [f"p{w}-{i}" for i in range(60)]
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    engine = _engine(tmp_path)
+    engine.add_med(_med("a"))
+    engine.add_med(_med("b"))
+    with open(engine.journal_file, "ab") as f:
+        f.write(storage_engine.journal_line({"id": "c", "rev": 1, "med": _med("c")})[:-7])
+    engine.close()
+
+    reopened = _engine(tmp_path)
+    assert [m["id"] for m in reopened.load_meds()] == ["a", "b"]
+    # La línea cortada se quitó: lo que se escribe después se lee bien.
+    reopened.add_med(_med("d"))
+    assert [m["id"] for m in _engine(tmp_path).load_meds()] == ["a", "b", "d"]
+
+
+def test_damaged_line_in_the_middle_is_an_error(tmp_path):
+    engine = _engine(tmp_path)
+    engine.add_med(_med("a"))
+    engine.add_med(_med("b"))
+    with open(engine.journal_file, "rb") as f:
+        data = bytearray(f.read())
+    data[data.index(b"\n") - 3] ^= 0xFF  # daña el primer alta, no la última línea
+    with open(engine.journal_file, "wb") as f:
+        f.write(data)
+    with pytest.raises(StorageCorruptedError):
+        _engine(tmp_path).load_meds()
+
+
+def test_crash_between_snapshot_and_journal_reset(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage_engine, "CHECKPOINT_EVERY", 3)
+    engine = _engine(tmp_path)
+    engine.add_med(_med("a"))
+    engine.update_med("a", _med("a", "A editado"))
+    real_write = storage_engine.write_atomic
+
+    def crash_on_journal(path, data):
+        if path.endswith(storage_engine.JOURNAL_SUFFIX):
+            raise OSError("corte de energía simulado")
+        real_write(path, data)
+
+    # La tercera escritura llega al diario y dispara el checkpoint: la foto
+    # nueva se escribe pero el diario viejo queda sin reiniciar. La línea ya
+    # es durable, así que el alta no falla.
+    monkeypatch.setattr(storage_engine, "write_atomic", crash_on_journal)
+    assert engine.add_med(_med("b")) == "b"
+    monkeypatch.setattr(storage_engine, "write_atomic", real_write)
+    with open(engine.meds_file, encoding="utf-8") as f:
+        assert [m["id"] for m in json.load(f)] == ["a", "b"]
+    assert [m["id"] for m in engine.load_meds()] == ["a", "b"]
+
+    # Al reabrir, el diario viejo se aplica sobre la foto nueva sin duplicar.
+    reopened = _engine(tmp_path)
+    meds = reopened.load_meds()
+    assert [m["id"] for m in meds] == ["a", "b"]
+    assert meds[0]["nombre"] == "A editado"
+    assert reopened.revision("a") == 2
+    # La escritura siguiente reintenta el checkpoint y reinicia el diario.
+    reopened.update_med("a", _med("a", "otra vez"))
+    with open(engine.journal_file, "rb") as f:
+        assert len(f.read().splitlines()) == 1
+    assert _engine(tmp_path).load_meds()[0]["nombre"] == "otra vez"
+
+
+def test_stale_revision_is_a_conflict(tmp_path):
+    first = _engine(tmp_path)
+    first.add_med(_med("a"))
+    second = _engine(tmp_path)
+    first.load_meds()
+    second.load_meds()
+
+    second.update_med("a", _med("a", "de otro proceso"))
+    with pytest.raises(ConflictError):
+        first.update_med("a", _med("a", "pisaría el cambio"))
+    assert _engine(tmp_path).load_meds()[0]["nombre"] == "de otro proceso"
+
+    # Después de releer, la edición se aplica sobre la versión nueva.
+    first.load_meds()
+    first.update_med("a", _med("a", "sobre la última"))
+    assert _engine(tmp_path).load_meds()[0]["nombre"] == "sobre la última"
+
+
+def test_no_truncation_without_file_lock(tmp_path, monkeypatch):
+    engine = _engine(tmp_path)
+    engine.add_med(_med("a"))
+    partial = storage_engine.journal_line({"id": "b", "rev": 1, "med": _med("b")})[:-5]
+    with open(engine.journal_file, "ab") as f:
+        f.write(partial)
+    size = os.path.getsize(engine.journal_file)
+    # Sin lock entre procesos (Windows) la lectura no corta lo que otro
+    # proceso podría estar escribiendo.
+    monkeypatch.setattr(storage_engine, "fcntl", None)
+    reader = _engine(tmp_path)
+    assert [m["id"] for m in reader.load_meds()] == ["a"]
+    assert os.path.getsize(engine.journal_file) == size
+    # Al escribir tampoco: la línea nueva empieza en un renglón propio.
+    reader.add_med(_med("c"))
+    with open(engine.journal_file, "rb") as f:
+        assert partial + b"\n" in f.read()
+    assert [m["id"] for m in _engine(tmp_path).load_meds()] == ["a", "c"]
+
+
+def test_bulk_add_is_all_or_nothing(tmp_path):
+    engine = _engine(tmp_path)
+    engine.add_med(_med("a"))
+    with pytest.raises(ValueError):
+        engine.add_meds([_med("b"), _med("a"), _med("c")])
+    with pytest.raises(ValueError):
+        engine.add_meds([_med("d"), _med("d")])
+    assert [m["id"] for m in engine.load_meds()] == ["a"]
+    assert [m["id"] for m in _engine(tmp_path).load_meds()] == ["a"]
+    engine.add_meds(_med(i) for i in ("b", "c"))
+    assert [m["id"] for m in _engine(tmp_path).load_meds()] == ["a", "b", "c"]
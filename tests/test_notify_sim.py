@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""Pruebas de notify_sim: la simulación detecta errores del planificador."""
+import notify
+import notify_sim
+
+
+def test_clean_run_has_no_problems():
+    report = notify_sim.simulate(meds=40, days=20)
+    assert notify_sim.check(report) == []
+    assert report["fires"] == report["expected_fires"] > 0
+    assert report["delivered"] == report["fires"]
+
+
+def test_drift_is_measured_against_its_own_schedule(monkeypatch):
+    real_push = notify._Scheduler._push
+
+    def late_push(self, reminder):
+        # Cada reprogramación llega medio segundo tarde.
+        if reminder.due > self.clock.time():
+            reminder.due += 0.5
+        real_push(self, reminder)
+
+    monkeypatch.setattr(notify._Scheduler, "_push", late_push)
+    report = notify_sim.simulate(meds=10, days=5)
+    assert report["max_drift_s"] >= 0.5
+    assert any("deriva" in problem for problem in notify_sim.check(report))
+
+
+def test_skipped_fires_are_reported(monkeypatch):
+    real_push = notify._Scheduler._push
+
+    def skipping_push(self, reminder):
+        # Cada reprogramación se saltea un disparo.
+        reminder.due += reminder.interval
+        real_push(self, reminder)
+
+    monkeypatch.setattr(notify._Scheduler, "_push", skipping_push)
+    report = notify_sim.simulate(meds=10, days=10)
+    assert report["missed_fires"] > 0
+    assert report["skipped_fires"] > 0
+    assert notify_sim.check(report)
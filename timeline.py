@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Agenda de próximas tomas ("qué toca en las próximas 24 h / 7 días").
+
+Cada medicamento con recordatorio se reduce a un ancla y un intervalo: las
+tomas caen en `ancla + k * intervalo`. El ancla es la última toma registrada
+si la hay, si no `recordatorio.inicio` (hora en que se programó) y, para los
+datos antiguos sin `inicio`, el comienzo de la agenda.
+
+Con NumPy, todas las horas de todos los medicamentos dentro del horizonte se
+calculan en lote (sin bucles por toma) y se ordenan en un solo arreglo. Sin
+NumPy se usa el mismo algoritmo con listas. La agenda queda en caché; editar
+un medicamento solo quita sus filas e inserta las nuevas en orden.
+"""
+import bisect
+import math
+import time
+
+try:
+    import numpy as np
+except ImportError:  # NumPy es opcional
+    np = None
+
+DAY = 86400.0
+# Horizonte que se materializa por adelantado.
+DEFAULT_HORIZON = 7 * DAY
+
+
+def reminder_plan(med: dict, last_dose: float = None):
+    """(ancla, intervalo en segundos) de un medicamento, o None si no tiene recordatorio."""
+    reminder = med.get("recordatorio") or {}
+    try:
+        hours = float(reminder.get("intervalo_horas") or 0)
+    except (TypeError, ValueError):
+        hours = 0.0
+    if hours <= 0:
+        return None
+    anchor = last_dose if last_dose else reminder.get("inicio")
+    try:
+        anchor = float(anchor) if anchor else None
+    except (TypeError, ValueError):
+        anchor = None
+    return anchor, hours * 3600.0
+
+
+class Timeline:
+    """
+    Agenda en caché entre `start` y `start + horizon`.
+
+    - `rebuild(meds, last_doses)`: recalcula todo en lote.
+    - `update(med, last_dose)` / `remove(med_id)`: solo las filas de ese medicamento.
+    - `upcoming(within)`: tomas (hora, id) ordenadas desde ahora.
+    """
+
+    def __init__(self, horizon: float = DEFAULT_HORIZON, use_numpy: bool = None):
+        self.horizon = float(horizon)
+        self.use_numpy = (np is not None) if use_numpy is None else (use_numpy and np is not None)
+        self.start = None
+        self.end = None
+        self._plans = {}  # id -> (ancla, intervalo)
+        self._slots = {}  # id -> índice en _ids
+        self._ids = []
+        self._times = None
+        self._owners = None
+
+    def __len__(self):
+        return 0 if self._times is None else len(self._times)
+
+    # ------------------------
+    # Cálculo
+    # ------------------------
+    def _anchor(self, plan):
+        anchor, interval = plan
+        return (self.start if anchor is None else anchor), interval
+
+    def _slot(self, med_id: str) -> int:
+        slot = self._slots.get(med_id)
+        if slot is None:
+            slot = self._slots[med_id] = len(self._ids)
+            self._ids.append(med_id)
+        return slot
+
+    def _occurrences_numpy(self, slots, anchors, intervals):
+        """Horas y dueños de todas las tomas en [start, end), calculadas en lote."""
+        anchors = np.asarray(anchors, dtype=np.float64)
+        intervals = np.asarray(intervals, dtype=np.float64)
+        # Primera y última toma de cada medicamento dentro de la ventana.
+        first = np.ceil((self.start - anchors) / intervals)
+        # La toma del ancla misma ya ocurrió: la siguiente es k >= 1.
+        first = np.maximum(first, 1)
+        last = np.ceil((self.end - anchors) / intervals) - 1
+        counts = np.maximum(last - first + 1, 0).astype(np.int64)
+        total = int(counts.sum())
+        owners = np.repeat(np.asarray(slots, dtype=np.int64), counts)
+        if not total:
+            return np.empty(0, dtype=np.float64), owners
+        # Posición de cada toma dentro de su medicamento: 0, 1, 2, ...
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        k = np.repeat(first, counts) + (np.arange(total) - starts)
+        times = np.repeat(anchors, counts) + np.repeat(intervals, counts) * k
+        return times, owners
+
+    def _occurrences_python(self, slots, anchors, intervals):
+        times, owners = [], []
+        for slot, anchor, interval in zip(slots, anchors, intervals):
+            k = max(math.ceil((self.start - anchor) / interval), 1)
+            t = anchor + k * interval
+            while t < self.end:
+                times.append(t)
+                owners.append(slot)
+                k += 1
+                t = anchor + k * interval
+        return times, owners
+
+    def _occurrences(self, med_ids):
+        slots, anchors, intervals = [], [], []
+        for med_id in med_ids:
+            anchor, interval = self._anchor(self._plans[med_id])
+            slots.append(self._slot(med_id))
+            anchors.append(anchor)
+            intervals.append(interval)
+        if self.use_numpy:
+            return self._occurrences_numpy(slots, anchors, intervals)
+        return self._occurrences_python(slots, anchors, intervals)
+
+    def _materialize(self):
+        times, owners = self._occurrences(list(self._plans))
+        if self.use_numpy:
+            order = np.argsort(times, kind="stable")
+            self._times = times[order]
+            self._owners = owners[order]
+        else:
+            pairs = sorted(zip(times, owners))
+            self._times = [t for t, _o in pairs]
+            self._owners = [o for _t, o in pairs]
+
+    # ------------------------
+    # API
+    # ------------------------
+    def rebuild(self, meds, last_doses=None, start: float = None):
+        """Recalcula la agenda completa desde `start` (por defecto, ahora)."""
+        last_doses = last_doses or {}
+        self.start = time.time() if start is None else float(start)
+        self.end = self.start + self.horizon
+        self._plans = {}
+        self._slots = {}
+        self._ids = []
+        for med in meds:
+            plan = reminder_plan(med, last_doses.get(med.get("id")))
+            if plan is not None:
+                self._plans[med["id"]] = plan
+        self._materialize()
+        return self
+
+    def _shift(self, start: float):
+        """Mueve la ventana a `start` reutilizando los planes guardados."""
+        self.start = float(start)
+        self.end = self.start + self.horizon
+        self._materialize()
+
+    def remove(self, med_id: str):
+        """Quita las tomas de un medicamento."""
+        self._plans.pop(med_id, None)
+        slot = self._slots.get(med_id)
+        if slot is None or self._times is None:
+            return
+        if self.use_numpy:
+            keep = self._owners != slot
+            self._times = self._times[keep]
+            self._owners = self._owners[keep]
+        else:
+            pairs = [(t, o) for t, o in zip(self._times, self._owners) if o != slot]
+            self._times = [t for t, _o in pairs]
+            self._owners = [o for _t, o in pairs]
+
+    def update(self, med: dict, last_dose: float = None):
+        """Recalcula solo las tomas de `med` (alta, edición o nueva toma)."""
+        if self.start is None:
+            raise RuntimeError("La agenda no se construyó; use rebuild()")
+        med_id = med["id"]
+        self.remove(med_id)
+        plan = reminder_plan(med, last_dose)
+        if plan is None:
+            return
+        self._plans[med_id] = plan
+        times, owners = self._occurrences([med_id])
+        if self.use_numpy:
+            positions = np.searchsorted(self._times, times, side="right")
+            self._times = np.insert(self._times, positions, times)
+            self._owners = np.insert(self._owners, positions, owners)
+        else:
+            for t, owner in zip(times, owners):
+                pos = bisect.bisect_right(self._times, t)
+                self._times.insert(pos, t)
+                self._owners.insert(pos, owner)
+
+    def upcoming(self, within: float = DAY, start: float = None, limit: int = None):
+        """
+        Tomas entre `start` (por defecto ahora) y `start + within`, como lista
+        de (hora, id) ordenada. Si la ventana pedida sale de la caché, se
+        vuelve a materializar desde `start`.
+        """
+        start = time.time() if start is None else float(start)
+        end = start + within
+        if self.start is None:
+            return []
+        if start < self.start or end > self.end:
+            if within > self.horizon:
+                self.horizon = float(within)
+            self._shift(start)
+        if self.use_numpy:
+            lo = int(np.searchsorted(self._times, start, side="left"))
+            hi = int(np.searchsorted(self._times, end, side="left"))
+        else:
+            lo = bisect.bisect_left(self._times, start)
+            hi = bisect.bisect_left(self._times, end)
+        if limit is not None:
+            hi = min(hi, lo + limit)
+        ids = self._ids
+        return [(float(t), ids[int(o)]) for t, o in zip(self._times[lo:hi], self._owners[lo:hi])]
+
+    def next_dose(self, med_id: str, start: float = None):
+        """Próxima toma de un medicamento después de `start`, o None."""
+        plan = self._plans.get(med_id)
+        if plan is None:
+            return None
+        start = time.time() if start is None else float(start)
+        anchor, interval = self._anchor(plan)
+        k = max(math.floor((start - anchor) / interval) + 1, 1)
+        return anchor + k * interval